@@ -0,0 +1,61 @@
+'''
+Compares the landmark region engine against exact spectral clustering on the bundled datasets.
+The exact path uses the sparse affinity with the ARPACK eigensolver so that it fits in memory
+up to 25k users. Agreement is reported both with each engine choosing K by its own eigengap
+and with the landmark engine forced to the K chosen by the exact path.
+Expect an ARI of about 0.5-0.6 at the same K: the landmark embedding approximates the
+eigenvectors of a different, landmark mediated affinity, so k-means draws the boundaries
+between neighbouring settlements differently. The eigengap of either engine is often
+only marginally larger than the next one, so K can differ too. Neither is the ground truth.
+
+USAGE: python3 -m benchmarks.compare_engines [DATASET_SIZE ...]
+'''
+import sys
+import time
+import numpy as np
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+from regions import Regions
+from landmarks import LandmarkRegions
+from datahandler import DatasetReader
+
+DATASET_SIZES = [1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000, 5500, 10000, 15000, 20000, 25000]
+
+def read_dataset(size):
+    # same ingest path as the pipeline, including the .npy sidecar cache
+    return DatasetReader().read("datasets/dataset%s.csv" % size)
+
+def timed_labels(settlement_clustering, users):
+    start = time.time()
+    settlement_clustering.detect_regions(users)
+    return settlement_clustering.labels, time.time() - start
+
+def compare(size):
+    users = read_dataset(size)
+    exact_labels, exact_time = timed_labels(Regions(affinity="sparse", eigen_solver="arpack"), users)
+    landmark_labels, landmark_time = timed_labels(LandmarkRegions(), users)
+    exact_k = len(np.unique(exact_labels))
+    same_k_labels, _ = timed_labels(LandmarkRegions(n_clusters=exact_k), users)
+
+    return {
+        "users": size,
+        "exact_regions": exact_k,
+        "landmark_regions": len(np.unique(landmark_labels)),
+        "ari": adjusted_rand_score(exact_labels, landmark_labels),
+        "nmi": normalized_mutual_info_score(exact_labels, landmark_labels),
+        "ari_same_k": adjusted_rand_score(exact_labels, same_k_labels),
+        "nmi_same_k": normalized_mutual_info_score(exact_labels, same_k_labels),
+        "exact_seconds": exact_time,
+        "landmark_seconds": landmark_time
+    }
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or DATASET_SIZES
+    columns = ["users", "exact_regions", "landmark_regions", "ari", "nmi", "ari_same_k", "nmi_same_k",
+               "exact_seconds", "landmark_seconds"]
+    print("\t".join(columns))
+    for size in sizes:
+        result = compare(size)
+        print("\t".join(
+            "%.3f" % result[column] if isinstance(result[column], float) else str(result[column])
+            for column in columns
+        ))
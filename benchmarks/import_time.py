@@ -0,0 +1,86 @@
+'''
+Cold start benchmark of the command line interface. Every scenario runs in a fresh
+interpreter so that nothing is already imported, wall time is the best and the median
+of the repeats, and -X importtime gives the modules that cost the most to import.
+The eager scenario imports every pipeline stage up front, the way towersdistributor
+used to at module load, as the reference the lazy scenarios are compared against.
+
+USAGE: python3 -m benchmarks.import_time [OPTIONS] [SCENARIO ...]
+'''
+import sys
+import json
+import time
+import subprocess
+import click
+
+SCENARIOS = {
+    "interpreter": "pass",
+    "cli": "import cli",
+    "cli_help": "import sys; sys.argv = ['cli.py', 'evaluate', '--help']; import cli; cli.cli(standalone_mode=False)",
+    "towersdistributor": "import towersdistributor",
+    "headless": "import towersdistributor, regions, cellsites, optimizer, evaluator",
+    "render": "import towersdistributor, visualizer",
+    "eager": "import towersdistributor, regions, landmarks, cellsites, optimizer, evaluator, visualizer, matplotlib.pyplot"
+}
+
+def wall_time(statement):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", statement], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def slowest_imports(statement, top):
+    '''
+    :return: list of (cumulative seconds, module) of the top slowest top level imports
+    '''
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement], check=True, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, text=True
+    )
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        # only modules imported by the statement itself, not their dependencies
+        if cumulative.strip().isdigit() and not module.startswith("  "):
+            imports.append((int(cumulative) / 10 ** 6, module.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+@click.command()
+@click.argument("scenarios", nargs=-1, type=click.Choice(list(SCENARIOS)))
+@click.option("-r", "--repeat", default=5, help="fresh interpreters started per scenario")
+@click.option("-t", "--top", default=5, help="slowest imports listed per scenario")
+@click.option("-o", "--output", default=None, help="JSON file for the results")
+def import_time(scenarios, repeat, top, output):
+    if repeat < 1:
+        raise ValueError("repeat must be atleast 1")
+    scenarios = scenarios or list(SCENARIOS)
+
+    results = dict()
+    for scenario in scenarios:
+        # one warm up run so that the bytecode is compiled and the files are in the page cache
+        wall_time(SCENARIOS[scenario])
+        seconds = sorted(wall_time(SCENARIOS[scenario]) for _ in range(repeat))
+        results[scenario] = {
+            "best": seconds[0],
+            "median": seconds[len(seconds) // 2],
+            "slowest_imports": slowest_imports(SCENARIOS[scenario], top)
+        }
+        print("%-18s best %.3f s, median %.3f s | %s" % (
+            scenario, results[scenario]["best"], results[scenario]["median"],
+            ", ".join("%s %.3f s" % (module, cumulative) for cumulative, module in results[scenario]["slowest_imports"])
+        ))
+
+    if "eager" in results:
+        for scenario in results:
+            if scenario != "eager":
+                print("%-18s %.1fx speedup over eager" % (
+                    scenario, results["eager"]["median"] / results[scenario]["median"]
+                ))
+
+    if output is not None:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+if __name__ == "__main__":
+    import_time()
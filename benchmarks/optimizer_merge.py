@@ -0,0 +1,56 @@
+'''
+Benchmarks the priority queue merge engine of the Optimizer against the repeated scan
+on the bundled 10k-100k datasets and checks that both give identical distributions.
+Regions are cut on a fixed geographic grid so that the optimizer sees hundreds to
+thousands of regions without paying for a region clustering per run.
+
+USAGE: python3 -m benchmarks.optimizer_merge [DATASET_SIZE ...]
+'''
+import sys
+import copy
+import time
+import numpy as np
+from regions import Regions
+from cellsites import CellSites
+from optimizer import Optimizer
+from towerdistribution import TowerDistribution
+from benchmarks.compare_engines import read_dataset
+
+DATASET_SIZES = [10000, 15000, 20000, 25000, 50000, 100000]
+
+def build_distribution(size, grid_size=0.004):
+    users = read_dataset(size)
+    grid_cells = np.floor(users / grid_size).astype(np.int64)
+    _, labels = np.unique(grid_cells, axis=0, return_inverse=True)
+    settlement_clustering = Regions()
+    settlement_clustering.regions = regions = settlement_clustering.format_regions(labels.ravel(), users)
+    base_stations = settlement_clustering.locate_base_stations_proximity()
+    cell_sites = CellSites(radiation_range=0.01).distribute_cellsites(regions)
+    return TowerDistribution.from_regions(regions, cell_sites, base_stations)
+
+def timed_optimize(tower_distribution, merge):
+    optimizer = Optimizer(min_towers=5, min_cell_site_distance=0.004, merge=merge)
+    start = time.time()
+    optimized = optimizer.optimize(copy.deepcopy(tower_distribution))
+    return optimized, time.time() - start
+
+def identical(first, second):
+    return (
+        np.array_equal(first.region_ids, second.region_ids)
+        and np.array_equal(first.user_regions, second.user_regions)
+        and np.array_equal(first.base_stations[first.region_ids], second.base_stations[second.region_ids])
+        and np.array_equal(first.cell_sites, second.cell_sites)
+        and np.array_equal(first.cell_site_regions, second.cell_site_regions)
+    )
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or DATASET_SIZES
+    print("\t".join(["users", "regions", "optimized_regions", "scan_seconds", "heap_seconds", "identical"]))
+    for size in sizes:
+        tower_distribution = build_distribution(size)
+        scanned, scan_time = timed_optimize(tower_distribution, "scan")
+        merged, heap_time = timed_optimize(tower_distribution, "heap")
+        print("\t".join([
+            str(size), str(len(tower_distribution)), str(len(merged)),
+            "%.3f" % scan_time, "%.3f" % heap_time, str(identical(scanned, merged))
+        ]))
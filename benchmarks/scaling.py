@@ -0,0 +1,221 @@
+'''
+Scaling benchmark of every pipeline stage over the bundled datasets. Each dataset size
+runs in a fresh process so that the peak RSS of a stage is not hidden by an earlier,
+larger one. Wall time, peak RSS and output quality are written to a JSON file, an
+empirical scaling exponent is fitted per stage and, given a baseline from an earlier
+run, slower stages and changed outputs are flagged as regressions.
+
+By default every bundled size up to 100k users is measured, the 25k-100k runs take
+most of the time, pass smaller sizes for a quick run.
+
+USAGE: python3 -m benchmarks.scaling [OPTIONS] [DATASET_SIZE ...]
+'''
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import click
+import numpy as np
+from instrumentation import reset_peak_rss, peak_rss
+
+DATASET_SIZES = [1000, 2000, 3000, 4000, 5000, 10000, 15000, 20000, 25000, 50000, 100000]
+STAGES = [
+    "ingest", "affinity", "eigendecomposition", "spectral_fit", "cellsites",
+    "optimizer", "evaluator", "serialization", "map_rendering"
+]
+
+class StageTimer:
+    def __init__(self):
+        self.stages = dict()
+
+    def run(self, stage, function, *args, **kwargs):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.stages[stage] = {"seconds": time.perf_counter() - start, "peak_rss": peak_rss()}
+        return result
+
+def benchmark_size(size, affinity, eigen_solver, radiation_range, min_towers, min_gap, render_map, seed):
+    '''
+    Runs the whole pipeline on one dataset, one timed stage at a time
+    :return: dict of the stage measurements and the output quality
+    '''
+    from sklearn.cluster import SpectralClustering
+    from regions import Regions
+    from cellsites import CellSites
+    from optimizer import Optimizer
+    from evaluator import Evaluator
+    from visualizer import Visuals
+    from datahandler import DatasetReader, Serializer
+    from towerdistribution import TowerDistribution
+
+    random.seed(seed)
+    np.random.seed(seed)
+    timer = StageTimer()
+    users = timer.run("ingest", DatasetReader(cache=False).read, "datasets/dataset%d.csv" % size)
+
+    settlement_clustering = Regions(affinity=affinity, eigen_solver=eigen_solver)
+    if affinity == "sparse":
+        affinity_matrix = timer.run("affinity", settlement_clustering.get_sparse_affinity_matrix, users, k=100)
+    else:
+        affinity_matrix = timer.run("affinity", settlement_clustering.get_affinity_matrix, users, k=100)
+    n_clusters, _ = timer.run("eigendecomposition", settlement_clustering.eigen_decomposition, affinity_matrix, topK=50)
+
+    def spectral_fit(affinity_matrix):
+        if settlement_clustering.eigenvectors is not None:
+            labels = settlement_clustering.embed_and_cluster(n_clusters)
+        else:
+            region_clustering = SpectralClustering(n_clusters=n_clusters, random_state=seed, affinity='precomputed')
+            labels = region_clustering.fit(affinity_matrix).labels_
+        settlement_clustering.regions = settlement_clustering.format_regions(labels, users)
+        return settlement_clustering.regions, settlement_clustering.locate_base_stations_proximity()
+
+    regions, base_stations = timer.run("spectral_fit", spectral_fit, affinity_matrix)
+    del affinity_matrix
+
+    radiation_range = radiation_range / 10 ** 5
+    cell_sites = timer.run("cellsites", CellSites(radiation_range=radiation_range).distribute_cellsites, regions)
+    tower_distribution = TowerDistribution.from_regions(regions, cell_sites, base_stations)
+    optimizer = Optimizer(min_towers=min_towers, min_cell_site_distance=min_gap / 10 ** 5)
+    tower_distribution = timer.run("optimizer", optimizer.optimize, tower_distribution)
+    _, n_cell_sites, coverage = timer.run(
+        "evaluator", Evaluator(radiation_range=radiation_range).evaluate, tower_distribution
+    )
+
+    with tempfile.TemporaryDirectory(prefix="towersdistributor-benchmark-") as output_directory:
+        def serialization():
+            serializer = Serializer(tower_distribution)
+            serializer.serialize()
+            serializer.save(os.path.join(output_directory, "td.json"))
+            serializer.save_arrays(os.path.join(output_directory, "td"))
+
+        timer.run("serialization", serialization)
+        if render_map:
+            timer.run("map_rendering", Visuals(tower_distribution).make_map, os.path.join(output_directory, "td.html"))
+
+    return {
+        "stages": timer.stages,
+        "quality": {
+            "regions": len(tower_distribution),
+            "eigengap_regions": int(n_clusters),
+            "cell_sites": int(n_cell_sites),
+            "coverage": float(coverage)
+        }
+    }
+
+def scaling_exponents(results):
+    '''
+    Fits seconds ~ users ** exponent for every stage by least squares in log-log space
+    :return: dict of stage: exponent, None with less than two usable sizes
+    '''
+    exponents = dict()
+    for stage in STAGES:
+        points = [
+            (int(size), result["stages"][stage]["seconds"])
+            for size, result in results.items()
+            if stage in result["stages"] and result["stages"][stage]["seconds"] > 0
+        ]
+        if len(points) < 2 or len(set(size for size, _ in points)) < 2:
+            exponents[stage] = None
+            continue
+        sizes, seconds = np.log(np.array(points, dtype=float)).T
+        exponents[stage] = float(np.polyfit(sizes, seconds, 1)[0])
+    return exponents
+
+def find_regressions(results, baseline, tolerance, min_seconds):
+    '''
+    Compares the run with a stored baseline
+    :param tolerance: relative slowdown or memory growth allowed
+    :param min_seconds: absolute slowdown below which timing noise is ignored
+    :return: list of regression descriptions
+    '''
+    regressions = []
+    for size, result in results.items():
+        if size not in baseline.get("results", dict()):
+            continue
+        baseline_result = baseline["results"][size]
+        for stage, measurement in result["stages"].items():
+            if stage not in baseline_result["stages"]:
+                continue
+            reference = baseline_result["stages"][stage]
+            slowdown = measurement["seconds"] - reference["seconds"]
+            if slowdown > min_seconds and measurement["seconds"] > reference["seconds"] * (1 + tolerance):
+                regressions.append("%s users, %s: %.3f s -> %.3f s" % (
+                    size, stage, reference["seconds"], measurement["seconds"]
+                ))
+            if measurement["peak_rss"] > reference["peak_rss"] * (1 + tolerance):
+                regressions.append("%s users, %s: peak RSS %.1f MB -> %.1f MB" % (
+                    size, stage, reference["peak_rss"] / 2 ** 20, measurement["peak_rss"] / 2 ** 20
+                ))
+        for metric, value in result["quality"].items():
+            reference = baseline_result["quality"].get(metric)
+            if reference is not None and not np.isclose(value, reference):
+                regressions.append("%s users, %s: %s -> %s" % (size, metric, reference, value))
+    return regressions
+
+@click.command()
+@click.argument("sizes", nargs=-1, type=int)
+@click.option("-o", "--output", default="benchmarks/scaling.json", help="JSON file for the results")
+@click.option("-b", "--baseline", default=None, help="results of an earlier run to check for regressions")
+@click.option("-t", "--tolerance", default=0.25, help="relative slowdown or memory growth flagged as a regression")
+@click.option("-ms", "--min_seconds", default=0.05, help="slowdowns shorter than this are ignored as noise")
+@click.option("-af", "--affinity", default="sparse", type=click.Choice(["dense", "sparse"]), help="affinity matrix used for region clustering")
+@click.option("-es", "--eigen_solver", default="arpack", type=click.Choice(["dense", "arpack", "lobpcg"]), help="eigen solver for the eigengap heuristic")
+@click.option("-rr", "--radiation_range", default=1000, help="radiation range of cell site(in metres)")
+@click.option("-mt", "--min_towers", default=5, help="minimum towers to be considered as a region")
+@click.option("-mg", "--min_gap", default=400, help="minimum distance between towers(in metres)")
+@click.option("-nm", "--no_map", is_flag=True, help="skip the map rendering stage")
+@click.option("--seed", default=0, help="seed of the python and numpy random generators")
+def scaling(sizes, output, baseline, tolerance, min_seconds, affinity, eigen_solver, radiation_range,
+            min_towers, min_gap, no_map, seed):
+    sizes = list(sizes) or DATASET_SIZES
+    results = dict()
+    # a fresh process per size keeps the peak RSS of every run independent
+    spawn = multiprocessing.get_context("spawn")
+    for size in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            results[str(size)] = pool.submit(
+                benchmark_size, size, affinity, eigen_solver, radiation_range, min_towers, min_gap, not no_map, seed
+            ).result()
+        stages = results[str(size)]["stages"]
+        quality = results[str(size)]["quality"]
+        print("%d users: %s | %d cell sites, %.2f %% coverage" % (
+            size, ", ".join("%s %.3f s" % (stage, stages[stage]["seconds"]) for stage in STAGES if stage in stages),
+            quality["cell_sites"], quality["coverage"]
+        ))
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__},
+        "config": {
+            "affinity": affinity, "eigen_solver": eigen_solver, "radiation_range": radiation_range,
+            "min_towers": min_towers, "min_gap": min_gap, "seed": seed
+        },
+        "results": results,
+        "scaling_exponents": scaling_exponents(results)
+    }
+
+    print("\nscaling exponents (seconds ~ users ** k)")
+    for stage, exponent in report["scaling_exponents"].items():
+        print("%-20s %s" % (stage, "-" if exponent is None else "%.2f" % exponent))
+
+    if baseline is not None:
+        with open(baseline) as baseline_file:
+            report["regressions"] = find_regressions(results, json.load(baseline_file), tolerance, min_seconds)
+        print("\n%d regressions against %s" % (len(report["regressions"]), baseline))
+        for regression in report["regressions"]:
+            print("  " + regression)
+
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    scaling()
@@ -1,7 +1,34 @@
-import threading
+import os
+import time
 import logging
 import numpy as np
-from sklearn.cluster import KMeans
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from instrumentation import profiler
+
+BLAS_THREADS_VARIABLES = (
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"
+)
+
+def limit_blas_threads(threads, set_environment=True):
+    '''
+    Caps the BLAS/OpenMP threads of the current process so that parallel workers
+    do not oversubscribe the cores. threadpoolctl is used when it is installed,
+    otherwise only the environment variables read by freshly started libraries are set.
+    :param threads: max threads per worker
+    :param set_environment: also export the limit through the environment variables
+    :return: the threadpoolctl limiter or None
+    '''
+    if set_environment:
+        for variable in BLAS_THREADS_VARIABLES:
+            os.environ[variable] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=threads)
 
 class CellSites:
     '''
@@ -9,9 +36,32 @@ class CellSites:
     to identify the appropriate location for each cell site
     '''
     settlements = np.array([])
+    EXECUTORS = ("thread", "process")
+    SEARCHES = ("linear", "gallop")
 
-    def __init__(self, radiation_range):
-        self.permissible_distortion = radiation_range - 0.2 * radiation_range
+    def __init__(self, radiation_range, executor="thread", workers=None, search="linear", minibatch_threshold=None,
+                 distortion_scale=1):
+        '''
+        :param radiation_range: in the units of the users, degrees or projected metres
+        :param search: linear tries every K from the cube root of the no of users up. gallop
+                       needs far fewer fits but binary searches K, which assumes the distortion
+                       falls monotonically with K; as K-Means inertia does not always, it may
+                       settle on a different no of cell sites than linear.
+        :param distortion_scale: factor of the permissible distortion. The distortion is a sum
+                                 of squared distances held against a distance, so it is not
+                                 unit free: 10 ** 5 keeps metres calibrated like degrees.
+        '''
+        if executor not in self.EXECUTORS:
+            raise ValueError("executor must be one of " + ", ".join(self.EXECUTORS))
+        if search not in self.SEARCHES:
+            raise ValueError("search must be one of " + ", ".join(self.SEARCHES))
+        if workers is not None and workers < 1:
+            raise ValueError("no of workers must be atleast 1")
+        self.permissible_distortion = (radiation_range - 0.2 * radiation_range) * distortion_scale
+        self.executor = executor
+        self.search = search
+        self.minibatch_threshold = minibatch_threshold
+        self.workers = workers or os.cpu_count() or 1
         self.logger = logging.getLogger("cellsites")
 
     def optimise_and_cluster(self, users):
@@ -21,39 +71,190 @@ class CellSites:
         :return: cluster centroids for cell sites
         '''
         self.logger.debug("Distributing cell sites")
+        start = time.time()
+
+        if self.search == "gallop":
+            K, cluster_centers, fits, iterations = self.gallop_search(users)
+        else:
+            K, cluster_centers, fits, iterations = self.linear_search(users)
+        if len(users) and not len(cluster_centers):
+            raise RuntimeError("no cell sites were placed for a region of " + str(len(users)) + " users")
+
+        self.logger.debug(
+            "Optimal K = " + str(K) + " after " + str(fits) + " fits and " + str(iterations) +
+            " Lloyd iterations in " + "%.3f" % (time.time() - start) + " s"
+        )
+        return cluster_centers
 
+    def distortion(self, users, cell_sites):
+        '''
+        Sum of squared distances from the users to their closest cell site, the
+        K-Means inertia the search compares with the permissible distortion
+        '''
+        if not len(cell_sites):
+            return np.inf
+        distances = cKDTree(cell_sites).query(users)[0]
+        return (distances ** 2).sum()
+
+    def linear_search(self, users):
+        '''
+        Increments K by one from the cube root of the no of users until the
+        distortion is within the permissible distortion, refitting from scratch each time
+        :return: tuple of K, cluster centroids, no of fits and Lloyd iterations
+        '''
         K = int(len(users) ** (1. / 3.)) - 1
-        distortion = 1
+        # the permissible distortion of a projected run is far above 1, always fit once
+        distortion = np.inf
+        fits, iterations = 0, 0
 
         cluster_centers = np.array([])
         while distortion > self.permissible_distortion:
             K += 1
-            cell_site_clustering = KMeans(n_clusters=K)
+            cluster_centers, distortion, n_iter = self.fit_kmeans(users, K)
+            fits, iterations = fits + 1, iterations + n_iter
+
+        return K, cluster_centers, fits, iterations
+
+    def gallop_search(self, users):
+        '''
+        Finds the smallest K satisfying the same criterion as linear_search with
+        galloping steps of 1, 2, 4, ... followed by a binary search between the last
+        failing and the first passing K. Every fit is warm started from the centroids
+        of the closest smaller K already fitted.
+        :return: tuple of K, cluster centroids, no of fits and Lloyd iterations
+        '''
+        n_users = len(users)
+        fitted = dict()
+        iterations = 0
+
+        def fit(K):
+            smaller = [fitted_K for fitted_K in fitted if fitted_K < K]
+            init = None
+            if smaller:
+                nearest_K = max(smaller)
+                init = self.split_worst_clusters(users, fitted[nearest_K][0], K - nearest_K)
+            cluster_centers, distortion, n_iter = self.fit_kmeans(users, K, init)
+            fitted[K] = (cluster_centers, distortion)
+            return distortion <= self.permissible_distortion, n_iter
+
+        K = min(max(int(n_users ** (1. / 3.)), 1), n_users)
+        failing_K, passing_K, step = None, None, 1
+        while passing_K is None:
+            passed, n_iter = fit(K)
+            iterations += n_iter
+            if passed or K == n_users:
+                passing_K = K
+            else:
+                failing_K = K
+                K = min(K + step, n_users)
+                step *= 2
+
+        while failing_K is not None and passing_K - failing_K > 1:
+            K = (failing_K + passing_K) // 2
+            passed, n_iter = fit(K)
+            iterations += n_iter
+            if passed:
+                passing_K = K
+            else:
+                failing_K = K
+
+        return passing_K, fitted[passing_K][0], len(fitted), iterations
+
+    def fit_kmeans(self, users, K, init=None):
+        '''
+        Fits K-Means, or MiniBatchKMeans for regions above the minibatch threshold.
+        A warm start runs a single initialisation from the given centroids.
+        :return: tuple of cluster centroids, inertia and Lloyd iterations
+        '''
+        use_minibatch = self.minibatch_threshold is not None and len(users) >= self.minibatch_threshold
+        # a cold start keeps the library default no of initialisations
+        warm_start = dict() if init is None else dict(init=init, n_init=1)
+
+        with profiler.span("kmeans_fit", K=int(K), users=len(users), warm_start=init is not None):
+            if use_minibatch:
+                cell_site_clustering = MiniBatchKMeans(n_clusters=K, random_state=0, **warm_start)
+            else:
+                cell_site_clustering = KMeans(n_clusters=K, random_state=0, **warm_start)
             cell_site_clustering.fit(users)
-            distortion = cell_site_clustering.inertia_
-            cluster_centers = cell_site_clustering.cluster_centers_
-            del cell_site_clustering
+            profiler.count("kmeans_fits")
+            profiler.count("lloyd_iterations", int(cell_site_clustering.n_iter_))
 
-        self.logger.debug("Optimal K = " + str(K))
-        return cluster_centers
+        return cell_site_clustering.cluster_centers_, cell_site_clustering.inertia_, cell_site_clustering.n_iter_
 
-    def cell_site_clustering_thread(self, label, region):
-        cellsites_for_cluster = self.optimise_and_cluster(region)
-        self.cell_sites[label] = np.array(cellsites_for_cluster)
+    def split_worst_clusters(self, users, cluster_centers, n_splits):
+        '''
+        Grows the centroids by n_splits by repeatedly splitting the cluster with the
+        largest sum of squared distances: its farthest user becomes a new centroid
+        :return: array of len(cluster_centers) + n_splits centroids
+        '''
+        # a tree query instead of a users x centroids distance matrix
+        closest_distances, labels = cKDTree(cluster_centers).query(users)
+        closest_sq_distances = closest_distances ** 2
+
+        centers = list(cluster_centers)
+        for _ in range(n_splits):
+            cluster_distortion = np.bincount(labels, weights=closest_sq_distances, minlength=len(centers))
+            worst_cluster = np.argmax(cluster_distortion)
+            members = np.flatnonzero(labels == worst_cluster)
+            new_center = users[members[np.argmax(closest_sq_distances[members])]]
+
+            new_sq_distances = ((users - new_center) ** 2).sum(axis=1)
+            closer = new_sq_distances < closest_sq_distances
+            labels[closer] = len(centers)
+            closest_sq_distances[closer] = new_sq_distances[closer]
+            centers.append(new_center)
+
+        return np.array(centers)
+
+    def cell_site_clustering_task(self, label, region):
+        '''
+        Clusters a single region, runs inside the executor workers
+        :return: tuple of label, cell sites and seconds taken
+        '''
+        start = time.time()
+        with profiler.span("region_cell_sites", region=str(label), users=len(region)):
+            cellsites_for_cluster = self.optimise_and_cluster(region)
+        return label, np.array(cellsites_for_cluster), time.time() - start
 
     def distribute_cellsites(self, regions):
         '''
-        Optimises and distributes the cell sites
+        Optimises and distributes the cell sites. Regions are submitted to the executor
+        largest first so that the big regions do not end up as the last stragglers.
         :return: dict of label: cellsites
         '''
-        self.logger.debug("Creating threads...")
-        self.cell_sites = dict()
-        clustering_threads = dict()
-        for label, region in regions.items():
-            clustering_thread = threading.Thread(target=self.cell_site_clustering_thread, args=(label, region))
-            clustering_thread.start()
-            clustering_thread.join()
+        threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        self.logger.debug(
+            "Clustering " + str(len(regions)) + " regions on " + str(self.workers) + " " +
+            self.executor + " workers with " + str(threads_per_worker) + " BLAS threads each"
+        )
+
+        ordered_regions = sorted(regions.items(), key=lambda item: len(item[1]), reverse=True)
+        if self.executor == "process":
+            pool = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=limit_blas_threads, initargs=(threads_per_worker,)
+            )
+            blas_limiter = None
+        else:
+            pool = ThreadPoolExecutor(max_workers=self.workers)
+            blas_limiter = limit_blas_threads(threads_per_worker, set_environment=False)
 
-            clustering_threads[label] = clustering_thread
+        cell_sites = dict()
+        try:
+            with pool:
+                tasks = [
+                    pool.submit(self.cell_site_clustering_task, label, region)
+                    for label, region in ordered_regions
+                ]
+                for task in tasks:
+                    label, cellsites_for_cluster, seconds = task.result()
+                    cell_sites[label] = cellsites_for_cluster
+                    self.logger.debug(
+                        "Region " + str(label) + " with " + str(len(regions[label])) + " users took " +
+                        "%.3f" % seconds + " s for " + str(len(cellsites_for_cluster)) + " cell sites"
+                    )
+        finally:
+            if blas_limiter is not None:
+                blas_limiter.restore_original_limits()
 
+        self.cell_sites = {label: cell_sites[label] for label in regions.keys()}
         return self.cell_sites
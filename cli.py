@@ -1,38 +1,342 @@
+import os
+import json
 import click
-from towersdistributor import TowersDistributor
+from service import DEFAULT_URL, JOBS, PATH_PARAMETERS, ServiceClient
 
-@click.command()
+# the pipeline is imported by the stages that run it, a client of the service never loads it
+# and a headless job never loads the map
+
+def echo_result(result):
+    if result is not None and "coverage" in result:
+        click.echo("coverage " + str(result["coverage"]) + " %, " + str(result["cell_sites"]) + " cell sites")
+
+def run_on_service(url, job_type, parameters, path_parameters):
+    '''
+    Runs a job on the planning service when one is running, echoing its progress
+    :param path_parameters: names of the parameters that are paths, made absolute for the service
+    :return: False when no service answers at url
+    '''
+    client = ServiceClient(url)
+    if not client.available():
+        return False
+
+    parameters = dict(parameters)
+    for name in path_parameters:
+        if parameters.get(name) is not None:
+            parameters[name] = os.path.abspath(parameters[name])
+    log = parameters.get("log", True)
+    # the map is opened by the browser of this shell, not of the service
+    display = parameters.get("display", False)
+    if display:
+        parameters["display"] = False
+
+    def on_event(event):
+        if log and event["event"] == "log":
+            click.echo("%8.3f %s %s" % (event["time"], event["logger"], event["message"]))
+
+    click.echo("Running " + job_type + " on the planning service at " + url)
+    try:
+        result = client.run(job_type, parameters, on_event=on_event)
+    except (RuntimeError, ValueError) as error:
+        raise click.ClickException(str(error))
+    echo_result(result)
+    if display:
+        from towersdistributor import open_in_browser
+        open_in_browser(parameters["output_map_html_file"])
+    return True
+
+def run_job(job_type, parameters, url=DEFAULT_URL, local=False):
+    '''
+    Runs a job on the planning service when one is running, else in this process
+    :param local: run in this process even when the service is running
+    '''
+    if not local and run_on_service(url, job_type, parameters, PATH_PARAMETERS[job_type]):
+        return
+    echo_result(JOBS[job_type](**parameters))
+
+class DefaultGroup(click.Group):
+    '''
+    Group that runs its default command when the first argument names no command, so
+    the former single command invocation cli.py DATASET OUTPUT_JSON_FILE OUTPUT_MAP_HTML_FILE
+    keeps working as cli.py distribute DATASET OUTPUT_JSON_FILE OUTPUT_MAP_HTML_FILE
+    '''
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in self.get_help_option_names(ctx):
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+@click.group(cls=DefaultGroup, default_command="distribute")
+def cli():
+    '''
+    Towers Distributor command line interface. distribute runs the whole pipeline and
+    is the default command, cluster, optimize, evaluate and render run one step of it
+    on saved distributions.
+    '''
+
+@cli.command("distribute")
 @click.argument("dataset", nargs=1, required=True)
 @click.argument("output_json_file", nargs=1, required=True)
-@click.argument("output_map_html_file", nargs=1, required=True)
+@click.argument("output_map_html_file", nargs=1, required=False)
 @click.option("-rr", "--radiation_range", default=1000, help="radiation range of cell site(in metres)")
 @click.option("-mt", "--min_towers", default=5, help="minimum towers to be considered as a region")
 @click.option("-mg", "--min_gap", default=400, help="minimum distance between towers(in metres) to not be clubbed")
+@click.option("-af", "--affinity", default="dense", type=click.Choice(["dense", "sparse"]), help="affinity matrix used for region clustering")
+@click.option("-es", "--eigen_solver", default="dense", type=click.Choice(["dense", "arpack", "lobpcg"]), help="eigen solver for the eigengap heuristic")
+@click.option("-en", "--engine", default="spectral", type=click.Choice(["spectral", "landmark"]), help="region detection engine, landmark scales to millions of users")
+@click.option("-lm", "--landmarks", default=500, help="no of landmarks for the landmark engine")
+@click.option("-pj", "--projection", default=None, type=click.Choice(["equirectangular"]), help="cluster in a local metric plane instead of degrees")
+@click.option("-ex", "--executor", default="thread", type=click.Choice(["thread", "process"]), help="executor for per region cell site clustering")
+@click.option("-w", "--workers", default=None, type=int, help="no of cell site clustering workers, defaults to the cpu count")
+@click.option("-s", "--search", default="linear", type=click.Choice(["linear", "gallop"]), help="search strategy for the no of cell sites per region, gallop needs fewer fits but may pick a different no of cell sites")
+@click.option("-mb", "--minibatch_threshold", default=None, type=int, help="regions with atleast these many users use MiniBatchKMeans")
+@click.option("-dd", "--dedup", is_flag=True, help="remove cell sites closer than min_gap across region borders too")
+@click.option("-rp", "--report", default=None, help="file to save the coverage report as JSON")
+@click.option("-of", "--output_format", default="json", type=click.Choice(["json", "binary"]), help="output format, binary writes a memory-mappable directory instead of the JSON file")
+@click.option("-st", "--stream", is_flag=True, help="out of core mode, clusters the dataset one geographic bucket at a time")
+@click.option("-bs", "--bucket_size", default=10000, help="side of a streaming bucket(in metres)")
+@click.option("-pt", "--partition", is_flag=True, help="plans geographic tiles with an overlap halo in parallel and stitches them")
+@click.option("-ts", "--tile_size", default=20000, help="side of a partition tile(in metres)")
+@click.option("-hl", "--halo", default=None, type=int, help="overlap around a partition tile(in metres), defaults to the radiation range")
+@click.option("-cd", "--cache_directory", default=None, help="directory of the stage cache, reuses unchanged stages across runs")
+@click.option("-cs", "--cache_size", default=1024, help="max size of the stage cache(in MB)")
+@click.option("-mm", "--map_mode", default="auto", type=click.Choice(["auto", "detailed", "large"]), help="large draws users as one layer and cell sites as GeoJSON, auto picks it for big datasets")
+@click.option("-pb", "--point_budget", default=50000, help="max users drawn on a large map, more are downsampled")
+@click.option("-ul", "--user_layer", default="heatmap", type=click.Choice(["heatmap", "cluster"]), help="user layer of the large map")
+@click.option("-tl", "--tiles", default=None, help="directory to export a PNG tile pyramid with a static viewer to")
+@click.option("-tz", "--tile_max_zoom", default=15, help="deepest zoom level of the tile pyramid")
+@click.option("-pf", "--profile", default=None, help="directory to write a JSON and a Chrome trace of the stages to")
+@click.option("-ps", "--profile_stage", default=None, type=click.Choice(["ingest", "projection", "settlement_clustering", "cellsite_clustering", "format", "optimization", "serialization", "map_rendering", "tile_export", "evaluation"]), help="stage to run under cProfile, needs --profile")
+@click.option("-nm", "--no_map", is_flag=True, help="headless run for batch jobs, saves the distribution and report without drawing a map")
+@click.option("-nd", "--no_display", is_flag=True, help="save the map without opening it in the browser")
+@click.option("-sv", "--service", default=DEFAULT_URL, help="url of the planning service, used when it is running")
+@click.option("-lc", "--local", is_flag=True, help="run in this process even when the planning service is running")
 @click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
-def distribute_towers(dataset, output_json_file, output_map_html_file, radiation_range, min_towers, min_gap, log):
+def distribute_towers(dataset, output_json_file, output_map_html_file, radiation_range, min_towers, min_gap,
+                      affinity, eigen_solver, engine, landmarks, projection, executor, workers, search, minibatch_threshold,
+                      dedup, report, output_format, stream, bucket_size, partition, tile_size, halo, cache_directory,
+                      cache_size, map_mode, point_budget, user_layer, tiles, tile_max_zoom, profile, profile_stage,
+                      no_map, no_display, service, local, log):
     '''
     Distributes 5G cell sites and base stations using Spectral & K-Means clustering.
     Further enhanced using custom optimization techniques.
     '''
-    if radiation_range < 0:
-        raise ValueError("radiation range cannot be negative")
-    if min_towers < 0:
-        raise ValueError("min no of towers per cluster cannot be negative")
-    if min_gap < 0:
-        raise ValueError("min gap between cell sites cannot be negative")
+    if output_map_html_file is None and not no_map:
+        raise click.UsageError("OUTPUT_MAP_HTML_FILE is required unless --no_map is given")
+    if stream and partition:
+        raise click.UsageError("--stream and --partition cannot be combined")
+
+    parameters = dict(
+        dataset=dataset, output_json_file=output_json_file, output_map_html_file=output_map_html_file,
+        radiation_range=radiation_range, min_towers=min_towers, min_gap=min_gap, affinity=affinity,
+        eigen_solver=eigen_solver, engine=engine, landmarks=landmarks, projection=projection, executor=executor,
+        workers=workers, search=search, minibatch_threshold=minibatch_threshold, dedup=dedup, report=report,
+        output_format=output_format, stream=stream, bucket_size=bucket_size, partition=partition,
+        tile_size=tile_size, halo=halo, cache_directory=cache_directory, cache_size=cache_size, map_mode=map_mode,
+        point_budget=point_budget, user_layer=user_layer, tiles=tiles, tile_max_zoom=tile_max_zoom,
+        profile=profile, profile_stage=profile_stage, no_map=no_map, display=not (no_map or no_display), log=log
+    )
+    # a profile is of this process, it never goes to the service
+    run_job("plan", parameters, url=service, local=local or profile is not None)
+
+@cli.command("cluster")
+@click.argument("dataset", nargs=1, required=True)
+@click.argument("output_json_file", nargs=1, required=True)
+@click.option("-rr", "--radiation_range", default=1000, help="radiation range of cell site(in metres)")
+@click.option("-af", "--affinity", default="dense", type=click.Choice(["dense", "sparse"]), help="affinity matrix used for region clustering")
+@click.option("-es", "--eigen_solver", default="dense", type=click.Choice(["dense", "arpack", "lobpcg"]), help="eigen solver for the eigengap heuristic")
+@click.option("-en", "--engine", default="spectral", type=click.Choice(["spectral", "landmark"]), help="region detection engine, landmark scales to millions of users")
+@click.option("-lm", "--landmarks", default=500, help="no of landmarks for the landmark engine")
+@click.option("-pj", "--projection", default=None, type=click.Choice(["equirectangular"]), help="cluster in a local metric plane instead of degrees")
+@click.option("-ex", "--executor", default="thread", type=click.Choice(["thread", "process"]), help="executor for per region cell site clustering")
+@click.option("-w", "--workers", default=None, type=int, help="no of cell site clustering workers, defaults to the cpu count")
+@click.option("-s", "--search", default="linear", type=click.Choice(["linear", "gallop"]), help="search strategy for the no of cell sites per region, gallop needs fewer fits but may pick a different no of cell sites")
+@click.option("-mb", "--minibatch_threshold", default=None, type=int, help="regions with atleast these many users use MiniBatchKMeans")
+@click.option("-rp", "--report", default=None, help="file to save the coverage report as JSON")
+@click.option("-of", "--output_format", default="json", type=click.Choice(["json", "binary"]), help="output format, binary writes a memory-mappable directory instead of the JSON file")
+@click.option("-cd", "--cache_directory", default=None, help="directory of the stage cache, reuses unchanged stages across runs")
+@click.option("-cs", "--cache_size", default=1024, help="max size of the stage cache(in MB)")
+@click.option("-sv", "--service", default=DEFAULT_URL, help="url of the planning service, used when it is running")
+@click.option("-lc", "--local", is_flag=True, help="run in this process even when the planning service is running")
+@click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
+def cluster_towers(dataset, output_json_file, radiation_range, affinity, eigen_solver, engine, landmarks, projection,
+                   executor, workers, search, minibatch_threshold, report, output_format, cache_directory, cache_size,
+                   service, local, log):
+    '''
+    Clusters the users into regions and cell sites and saves the distribution before
+    optimization. Only sklearn and scipy are loaded, the map modules never are.
+    '''
+    parameters = dict(
+        dataset=dataset, output_json_file=output_json_file, radiation_range=radiation_range, affinity=affinity,
+        eigen_solver=eigen_solver, engine=engine, landmarks=landmarks, projection=projection, executor=executor,
+        workers=workers, search=search, minibatch_threshold=minibatch_threshold, report=report,
+        output_format=output_format, cache_directory=cache_directory, cache_size=cache_size, log=log
+    )
+    run_job("cluster", parameters, url=service, local=local)
+
+@cli.command("optimize")
+@click.argument("distribution", nargs=1, required=True)
+@click.argument("output_json_file", nargs=1, required=True)
+@click.option("-mt", "--min_towers", default=None, type=int, help="minimum towers to be considered as a region, defaults to the saved one else 5")
+@click.option("-mg", "--min_gap", default=None, type=int, help="minimum distance between towers(in metres), defaults to the saved one else 400")
+@click.option("-dd", "--dedup", is_flag=True, help="remove cell sites closer than min_gap across region borders too")
+@click.option("-rp", "--report", default=None, help="file to save the coverage report as JSON")
+@click.option("-of", "--output_format", default="json", type=click.Choice(["json", "binary"]), help="output format, binary writes a memory-mappable directory instead of the JSON file")
+@click.option("-sv", "--service", default=DEFAULT_URL, help="url of the planning service, used when it is running")
+@click.option("-lc", "--local", is_flag=True, help="run in this process even when the planning service is running")
+@click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
+def optimize_towers(distribution, output_json_file, min_towers, min_gap, dedup, report, output_format, service,
+                    local, log):
+    '''
+    Merges the small regions and the close cell sites of a saved tower distribution.
+    '''
+    parameters = dict(
+        distribution=distribution, output_json_file=output_json_file, min_towers=min_towers, min_gap=min_gap,
+        dedup=dedup, report=report, output_format=output_format, log=log
+    )
+    run_job("optimize", parameters, url=service, local=local)
+
+@cli.command("evaluate")
+@click.argument("distribution", nargs=1, required=True)
+@click.option("-rr", "--radiation_range", default=None, type=int, help="radiation range of cell site(in metres), defaults to the saved one")
+@click.option("-rp", "--report", default=None, help="file to save the coverage report as JSON")
+@click.option("-sv", "--service", default=DEFAULT_URL, help="url of the planning service, used when it is running")
+@click.option("-lc", "--local", is_flag=True, help="run in this process even when the planning service is running")
+@click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
+def evaluate_towers(distribution, radiation_range, report, service, local, log):
+    '''
+    Reports the coverage of a saved tower distribution.
+    '''
+    parameters = dict(distribution=distribution, radiation_range=radiation_range, report=report, log=log)
+    run_job("evaluate", parameters, url=service, local=local)
+
+@cli.command("render")
+@click.argument("distribution", nargs=1, required=True)
+@click.argument("output_map_html_file", nargs=1, required=True)
+@click.option("-mm", "--map_mode", default="auto", type=click.Choice(["auto", "detailed", "large"]), help="large draws users as one layer and cell sites as GeoJSON, auto picks it for big datasets")
+@click.option("-pb", "--point_budget", default=50000, help="max users drawn on a large map, more are downsampled")
+@click.option("-ul", "--user_layer", default="heatmap", type=click.Choice(["heatmap", "cluster"]), help="user layer of the large map")
+@click.option("-tl", "--tiles", default=None, help="directory to export a PNG tile pyramid with a static viewer to")
+@click.option("-tz", "--tile_max_zoom", default=15, help="deepest zoom level of the tile pyramid")
+@click.option("-w", "--workers", default=None, type=int, help="no of tile rendering processes, defaults to the cpu count")
+@click.option("-nd", "--no_display", is_flag=True, help="save the map without opening it in the browser")
+@click.option("-sv", "--service", default=DEFAULT_URL, help="url of the planning service, used when it is running")
+@click.option("-lc", "--local", is_flag=True, help="run in this process even when the planning service is running")
+@click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
+def render_towers(distribution, output_map_html_file, map_mode, point_budget, user_layer, tiles, tile_max_zoom,
+                  workers, no_display, service, local, log):
+    '''
+    Draws the map, and optionally the tile pyramid, of a saved tower distribution.
+    '''
+    parameters = dict(
+        distribution=distribution, output_map_html_file=output_map_html_file, map_mode=map_mode,
+        point_budget=point_budget, user_layer=user_layer, tiles=tiles, tile_max_zoom=tile_max_zoom,
+        workers=workers, display=not no_display, log=log
+    )
+    run_job("render", parameters, url=service, local=local)
+
+@cli.command("update")
+@click.argument("distribution", nargs=1, required=True)
+@click.argument("new_users", nargs=1, required=True)
+@click.argument("output_json_file", nargs=1, required=True)
+@click.option("-rr", "--radiation_range", default=None, type=int, help="radiation range of cell site(in metres), defaults to the saved one")
+@click.option("-mt", "--min_towers", default=None, type=int, help="minimum towers to be considered as a region, defaults to the saved one")
+@click.option("-mg", "--min_gap", default=None, type=int, help="minimum distance between towers(in metres), defaults to the saved one")
+@click.option("-s", "--search", default="linear", type=click.Choice(["linear", "gallop"]), help="search strategy for the no of cell sites per region, gallop needs fewer fits but may pick a different no of cell sites")
+@click.option("-rp", "--report", default=None, help="file to save the coverage report of the touched regions as JSON")
+@click.option("-of", "--output_format", default="json", type=click.Choice(["json", "binary"]), help="output format, binary writes a memory-mappable directory instead of the JSON file")
+@click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
+def update_towers(distribution, new_users, output_json_file, radiation_range, min_towers, min_gap,
+                  search, report, output_format, log):
+    '''
+    Adds the users of a new dataset to a saved tower distribution, reclustering
+    only the regions they push past the permissible distortion.
+    '''
+    from towersdistributor import TowersDistributor
+
+    distributor = TowersDistributor.from_distribution(distribution, enable_logger=log)
+    distributor.update(
+        new_users, radiation_range=radiation_range, min_towers=min_towers,
+        min_cell_site_distance=min_gap, search=search
+    )
+    distributor.serialize_and_save_data(output_json_file, output_format=output_format)
+
+    if report is not None:
+        with open(report, "w") as report_file:
+            json.dump(distributor.evaluation, report_file)
+
+@cli.command("sweep")
+@click.argument("dataset", nargs=1, required=True)
+@click.argument("results_file", nargs=1, required=True)
+@click.option("-rr", "--radiation_range", multiple=True, default=[1000], type=int, help="radiation range of cell site(in metres), repeat for a grid")
+@click.option("-mt", "--min_towers", multiple=True, default=[5], type=int, help="minimum towers to be considered as a region, repeat for a grid")
+@click.option("-mg", "--min_gap", multiple=True, default=[400], type=int, help="minimum distance between towers(in metres), repeat for a grid")
+@click.option("-af", "--affinity", default="dense", type=click.Choice(["dense", "sparse"]), help="affinity matrix used for region clustering")
+@click.option("-es", "--eigen_solver", default="dense", type=click.Choice(["dense", "arpack", "lobpcg"]), help="eigen solver for the eigengap heuristic")
+@click.option("-en", "--engine", default="spectral", type=click.Choice(["spectral", "landmark"]), help="region detection engine, landmark scales to millions of users")
+@click.option("-lm", "--landmarks", default=500, help="no of landmarks for the landmark engine")
+@click.option("-pj", "--projection", default=None, type=click.Choice(["equirectangular"]), help="cluster in a local metric plane instead of degrees")
+@click.option("-w", "--workers", default=None, type=int, help="no of sweep processes, defaults to the cpu count")
+@click.option("-s", "--search", default="linear", type=click.Choice(["linear", "gallop"]), help="search strategy for the no of cell sites per region, gallop needs fewer fits but may pick a different no of cell sites")
+@click.option("-mb", "--minibatch_threshold", default=None, type=int, help="regions with atleast these many users use MiniBatchKMeans")
+@click.option("-dd", "--dedup", is_flag=True, help="remove cell sites closer than min_gap across region borders too")
+@click.option("-cd", "--cache_directory", default=None, help="directory of the stage cache, reuses the region clustering across runs")
+@click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
+def sweep_parameters(dataset, results_file, radiation_range, min_towers, min_gap, affinity, eigen_solver, engine,
+                     landmarks, projection, workers, search, minibatch_threshold, dedup, cache_directory, log):
+    '''
+    Runs every combination of the radiation range, min towers and min gap grids
+    and writes users, cell sites, coverage and runtime per configuration.
+    '''
+    from towersdistributor import TowersDistributor
+    from stagecache import StageCache
+    from sweep import ParameterSweep
 
-    distributor = TowersDistributor(dataset, enable_logger=log)
+    stage_cache = StageCache(cache_directory) if cache_directory is not None else None
+    distributor = TowersDistributor(dataset, enable_logger=log, stage_cache=stage_cache, projection=projection)
 
-    distributor.perform_settlement_clustering()
-    distributor.perform_cellsite_clustering(radiation_range=radiation_range)
+    parameter_sweep = ParameterSweep(distributor, workers=workers)
+    rows = parameter_sweep.run(
+        radiation_range, min_towers, min_gap,
+        settlement_clustering=dict(affinity=affinity, eigen_solver=eigen_solver, engine=engine, n_landmarks=landmarks),
+        search=search, minibatch_threshold=minibatch_threshold, deduplicate=dedup
+    )
+    parameter_sweep.save(results_file)
 
-    distributor.format()
-    distributor.optimize(min_towers=min_towers, min_cell_site_distance=min_gap)
+    click.echo("\t".join(ParameterSweep.COLUMNS))
+    for row in rows:
+        click.echo("\t".join(
+            "%.3f" % row[column] if isinstance(row[column], float) else str(row[column])
+            for column in ParameterSweep.COLUMNS
+        ))
 
-    distributor.serialize_and_save_data(output_json_file)
-    distributor.make_and_display_map(output_map_html_file)
+@cli.command("serve")
+@click.option("-H", "--host", default="127.0.0.1", help="loopback address to listen on")
+@click.option("-p", "--port", default=8765, help="port to listen on")
+@click.option("-w", "--workers", default=2, help="no of jobs run at the same time")
+@click.option("-cs", "--cache_size", default=1024, help="max size of the in memory stage cache(in MB)")
+@click.option("-md", "--max_datasets", default=4, help="no of datasets kept in memory")
+@click.option("-rd", "--root_directory", default=".", help="directory the jobs may read and write in")
+@click.option("-l/-dl", "--log/--disable_logs", default=True, help="To disable logging the execution")
+def serve_planning(host, port, workers, cache_size, max_datasets, root_directory, log):
+    '''
+    Runs the planning service, which keeps the pipeline, the datasets and the stage
+    results warm for the distribute commands of other shells. Jobs may only read and
+    write inside the root directory.
+    '''
+    from service import serve, is_loopback
 
-    distributor.evaluate()
+    if not is_loopback(host):
+        raise click.BadParameter("the service has no authentication, use a loopback address", param_hint="--host")
+    if not os.path.isdir(root_directory):
+        raise click.BadParameter(root_directory + " is not a directory", param_hint="--root_directory")
+    serve(
+        host=host, port=port, workers=workers, cache_size=cache_size, max_datasets=max_datasets,
+        root_directory=root_directory, log=log
+    )
 
 if __name__ == "__main__":
-    distribute_towers()
\ No newline at end of file
+    cli()
\ No newline at end of file
@@ -1,46 +1,225 @@
-import csv
-import sys
+'''
+Synthetic user dataset generator. Users are scattered around the hotspots of
+datasets/hotspots.csv, optionally weighted by a third column, following a uniform,
+gaussian or power law density profile. The output is written one chunk at a time by
+a process pool, as CSV or as a memory-mappable .npy file, so memory stays constant
+whatever the size, and a given seed and chunk size always produce the same dataset.
+
+USAGE: python3 datagen.py [OPTIONS] SIZE [OUTPUT]
+'''
+import os
+import time
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import click
 import numpy as np
-import matplotlib.pyplot as plt
+from numpy.lib.format import open_memmap
+from datahandler import DatasetReader
+
+PROFILES = ("uniform", "gaussian", "powerlaw")
+# metres of spread per profile: half width of the box, standard deviation and scale radius
+DEFAULT_SPREAD = {"uniform": 2000, "gaussian": 1000, "powerlaw": 300}
+# power law users farther than this many scale radii are redrawn closer
+MAX_SCALE_RADII = 50
 
 def read_hotspots(hotspots_filepath):
-    with open(hotspots_filepath) as hotspots_datafile:
-        datapoint_reader = csv.reader(hotspots_datafile)
-        hotspots = [list(map(float, datapoint)) for datapoint in datapoint_reader]
+    '''
+    Reads the latitude, longitude[, weight] rows of the hotspots file
+    :return: hotspots array, weights array or None when there is no weight column
+    '''
+    with open(hotspots_filepath) as hotspots_file:
+        first_row = next((line for line in hotspots_file if line.strip()), "")
+    columns = max(2, first_row.count(",") + 1)
+    hotspots = DatasetReader(cache=False, columns=columns).read(hotspots_filepath)
+
+    if columns > 2:
+        return hotspots[:, :2], hotspots[:, 2]
+    return hotspots, None
+
+def hotspot_counts(n_hotspots, required_size, weights=None):
+    '''
+    Splits the users among the hotspots in proportion to their weights, handing
+    the rounding remainder to the largest fractions so that the counts add up exactly
+    :return: array of users per hotspot
+    '''
+    if weights is None:
+        weights = np.ones(n_hotspots)
+    weights = np.asarray(weights, dtype=float)
+    if len(weights) != n_hotspots:
+        raise ValueError("there must be one weight per hotspot")
+    if (weights < 0).any() or not weights.sum() > 0:
+        raise ValueError("hotspot weights must be non negative and not all zero")
+
+    shares = weights / weights.sum() * required_size
+    counts = np.floor(shares).astype(np.int64)
+    remainder = required_size - counts.sum()
+    counts[np.argsort(counts - shares, kind="stable")[:remainder]] += 1
+    return counts
+
+def draw_offsets(rng, n_users, profile, spread, alpha):
+    '''
+    Draws the offsets of n_users from their hotspot in one vectorized call
+    :param spread: size of the profile(in metres), see DEFAULT_SPREAD
+    :param alpha: tail exponent of the power law profile, smaller is heavier
+    :return: array of n_users x (latitude, longitude) offsets in degrees
+    '''
+    if profile == "uniform":
+        # the original generator: a box of 10 metre steps
+        steps = int(round(spread / 10))
+        return 0.0001 * rng.integers(-steps, steps, size=(n_users, 2))
+    if profile == "gaussian":
+        return rng.normal(0, spread / 10 ** 5, size=(n_users, 2))
+
+    radius = rng.pareto(alpha, size=n_users)
+    far = radius > MAX_SCALE_RADII
+    while far.any():
+        radius[far] = rng.pareto(alpha, size=far.sum())
+        far = radius > MAX_SCALE_RADII
+    angle = rng.uniform(0, 2 * np.pi, size=n_users)
+    return (radius * spread / 10 ** 5)[:, None] * np.column_stack((np.cos(angle), np.sin(angle)))
+
+def generate_chunk(hotspots, bounds, start, end, profile, spread, alpha, rng):
+    '''
+    Generates the users start to end of the dataset, users being laid out hotspot by hotspot
+    :param bounds: first user of every hotspot followed by the dataset size
+    :return: array of users x (latitude, longitude)
+    '''
+    hotspot_ids = np.searchsorted(bounds, np.arange(start, end), side="right") - 1
+    return hotspots[hotspot_ids] + draw_offsets(rng, end - start, profile, spread, alpha)
 
-    return hotspots
+def generate_dataset(hotspots, required_size=1000, weights=None, profile="uniform", spread=None, alpha=1.5, seed=0):
+    '''
+    Generates the whole dataset in memory, see write_dataset_chunks for large datasets
+    :param weights: relative no of users per hotspot, equal by default
+    :param profile: density of users around a hotspot, one of PROFILES
+    :param spread: size of the profile(in metres), DEFAULT_SPREAD by default
+    :param seed: seed of the numpy random generator
+    :return: array of users x (latitude, longitude)
+    '''
+    if profile not in PROFILES:
+        raise ValueError("profile must be one of " + ", ".join(PROFILES))
+    hotspots = np.asarray(hotspots, dtype=float)
+    counts = hotspot_counts(len(hotspots), required_size, weights)
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    spread = DEFAULT_SPREAD[profile] if spread is None else spread
 
-def generate_dataset(hotspots, required_size=1000):
-    users_distance = (-200, 200)
-    dataset = []
-    for hotspot in hotspots:
-        user_per_hotspot = required_size // len(hotspots)
-        # customer_per_hotspot = itertools.cycle([2, 5, 3, 2, 1000])
-        for user in range(user_per_hotspot):
-            x = hotspot[0] + (0.0001 * np.random.randint(*users_distance))
-            y = hotspot[1] + (0.0001 * np.random.randint(*users_distance))
-            dataset.append([x, y])
+    return generate_chunk(
+        hotspots, bounds, 0, required_size, profile, spread, alpha, np.random.default_rng(seed)
+    )
 
-    return dataset
+def format_rows(dataset):
+    # one printf over the whole chunk is far faster than a csv writer row by row
+    return (("%.6f,%.6f\n" * len(dataset)) % tuple(np.asarray(dataset).ravel())).encode()
 
 def write_dataset(dataset, dataset_filepath):
-    with open(dataset_filepath, "w") as users_datafile:
-        datapoint_writer = csv.writer(users_datafile, delimiter=",")
-        for datapoint in dataset:
-            datapoint_writer.writerow(datapoint)
+    with open(dataset_filepath, "wb") as users_datafile:
+        users_datafile.write(format_rows(dataset))
+
+def chunk_task(task):
+    '''
+    Generates one chunk in a worker process. Every chunk has its own child of the
+    seed sequence so that the dataset does not depend on the no of workers.
+    :return: CSV bytes of the chunk, or the no of users written into the .npy file
+    '''
+    hotspots, bounds, chunk, start, end, profile, spread, alpha, seed, binary_filepath = task
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk,)))
+    users = generate_chunk(hotspots, bounds, start, end, profile, spread, alpha, rng)
+
+    if binary_filepath is None:
+        return format_rows(users)
+    dataset = np.load(binary_filepath, mmap_mode="r+")
+    dataset[start:end] = users
+    dataset.flush()
+    return end - start
+
+def write_dataset_chunks(hotspots, dataset_filepath, required_size, weights=None, profile="uniform", spread=None,
+                         alpha=1.5, seed=0, chunk_size=10 ** 6, workers=None, output_format=None):
+    '''
+    Generates and writes the dataset one chunk at a time across a process pool.
+    CSV chunks are appended in order as they complete, with at most two chunks per
+    worker in flight, and binary chunks are written in place into a preallocated .npy file.
+    :param chunk_size: no of users generated per task
+    :param workers: no of processes, defaults to the cpu count
+    :param output_format: csv or binary, binary only for .npy files by default
+    :return: no of users written
+    '''
+    if profile not in PROFILES:
+        raise ValueError("profile must be one of " + ", ".join(PROFILES))
+    if chunk_size < 1:
+        raise ValueError("chunk size must be atleast 1")
+    if output_format is None:
+        output_format = "binary" if DatasetReader.is_binary(dataset_filepath) else "csv"
+    hotspots = np.asarray(hotspots, dtype=float)
+    counts = hotspot_counts(len(hotspots), required_size, weights)
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    spread = DEFAULT_SPREAD[profile] if spread is None else spread
+    workers = workers or os.cpu_count() or 1
+
+    binary_filepath = None
+    if output_format == "binary":
+        binary_filepath = dataset_filepath
+        # allocates the file up front, the workers then fill in their own rows
+        open_memmap(binary_filepath, mode="w+", dtype=float, shape=(required_size, 2))
+
+    tasks = (
+        (hotspots, bounds, chunk, start, min(start + chunk_size, required_size), profile, spread, alpha, seed, binary_filepath)
+        for chunk, start in enumerate(range(0, required_size, chunk_size))
+    )
+    dataset_file = open(dataset_filepath, "wb") if binary_filepath is None else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            in_flight = collections.deque()
+            for task in tasks:
+                in_flight.append(pool.submit(chunk_task, task))
+                if len(in_flight) >= 2 * workers:
+                    result = in_flight.popleft().result()
+                    if dataset_file is not None:
+                        dataset_file.write(result)
+            while in_flight:
+                result = in_flight.popleft().result()
+                if dataset_file is not None:
+                    dataset_file.write(result)
+    finally:
+        if dataset_file is not None:
+            dataset_file.close()
+    return required_size
 
 def visualise_dataset(dataset):
+    # only here, so that the generator workers never import pyplot
+    import matplotlib.pyplot as plt
+
     X = np.array([datapoint[0] for datapoint in dataset])
     Y = np.array([datapoint[1] for datapoint in dataset])
     plt.scatter(X, Y, marker=".")
     plt.show()
 
+@click.command()
+@click.argument("size", type=int)
+@click.argument("output", required=False, default=None)
+@click.option("-hs", "--hotspots", default="datasets/hotspots.csv", help="latitude, longitude[, weight] rows of the hotspots")
+@click.option("-p", "--profile", default="uniform", type=click.Choice(PROFILES), help="density of users around a hotspot, uniform is the original box of +-0.02 degrees")
+@click.option("-sp", "--spread", default=None, type=float, help="size of the profile(in metres): half width, standard deviation or scale radius")
+@click.option("-a", "--alpha", default=1.5, help="tail exponent of the power law profile")
+@click.option("-sd", "--seed", default=0, help="seed of the random generator")
+@click.option("-cs", "--chunk_size", default=10 ** 6, help="no of users generated per task")
+@click.option("-w", "--workers", default=None, type=int, help="no of generator processes, defaults to the cpu count")
+@click.option("-of", "--output_format", default=None, type=click.Choice(["csv", "binary"]), help="output format, binary writes a memory-mappable .npy file (default: binary only for .npy files)")
+def datagen(size, output, hotspots, profile, spread, alpha, seed, chunk_size, workers, output_format):
+    '''
+    Generates a synthetic dataset of SIZE users, datasets/datasetSIZE.csv by default
+    '''
+    if size < 0:
+        raise ValueError("dataset size cannot be negative")
+    output = output or "datasets/dataset%s.csv" % size
+    hotspots, weights = read_hotspots(hotspots)
+
+    start = time.time()
+    write_dataset_chunks(
+        hotspots, output, size, weights=weights, profile=profile, spread=spread, alpha=alpha, seed=seed,
+        chunk_size=chunk_size, workers=workers, output_format=output_format
+    )
+    click.echo("%d users written to %s in %.2f s" % (size, output, time.time() - start))
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print('USAGE: python3 datagen.py SIZE')
-    else:
-        size = int(sys.argv[1])
-        hotspots = read_hotspots("datasets/hotspots.csv")
-        dataset = generate_dataset(hotspots, required_size=size)
-        write_dataset(dataset, "datasets/dataset%s.csv" % size)
-        # visualise_dataset(dataset)
+    datagen()
@@ -1,12 +1,20 @@
+import os
+import glob
 import json
+import time
 import numpy as np
+from towerdistribution import TowerDistribution
 
 class Serializer:
     '''
     Serializes the tower distribution data structure to write to files
     '''
-    def __init__(self, tower_distribution):
+    ARRAYS = ("users", "user_region", "cell_sites", "cell_site_region", "base_stations")
+    MANIFEST = "manifest.json"
+
+    def __init__(self, tower_distribution, metadata=None):
         self.tower_distribution = tower_distribution
+        self.metadata = metadata or dict()
 
     def serialize(self):
         self.stringified_structure = dict()
@@ -14,7 +22,7 @@ class Serializer:
             self.stringified_structure[key] = {
                 'base_station': str(region['base_station']),
                 'users': "[" + ",".join([str(user) for user in region['users']]) + "]",
-                # 'cell_sites': "[" + ",".join([str(cell_site) for cell_site in region['cell_sites']]) + "]",
+                'cell_sites': "[" + ",".join([str(cell_site) for cell_site in region['cell_sites']]) + "]",
             }
         return self.stringified_structure
 
@@ -23,6 +31,36 @@ class Serializer:
         with open(filename, "w") as output_file:
             output_file.write(writeable_structure)
 
+    def save_arrays(self, directory):
+        '''
+        Saves the distribution in the binary columnar format: one raw .npy file per
+        array plus a small JSON manifest, so that Deserializer can memory-map it
+        :param directory: output directory, created if missing
+        '''
+        tower_distribution = self.tower_distribution
+        if not isinstance(tower_distribution, TowerDistribution):
+            tower_distribution = TowerDistribution.from_dict(tower_distribution)
+        tower_distribution = tower_distribution.compacted()
+        # users are saved ordered by region, so that an update finds them by binary search
+        order = np.argsort(tower_distribution.user_region, kind="stable")
+        arrays = dict((name, getattr(tower_distribution, name)) for name in self.ARRAYS)
+        arrays["users"], arrays["user_region"] = arrays["users"][order], arrays["user_region"][order]
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        manifest = {
+            "format": "towersdistributor", "version": 1, "arrays": dict(), "metadata": self.metadata,
+            "grouped_users": len(order)
+        }
+        for name in self.ARRAYS:
+            array = np.ascontiguousarray(arrays[name])
+            np.save(os.path.join(directory, name + ".npy"), array)
+            manifest["arrays"][name] = {"file": name + ".npy", "dtype": str(array.dtype), "shape": list(array.shape)}
+
+        with open(os.path.join(directory, self.MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
 class Deserializer:
     '''
     Deserializes the tower distribution stringified data structure
@@ -35,7 +73,7 @@ class Deserializer:
         for key, region in self.stringified_structure.items():
             base_station = np.fromstring(
                 region['base_station'].replace("[", "").replace("]", ""),
-                dtype=np.float,
+                dtype=float,
                 sep=" "
             )
 
@@ -43,7 +81,7 @@ class Deserializer:
                 [
                     np.fromstring(
                         user.replace("[", "").replace("]", ""),
-                        dtype=np.float,
+                        dtype=float,
                         sep=" "
                     )
                     for user in region['users'].split(",")
@@ -54,10 +92,10 @@ class Deserializer:
                 [
                     np.fromstring(
                         cell_site.replace("[", "").replace("]", ""),
-                        dtype=np.float,
+                        dtype=float,
                         sep=" "
                     )
-                    for cell_site in region['cell_sites'].split(",")
+                    for cell_site in region.get('cell_sites', "[]").split(",")
                 ]
             )
 
@@ -73,6 +111,153 @@ class Deserializer:
         with open(filename) as output_file:
             self.stringified_structure = json.load(output_file)
 
+    def load_arrays(self, directory, mmap=True):
+        '''
+        Opens a distribution saved by Serializer.save_arrays. The user and cell site
+        arrays are memory-mapped read only, so even a 1M user result opens instantly.
+        :param directory: directory holding the manifest and the .npy arrays
+        :param mmap: memory-map the large arrays instead of reading them
+        :return: TowerDistribution
+        '''
+        with open(os.path.join(directory, Serializer.MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("format") != "towersdistributor":
+            raise ValueError(directory + " is not a tower distribution")
+
+        self.metadata = manifest.get("metadata", dict())
+        arrays = {
+            name: np.load(os.path.join(directory, entry["file"]), mmap_mode="r" if mmap else None)
+            for name, entry in manifest["arrays"].items()
+        }
+        self.tower_distribution = TowerDistribution(**arrays)
+        self.tower_distribution.grouped_users = manifest.get("grouped_users", 0)
+        return self.tower_distribution
+
+    def load(self, path, mmap=True):
+        '''
+        Opens either format, a binary directory or a JSON file
+        :return: TowerDistribution
+        '''
+        if os.path.isdir(path):
+            return self.load_arrays(path, mmap=mmap)
+
+        self.metadata = dict()
+        self.restore(path)
+        return TowerDistribution.from_dict(self.deserialize())
+
+class DatasetReader:
+    '''
+    Reads latitude, longitude CSV datasets in large blocks and keeps a sidecar
+    .npy cache, keyed by the file size and modification time, that later runs
+    memory-map instead of parsing the CSV again. Binary .npy datasets, as written
+    by datagen.py, are memory-mapped directly.
+    '''
+    def __init__(self, block_size=64 * 2 ** 20, cache=True, columns=2):
+        if block_size <= 0:
+            raise ValueError("block size must be positive")
+        self.block_size = block_size
+        self.cache = cache
+        self.columns = columns
+        self.from_cache = False
+        self.rows_per_second = None
+
+    def cache_filepath(self, filepath):
+        stat = os.stat(filepath)
+        directory, filename = os.path.split(os.path.abspath(filepath))
+        return os.path.join(directory, ".%s.%d-%d.cache.npy" % (filename, stat.st_size, stat.st_mtime_ns))
+
+    @staticmethod
+    def is_binary(filepath):
+        return filepath.endswith(".npy")
+
+    def load_binary(self, filepath):
+        dataset = np.load(filepath, mmap_mode="r")
+        if dataset.ndim != 2 or dataset.shape[1] != self.columns:
+            raise ValueError("every row of the dataset must have %d columns" % self.columns)
+        return dataset
+
+    def iter_blocks(self, filepath):
+        '''
+        Parses the CSV one block of lines at a time
+        :return: generator of arrays of shape rows x columns
+        '''
+        if self.is_binary(filepath):
+            dataset = self.load_binary(filepath)
+            rows = max(1, self.block_size // (dataset.itemsize * self.columns))
+            for start in range(0, len(dataset), rows):
+                yield np.array(dataset[start:start + rows], dtype=float)
+            return
+
+        with open(filepath, "rb") as dataset_file:
+            remainder = b""
+            while True:
+                block = dataset_file.read(self.block_size)
+                if not block:
+                    break
+                block = remainder + block
+                last_newline = block.rfind(b"\n")
+                if last_newline == -1:
+                    remainder = block
+                    continue
+                remainder = block[last_newline + 1:]
+                yield self.parse_block(block[:last_newline + 1])
+
+            if remainder.strip():
+                yield self.parse_block(remainder)
+
+    def parse_block(self, block):
+        # blanks inside a row are dropped, whitespace then only separates rows
+        lines = block.decode().replace(" ", "").split()
+        if not lines:
+            return np.empty((0, self.columns))
+        values = np.fromstring(",".join(lines), dtype=float, sep=",")
+        if len(values) != len(lines) * self.columns:
+            raise ValueError("every row of the dataset must have %d columns" % self.columns)
+        return values.reshape(len(lines), self.columns)
+
+    def validate(self, dataset):
+        if not np.isfinite(dataset).all():
+            raise ValueError("dataset has missing or non numeric coordinates")
+        if len(dataset) and (np.abs(dataset[:, 0]).max() > 90 or np.abs(dataset[:, 1]).max() > 180):
+            raise ValueError("dataset coordinates must be latitude, longitude in degrees")
+
+    def read(self, filepath):
+        '''
+        Reads the dataset, from the cache when it is still valid
+        :param filepath: path of the CSV or .npy dataset
+        :return: array of users x (latitude, longitude)
+        '''
+        start = time.time()
+        cache_filepath = self.cache_filepath(filepath) if self.cache and not self.is_binary(filepath) else None
+        if self.is_binary(filepath):
+            self.from_cache = False
+            dataset = self.load_binary(filepath)
+        elif cache_filepath is not None and os.path.exists(cache_filepath):
+            self.from_cache = True
+            dataset = np.load(cache_filepath, mmap_mode="r")
+        else:
+            self.from_cache = False
+            blocks = list(self.iter_blocks(filepath))
+            dataset = np.concatenate(blocks, axis=0) if blocks else np.empty((0, self.columns))
+            self.validate(dataset)
+            if cache_filepath is not None:
+                self.write_cache(filepath, cache_filepath, dataset)
+
+        self.rows_per_second = len(dataset) / max(time.time() - start, 1e-9)
+        return dataset
+
+    def write_cache(self, filepath, cache_filepath, dataset):
+        directory, filename = os.path.split(os.path.abspath(filepath))
+        try:
+            for stale_cache in glob.glob(os.path.join(directory, ".%s.*.cache.npy" % glob.escape(filename))):
+                os.remove(stale_cache)
+            temporary_filepath = cache_filepath + ".tmp.npy"
+            np.save(temporary_filepath, dataset)
+            os.replace(temporary_filepath, cache_filepath)
+        except OSError:
+            # a read only dataset directory only costs the cache
+            pass
+
 if __name__ == "__main__":
     deserializer = Deserializer()
     deserializer.restore("tower-distribution.json")
@@ -1,12 +1,10 @@
-import os
-import csv
 import folium
 import numpy as np
+from datahandler import DatasetReader
+from towersdistributor import open_in_browser
 
 dataset_filepath = "/users/ajayraj/documents/towersdistributor/datasets/dataset.csv"
-with open(dataset_filepath) as dataset_file:
-    dataset_reader = csv.reader(dataset_file)
-    dataset = np.array([list(map(float, datapoint)) for datapoint in dataset_reader])
+dataset = DatasetReader().read(dataset_filepath)
 
 map = folium.Map(location=np.array([17.777612, 83.250768]), titles='OpenStreetMap')
 for datapoint in dataset:
@@ -18,4 +16,4 @@ for datapoint in dataset:
         fill_color='red'
     ).add_to(map)
 map.save("/users/ajayraj/documents/towers-distributor/new-dataset.html")
-os.system("open /users/ajayraj/documents/towers-distributor/new-dataset.html")
\ No newline at end of file
+open_in_browser("/users/ajayraj/documents/towers-distributor/new-dataset.html")
\ No newline at end of file
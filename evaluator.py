@@ -1,53 +1,143 @@
 import logging
 import numpy as np
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
+from towerdistribution import TowerDistribution
+from instrumentation import profiler
 
 class Evaluator:
     '''
     Evaluates the number of users that fall within the range of one cell site atleast
     '''
-    def __init__(self, radiation_range):
+    METHODS = ("kdtree", "chunked")
+
+    def __init__(self, radiation_range, method="kdtree", memory_budget=256 * 2 ** 20, histogram_bins=20):
+        if method not in self.METHODS:
+            raise ValueError("method must be one of " + ", ".join(self.METHODS))
+        if memory_budget <= 0:
+            raise ValueError("memory budget must be positive")
         self.radiation_range = radiation_range
+        self.method = method
+        self.memory_budget = memory_budget
+        self.histogram_bins = histogram_bins
         self.logger = logging.getLogger("evaluator")
 
     def get_users_and_cell_sites(self):
-        users = np.array(
-            [user for region in self.tower_distribution.values() for user in region['users']]
-        )
-        cell_sites = np.array(
-            [cell_site for region in self.tower_distribution.values() for cell_site in region['cell_sites']]
-        )
+        return self.tower_distribution.users, self.tower_distribution.cell_sites
+
+    def chunks(self, users, bytes_per_user):
+        '''
+        Splits the users into chunks whose working set fits in the memory budget
+        '''
+        chunk_size = max(1, int(self.memory_budget // max(bytes_per_user, 1)))
+        for start in range(0, len(users), chunk_size):
+            yield start, users[start:start + chunk_size]
+
+    def measure_coverage(self, users, cell_sites):
+        '''
+        Finds the distance from every user to the closest cell site and the no of
+        cell sites covering every user, one chunk of users at a time
+        :return: tuple of nearest cell site distances and covering cell site counts
+        '''
+        nearest_distances = np.empty(len(users))
+        covering_counts = np.empty(len(users), dtype=np.intp)
+        if not len(cell_sites):
+            nearest_distances.fill(np.inf)
+            covering_counts.fill(0)
+            return nearest_distances, covering_counts
 
-        return users, cell_sites
+        if self.method == "kdtree":
+            cell_site_tree = cKDTree(cell_sites)
+            # the neighbour lists of a chunk are bounded by the sites covering each user
+            for start, chunk in self.chunks(users, 64):
+                nearest_distances[start:start + len(chunk)] = cell_site_tree.query(chunk)[0]
+                covering_counts[start:start + len(chunk)] = cell_site_tree.query_ball_point(
+                    chunk, self.radiation_range, return_length=True
+                )
+        else:
+            for start, chunk in self.chunks(users, 8 * len(cell_sites)):
+                distances = cdist(chunk, cell_sites, 'euclidean')
+                nearest_distances[start:start + len(chunk)] = distances.min(axis=1)
+                covering_counts[start:start + len(chunk)] = np.count_nonzero(distances <= self.radiation_range, axis=1)
+                del distances
 
+        return nearest_distances, covering_counts
 
-    def evaluate(self, tower_distribution):
+    def evaluate(self, tower_distribution, region_ids=None):
         '''
-        Exposed function for evaluation
+        Exposed function for evaluation. The detailed figures are kept in self.report:
+        per region coverage, a histogram of how many cell sites cover each user and
+        the distribution of distances to the closest cell site.
         :param tower_distribution: the UBC data structure
-        :return:
+        :param region_ids: only evaluate the users of these regions, all regions by default
+        :return: no of users, no of cell sites and coverage in percent
         '''
+        if not isinstance(tower_distribution, TowerDistribution):
+            tower_distribution = TowerDistribution.from_dict(tower_distribution)
         self.tower_distribution = tower_distribution
-        users, cell_sites = self.get_users_and_cell_sites()
-        is_within_range = lambda distance: distance <= self.radiation_range
-        closest_cell_site_distances = np.min(cdist(users, cell_sites, 'euclidean'), axis=1)
-        users_within_range = sum(map(is_within_range, closest_cell_site_distances))
+        cell_sites = tower_distribution.cell_sites
+        if region_ids is None:
+            users, user_regions = tower_distribution.users, tower_distribution.user_regions
+            region_ids = tower_distribution.region_ids
+        else:
+            region_ids = np.unique(tower_distribution.resolve(np.asarray(region_ids, dtype=np.intp)))
+            users, user_regions = tower_distribution.users_in(region_ids)
+
+        with profiler.span("measure_coverage", method=self.method, users=len(users), cell_sites=len(cell_sites)):
+            nearest_distances, covering_counts = self.measure_coverage(users, cell_sites)
+        is_within_range = nearest_distances <= self.radiation_range
+        users_within_range = np.count_nonzero(is_within_range)
 
         acccuracy = users_within_range * 100 / len(users)
 
+        region_users = np.bincount(user_regions, minlength=len(tower_distribution.base_stations))
+        region_users_within_range = np.bincount(
+            user_regions, weights=is_within_range, minlength=len(tower_distribution.base_stations)
+        )
+        finite_distances = nearest_distances[np.isfinite(nearest_distances)]
+        distance_counts, distance_bins = np.histogram(finite_distances, bins=self.histogram_bins)
+        percentiles = (50, 90, 95, 99, 100)
+        distance_percentiles = np.percentile(finite_distances, percentiles) if len(finite_distances) else [np.nan] * 5
+
+        self.report = {
+            'users': len(users),
+            'cell_sites': len(cell_sites),
+            'coverage': float(acccuracy),
+            'region_coverage': {
+                int(region_id): float(region_users_within_range[region_id] * 100 / region_users[region_id])
+                for region_id in region_ids if region_users[region_id]
+            },
+            'covering_cell_sites_histogram': np.bincount(covering_counts).tolist(),
+            'nearest_cell_site_distance': {
+                'percentiles': {
+                    str(percentile): float(value) for percentile, value in zip(percentiles, distance_percentiles)
+                },
+                'histogram': distance_counts.tolist(),
+                'bin_edges': distance_bins.tolist()
+            }
+        }
+
         self.logger.debug("Users = " + str(len(users)))
         self.logger.debug("Cell Sites = " + str(len(cell_sites)))
         self.logger.debug("Coverage = " + str(acccuracy) + " %")
+        self.logger.debug(
+            "Median distance to closest cell site = " +
+            str(self.report['nearest_cell_site_distance']['percentiles']['50'])
+        )
 
         return len(users), len(cell_sites), acccuracy
 
 if __name__ == "__main__":
+    import sys
     from datahandler import *
 
+    # either a JSON file or a binary distribution directory
     deserializer = Deserializer()
-    deserializer.restore("tower-distribution.json")
-    tower_distribution = deserializer.deserialize()
+    tower_distribution = deserializer.load(sys.argv[1] if len(sys.argv) > 1 else "tower-distribution.json")
+    if "projection" in deserializer.metadata:
+        from projection import Projection
+        tower_distribution = tower_distribution.transformed(Projection.from_dict(deserializer.metadata["projection"]).forward)
 
-    evaluator = Evaluator(tower_distribution)
-    acccuracy = evaluator.evaluate()
+    evaluator = Evaluator(radiation_range=deserializer.metadata.get("radiation_range", 0.01))
+    acccuracy = evaluator.evaluate(tower_distribution)
     print(acccuracy)
@@ -0,0 +1,213 @@
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+import functools
+import contextlib
+
+def reset_peak_rss():
+    # linux lets a process reset its high water mark, elsewhere the peak only grows
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+def peak_rss():
+    '''
+    :return: peak resident set size of the process in bytes
+    '''
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+class Profiler:
+    '''
+    Records wall time, CPU time, peak memory and custom counters of the pipeline
+    stages and their sub-steps. Disabled it costs one attribute check per span.
+
+    Spans nest per thread. The peak RSS of a span is the process peak since the
+    enclosing top level stage started, the high water mark being reset at every
+    stage of the main thread where the platform allows it. Work done inside
+    process pools is not recorded.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.profile_stage = None
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.counters = dict()
+        self.profiles = dict()
+        self.origin = time.perf_counter()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def enable(self, profile_stage=None):
+        '''
+        :param profile_stage: name of a span to run under cProfile
+        '''
+        self.reset()
+        self.enabled = True
+        self.profile_stage = profile_stage
+
+    def disable(self):
+        self.enabled = False
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name, **args):
+        '''
+        Context manager that records one stage or sub-step
+        :param name: name of the span
+        :param args: extra figures shown with the span
+        '''
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.record(name, args)
+
+    @contextlib.contextmanager
+    def record(self, name, args):
+        stack = self.stack()
+        is_stage = not stack and threading.current_thread() is threading.main_thread()
+        if is_stage:
+            reset_peak_rss()
+        event = {
+            "name": name, "args": args, "counters": dict(), "depth": len(stack),
+            "pid": os.getpid(), "tid": threading.get_ident()
+        }
+        stack.append(event)
+
+        profile = None
+        if name == self.profile_stage and name not in self.profiles:
+            profile = cProfile.Profile()
+        start_wall, start_cpu, start_thread_cpu = time.perf_counter(), time.process_time(), time.thread_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield event
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.profiles[name] = profile
+            event["start"] = start_wall - self.origin
+            event["wall_seconds"] = time.perf_counter() - start_wall
+            event["cpu_seconds"] = time.process_time() - start_cpu
+            event["thread_cpu_seconds"] = time.thread_time() - start_thread_cpu
+            event["peak_rss"] = peak_rss()
+            stack.pop()
+            with self.lock:
+                self.events.append(event)
+
+    def instrument(self, name=None):
+        '''
+        Decorator recording every call of a function as a span
+        :param name: name of the span, the function name by default
+        '''
+        def decorator(function):
+            span_name = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.record(span_name, dict()):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, value=1):
+        '''
+        Adds to a counter of the innermost open span and to the run total
+        '''
+        if not self.enabled:
+            return
+        stack = self.stack()
+        if stack:
+            counters = stack[-1]["counters"]
+            counters[name] = counters.get(name, 0) + value
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        '''
+        :return: dict of span name: calls, total wall, CPU seconds and max peak RSS
+        '''
+        summary = dict()
+        for event in self.events:
+            entry = summary.setdefault(
+                event["name"], {"calls": 0, "wall_seconds": 0., "cpu_seconds": 0., "peak_rss": 0}
+            )
+            entry["calls"] += 1
+            entry["wall_seconds"] += event["wall_seconds"]
+            entry["cpu_seconds"] += event["cpu_seconds"]
+            entry["peak_rss"] = max(entry["peak_rss"], event["peak_rss"])
+        return summary
+
+    def dump_json(self, filename):
+        with open(filename, "w") as trace_file:
+            json.dump({
+                "summary": self.summary(),
+                "counters": self.counters,
+                "events": sorted(self.events, key=lambda event: event["start"])
+            }, trace_file, indent=2, default=str)
+
+    def dump_chrome_trace(self, filename):
+        '''
+        Writes the spans in the Chrome trace event format, viewable in
+        chrome://tracing or https://ui.perfetto.dev
+        '''
+        trace_events = []
+        for event in self.events:
+            args = dict(event["args"])
+            args.update(event["counters"])
+            args.update(cpu_seconds=event["cpu_seconds"], peak_rss_mb=event["peak_rss"] / 2 ** 20)
+            trace_events.append({
+                "name": event["name"], "ph": "X", "pid": event["pid"], "tid": event["tid"],
+                "ts": event["start"] * 10 ** 6, "dur": event["wall_seconds"] * 10 ** 6, "args": args
+            })
+        with open(filename, "w") as trace_file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file, default=str)
+
+    def dump_profiles(self, directory, lines=40):
+        '''
+        Saves every cProfile run as a .prof file and a text summary sorted by cumulative time
+        :return: list of the files written
+        '''
+        written = []
+        for name, profile in self.profiles.items():
+            profile_filepath = os.path.join(directory, name + ".prof")
+            profile.dump_stats(profile_filepath)
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(lines)
+            with open(os.path.join(directory, name + ".profile.txt"), "w") as report_file:
+                report_file.write(report.getvalue())
+            written.append(profile_filepath)
+        return written
+
+    def dump(self, directory):
+        '''
+        Writes trace.json, trace.chrome.json and the cProfile results into directory
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.dump_json(os.path.join(directory, "trace.json"))
+        self.dump_chrome_trace(os.path.join(directory, "trace.chrome.json"))
+        self.dump_profiles(directory)
+
+profiler = Profiler()
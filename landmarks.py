@@ -0,0 +1,157 @@
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+from sklearn.cluster import KMeans
+from regions import Regions
+from instrumentation import profiler
+
+class LandmarkRegions(Regions):
+    '''
+    LandmarkRegions approximates the spectral clustering of Regions for city scale datasets.
+    Only the affinity between every user and m landmark points is built, so the whole
+    region detection runs in time linear in the number of users.
+
+        References:
+    https://www.aaai.org/ocs/index.php/AAAI/AAAI11/paper/view/3558/3858
+    '''
+    SELECTIONS = ("random", "kmeans++")
+
+    def __init__(self, n_landmarks=500, n_nearest_landmarks=5, selection="kmeans++", random_state=0, n_clusters=None,
+                 n_neighbours=100):
+        '''
+        :param n_nearest_landmarks: least no of landmarks every user is connected to
+        :param n_neighbours: the distance to this nearest neighbour sets the local scale,
+                             100 like the affinity of Regions
+        '''
+        if n_landmarks < 2:
+            raise ValueError("no of landmarks must be atleast 2")
+        if n_neighbours < 1:
+            raise ValueError("no of neighbours must be atleast 1")
+        if selection not in self.SELECTIONS:
+            raise ValueError("landmark selection must be one of " + ", ".join(self.SELECTIONS))
+        super().__init__()
+        self.n_landmarks = n_landmarks
+        self.n_nearest_landmarks = n_nearest_landmarks
+        self.selection = selection
+        self.n_clusters = n_clusters
+        self.n_neighbours = n_neighbours
+        self.random_state = np.random.RandomState(random_state)
+
+    def select_landmarks(self, users):
+        '''
+        Picks the landmark points either uniformly at random or by k-means++ seeding
+        :param users: geo-coordinates of all customers' locations.
+        :return: array of landmark coordinates
+        '''
+        n_landmarks = min(self.n_landmarks, len(users))
+        self.logger.debug("Selecting " + str(n_landmarks) + " landmarks by " + self.selection)
+
+        if self.selection == "random":
+            return users[self.random_state.choice(len(users), n_landmarks, replace=False)]
+
+        landmarks = np.empty((n_landmarks, users.shape[1]))
+        landmarks[0] = users[self.random_state.randint(len(users))]
+        closest_sq_distances = np.sum((users - landmarks[0]) ** 2, axis=1)
+        for index in range(1, n_landmarks):
+            total = closest_sq_distances.sum()
+            if total == 0:
+                # fewer distinct locations than landmarks
+                return landmarks[:index]
+            candidate = np.searchsorted(
+                np.cumsum(closest_sq_distances), self.random_state.uniform(0, total)
+            )
+            landmarks[index] = users[min(candidate, len(users) - 1)]
+            closest_sq_distances = np.minimum(
+                closest_sq_distances, np.sum((users - landmarks[index]) ** 2, axis=1)
+            )
+
+        return landmarks
+
+    def get_landmark_affinity_matrix(self, users, landmarks):
+        '''
+        Builds the sparse n x m affinity between users and their nearest landmarks with
+        the local scaling of Regions. Every landmark stands for about n / m users, so the
+        n_neighbours-th nearest user is about as far as the (n_neighbours * m / n)-th
+        nearest landmark, which gives the scale of both users and landmarks.
+        Each row keeps at least twice that many nearest landmarks and sums to 1.
+        :return: scipy.sparse affinity matrix of users x landmarks
+        '''
+        self.logger.debug("Building landmark affinity matrix")
+        n_users, n_landmarks = len(users), len(landmarks)
+        n_scale = int(np.clip(round(self.n_neighbours * n_landmarks / n_users), 1, max(n_landmarks - 1, 1)))
+        n_nearest = min(max(self.n_nearest_landmarks, 2 * n_scale), n_landmarks)
+
+        landmark_tree = cKDTree(landmarks)
+        landmark_scale = landmark_tree.query(landmarks, k=n_scale + 1)[0].reshape(n_landmarks, -1)[:, -1]
+        distances, indices = landmark_tree.query(users, k=n_nearest)
+        distances = distances.reshape(n_users, n_nearest)
+        indices = indices.reshape(n_users, n_nearest)
+        user_scale = distances[:, min(n_scale, n_nearest) - 1]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = np.exp(-distances ** 2 / (user_scale[:, np.newaxis] * landmark_scale[indices]))
+        # coincident points, as in Regions
+        weights[np.isnan(weights)] = 1.0
+        # a user whose landmarks all have a zero scale keeps its nearest one
+        weights[weights.sum(axis=1) == 0, 0] = 1.0
+        weights /= weights.sum(axis=1)[:, np.newaxis]
+
+        rows = np.repeat(np.arange(n_users), n_nearest)
+        return sparse.csr_matrix(
+            (weights.ravel(), (rows, indices.ravel())), shape=(n_users, n_landmarks)
+        )
+
+    def landmark_embedding(self, Z, topK=50, n_clusters=None):
+        '''
+        Approximates the leading eigenvectors of the user affinity W = Z D^-1 Z^T
+        through the m x m matrix Z^T Z, following landmark based spectral clustering
+        :param Z: users x landmarks affinity matrix
+        :param topK: no of eigenpairs considered for the eigengap heuristic
+        :param n_clusters: fixed no of clusters, skips the eigengap heuristic
+        :return: the optimal number of clusters by eigengap heuristic and the embedding
+        '''
+        self.logger.debug("Computing landmark eigen decomposition")
+        landmark_degree = np.asarray(Z.sum(axis=0)).ravel()
+        Z = Z[:, landmark_degree > 0]
+        Z_hat = Z.dot(sparse.diags(1 / np.sqrt(landmark_degree[landmark_degree > 0])))
+
+        eigenvalues, eigenvectors = np.linalg.eigh(Z_hat.T.dot(Z_hat).toarray())
+        order = np.argsort(eigenvalues)[::-1][:max(2, topK, n_clusters or 0)]
+        eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+
+        # eigenvalues of the normalized laplacian are 1 - eigenvalues of W
+        laplacian_eigenvalues = 1 - eigenvalues
+        index_largest_gap = np.argmax(np.diff(laplacian_eigenvalues))
+        nb_clusters = index_largest_gap + 1
+        if n_clusters is not None:
+            nb_clusters = min(n_clusters, len(eigenvalues))
+
+        singular_values = np.sqrt(np.clip(eigenvalues[:nb_clusters], 1e-12, None))
+        embedding = Z_hat.dot(eigenvectors[:, :nb_clusters]) / singular_values
+
+        self.logger.debug("Landmark eigen decomposition applied")
+        return nb_clusters, embedding
+
+    def detect_regions(self, users):
+        '''
+        Performs landmark based spectral clustering on geo_coordinates
+        :param users: geo-coordinates of all customers' locations.
+        :return: dict of clusters: datapoints
+        '''
+        self.logger.debug("Clustering settlements with landmarks")
+
+        with profiler.span("affinity", affinity="landmark", users=len(users)):
+            landmarks = self.select_landmarks(users)
+            Z = self.get_landmark_affinity_matrix(users, landmarks)
+
+        with profiler.span("eigen_decomposition", eigen_solver="landmark"):
+            K, embedding = self.landmark_embedding(Z, topK=50, n_clusters=self.n_clusters)
+        self.logger.debug("Optimal K for Region Clustering " + str(K))
+
+        with profiler.span("spectral_fit", n_clusters=int(K)):
+            region_clustering = KMeans(n_clusters=K, random_state=0, n_init=10)
+            labels = region_clustering.fit_predict(embedding)
+
+        self.regions = self.format_regions(labels, users)
+
+        return self.regions
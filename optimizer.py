@@ -1,55 +1,91 @@
+import heapq
 import logging
 import numpy as np
+from towerdistribution import TowerDistribution
+from spatialindex import BaseStationIndex, SpatialGrid, greedy_separation
+from instrumentation import profiler
 
 class Optimizer:
     '''
     This class optimizes the no of towers by merging stations with less than 25 towers
     '''
-    def __init__(self, min_towers=5, min_cell_site_distance=0.005):
+    MERGES = ("heap", "scan")
+
+    def __init__(self, min_towers=5, min_cell_site_distance=0.005, merge="heap", deduplicate=False):
+        if merge not in self.MERGES:
+            raise ValueError("merge must be one of " + ", ".join(self.MERGES))
         self.min_towers = min_towers
+        self.merge = merge
+        self.deduplicate = deduplicate
         self.min_cell_site_distance = min_cell_site_distance
+        self.candidate_regions = None
         self.logger = logging.getLogger("optimizer")
 
-    def optimize(self, tower_distribution):
+    def optimize(self, tower_distribution, region_ids=None):
         '''
         This is the exposed API for optimization
+        :param region_ids: only merge and relocate these regions, all regions by default
         :return: optimized tower_distribution
         '''
         self.logger.debug("Removing micro clusters")
+        if not isinstance(tower_distribution, TowerDistribution):
+            tower_distribution = TowerDistribution.from_dict(tower_distribution)
         self.tower_distribution = tower_distribution
-        while self.club_base_stations():
-            pass
+        self.candidate_regions = None if region_ids is None else set(np.asarray(region_ids).tolist())
+        if self.deduplicate:
+            with profiler.span("deduplicate_cell_sites"):
+                self.deduplicate_cell_sites()
+
+        with profiler.span("merge_micro_regions", merge=self.merge):
+            if self.merge == "heap":
+                self.merge_micro_regions()
+            else:
+                while self.club_base_stations():
+                    pass
 
-        self.relocate_base_stations()
+        with profiler.span("relocate_base_stations"):
+            self.relocate_base_stations(region_ids)
 
         self.logger.debug("Micro clusters removed")
         return self.tower_distribution
 
-    def find_nearest_base_station_key(self, base_station):
-        current_key = str(base_station)
-        all_base_stations = [
-            (key, region['base_station'])
-            for key, region in self.tower_distribution.items()
-                if key != current_key
-        ]
+    def find_nearest_base_station(self, region_id):
+        '''
+        :return: id of the region whose base station is closest to the given region's
+        '''
+        region_ids = self.tower_distribution.region_ids
+        other_region_ids = region_ids[region_ids != region_id]
+        base_stations = self.tower_distribution.base_stations
 
-        nearest_base_station = min(
-            all_base_stations,
-            key = lambda each_base_station: np.linalg.norm(each_base_station[1] - base_station)
-        )
+        distances = np.linalg.norm(base_stations[other_region_ids] - base_stations[region_id], axis=1)
+        return other_region_ids[np.argmin(distances)]
 
-        return nearest_base_station[0] # key is at 0th index
+    def accept_cell_sites(self, incoming_cell_sites, exisiting_cell_sites):
+        '''
+        Checks all incoming cell sites of a merged region at once. A cell site is accepted
+        unless it is within min_cell_site_distance of an exisiting cell site or of an
+        incoming cell site accepted before it.
+        :param incoming_cell_sites: cell sites of the region being merged
+        :param exisiting_cell_sites: cell sites of the region absorbing it
+        :return: boolean mask of the accepted incoming cell sites
+        '''
+        accepted = ~SpatialGrid(exisiting_cell_sites, self.min_cell_site_distance).any_within(incoming_cell_sites)
+        candidates = np.flatnonzero(accepted)
+        accepted[candidates] = greedy_separation(incoming_cell_sites[candidates], self.min_cell_site_distance)
+        return accepted
 
-    def has_cell_sites_within_range(self, current_cell_site, exisiting_cell_sites):
+    def deduplicate_cell_sites(self):
         '''
-        checks if the current cell site is within range of other cell sites
-        :param current_cell_site: the cellsite for the current iteration
-        :param exisiting_cell_sites: all the exisiting cell sites
-        :return: True if cell sites found else false
+        Collapses cell sites closer than min_cell_site_distance across the whole
+        distribution, including across region borders. The first cell site is kept.
+        :return: no of cell sites removed
         '''
-        is_within_range = lambda exisiting_cell_site: np.linalg.norm(exisiting_cell_site - current_cell_site) < self.min_cell_site_distance
-        any_site_within_range = max(map(is_within_range, exisiting_cell_sites))
-        return any_site_within_range
+        tower_distribution = self.tower_distribution
+        kept = greedy_separation(tower_distribution.cell_sites, self.min_cell_site_distance)
+        tower_distribution.remove_cell_sites(np.flatnonzero(~kept))
+
+        self.logger.debug("Removed " + str(np.count_nonzero(~kept)) + " duplicate cell sites")
+        return np.count_nonzero(~kept)
 
     def club_base_stations(self):
         '''
@@ -57,52 +93,112 @@ class Optimizer:
         :return: None
         '''
         self.logger.debug("Applying custom optimization")
-        distribution_updated = False
-        keys = list(self.tower_distribution.keys())
-        for key in keys:
-            if key not in self.tower_distribution:
+        tower_distribution = self.tower_distribution
+        region_ids = tower_distribution.region_ids
+        if len(region_ids) < 2:
+            return False
+
+        cell_site_counts = tower_distribution.cell_site_counts()
+        for region_id in region_ids:
+            if cell_site_counts[region_id] >= self.min_towers or not self.is_candidate(region_id):
                 continue
 
-            if len(self.tower_distribution[key]['cell_sites']) >= self.min_towers:
-                continue
+            with profiler.span("merge", source=int(region_id)):
+                nearest_region_id = self.find_nearest_base_station(region_id)
+                cell_site_regions = tower_distribution.cell_site_regions
+                incoming = np.flatnonzero(cell_site_regions == region_id)
+                accepted = self.accept_cell_sites(
+                    tower_distribution.cell_sites[incoming],
+                    tower_distribution.cell_sites[cell_site_regions == nearest_region_id]
+                )
+                rejected_cell_sites = incoming[~accepted]
+
+                tower_distribution.merge_regions(region_id, nearest_region_id, rejected_cell_sites)
+            profiler.count("merges")
+            profiler.count("rejected_cell_sites", len(rejected_cell_sites))
 
-            current_base_station = self.tower_distribution[key]
-            nearest_key = self.find_nearest_base_station_key(
-                self.tower_distribution[key]['base_station']
-            )
-            nearest_base_station = self.tower_distribution[nearest_key]
-            self.tower_distribution.pop(key)
-            # self.tower_distribution.pop(nearest_key)
+            self.logger.debug("Custom optimization applied")
+            return True
 
+        return False
 
-            nearest_base_station['users'] = np.concatenate(
-                (nearest_base_station['users'], current_base_station['users']),
-                axis=0
-            )
+    def merge_micro_regions(self):
+        '''
+        Single pass equivalent of repeating club_base_stations until nothing changes.
+        Regions with too few cell sites wait in a heap ordered by region id, which is
+        the order the scan would pick them in, and the nearest base station is looked
+        up in a KD-tree that drops regions as they get merged away.
+        :return: no of merges
+        '''
+        self.logger.debug("Applying custom optimization with a priority queue")
+        tower_distribution = self.tower_distribution
+        region_ids = tower_distribution.region_ids
+        cell_site_regions = tower_distribution.cell_site_regions
+
+        order = np.argsort(cell_site_regions, kind="mergesort")
+        bounds = np.searchsorted(cell_site_regions[order], np.append(region_ids, np.iinfo(np.intp).max))
+        region_cell_sites = {
+            region_id: list(order[bounds[index]:bounds[index + 1]])
+            for index, region_id in enumerate(region_ids)
+        }
+
+        micro_regions = [
+            region_id for region_id in region_ids
+            if len(region_cell_sites[region_id]) < self.min_towers and self.is_candidate(region_id)
+        ]
+        heapq.heapify(micro_regions)
+        base_station_index = BaseStationIndex(tower_distribution.base_stations, region_ids)
+
+        merges = 0
+        rejected_cell_sites = []
+        while micro_regions:
+            region_id = heapq.heappop(micro_regions)
+            # cell sites only ever get added to the surviving regions
+            if region_id not in region_cell_sites or len(region_cell_sites[region_id]) >= self.min_towers:
+                continue
 
-            for cell_site in current_base_station['cell_sites']:
-                if self.has_cell_sites_within_range(cell_site, nearest_base_station['cell_sites']):
-                    continue
+            with profiler.span("merge", source=int(region_id)):
+                nearest_region_id = base_station_index.nearest(region_id)
+                if nearest_region_id is None:
+                    break
 
-                nearest_base_station['cell_sites'] = np.concatenate(
-                    (nearest_base_station['cell_sites'], [cell_site]),
-                    axis=0
+                incoming = np.array(region_cell_sites.pop(region_id), dtype=np.intp)
+                accepted = self.accept_cell_sites(
+                    tower_distribution.cell_sites[incoming],
+                    tower_distribution.cell_sites[region_cell_sites[nearest_region_id]]
                 )
+                region_cell_sites[nearest_region_id].extend(incoming[accepted])
+                rejected_cell_sites.extend(incoming[~accepted])
 
-            distribution_updated = True
-            # self.tower_distribution[nearest_key] = nearest_base_station
+                tower_distribution.merge_regions(region_id, nearest_region_id)
+                base_station_index.remove(region_id)
+            merges += 1
+            profiler.count("merges")
+            profiler.count("rejected_cell_sites", int(np.count_nonzero(~accepted)))
 
-            self.logger.debug("Custom optimization applied")
-            return distribution_updated
-
-    def relocate_base_stations(self):
-        regions = list(self.tower_distribution.values())
-        for region in regions:
-            key = str(region['base_station'])
-            region['base_station'] = min(
-                region['cell_sites'],
-                key=lambda cell_site: np.linalg.norm(region['base_station'] - cell_site)
-            )
-            new_key = str(region['base_station'])
-            self.tower_distribution[new_key] = region
-            self.tower_distribution.pop(key)
\ No newline at end of file
+        tower_distribution.remove_cell_sites(rejected_cell_sites)
+        self.logger.debug("Custom optimization applied with " + str(merges) + " merges")
+        return merges
+
+    def is_candidate(self, region_id):
+        return self.candidate_regions is None or region_id in self.candidate_regions
+
+    def relocate_base_stations(self, region_ids=None):
+        '''
+        Moves every base station onto its closest cell site
+        :param region_ids: only relocate the regions these have been merged into
+        '''
+        tower_distribution = self.tower_distribution
+        if region_ids is None:
+            region_ids = tower_distribution.region_ids
+        else:
+            region_ids = np.unique(tower_distribution.resolve(np.asarray(region_ids, dtype=np.intp)))
+        cell_site_groups = tower_distribution.group(
+            tower_distribution.cell_sites, tower_distribution.cell_site_regions, region_ids
+        )
+        for region_id, cell_sites in zip(region_ids, cell_site_groups):
+            if not len(cell_sites):
+                continue
+            base_station = tower_distribution.base_stations[region_id]
+            distances = np.linalg.norm(cell_sites - base_station, axis=1)
+            tower_distribution.base_stations[region_id] = cell_sites[np.argmin(distances)]
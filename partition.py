@@ -0,0 +1,272 @@
+import os
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from towersdistributor import TowersDistributor
+from towerdistribution import TowerDistribution
+from cellsites import limit_blas_threads
+from spatialindex import greedy_separation
+from instrumentation import profiler
+
+def distribute_tile(users, settlement_clustering, cellsite_clustering, optimization, projection, min_tile_users):
+    '''
+    Runs the whole pipeline on the core and halo users of one tile, runs inside the pool
+    :return: dict of the region of every user in input order, the cell sites and base
+             stations in latitude, longitude and the seconds taken
+    '''
+    start = time.time()
+    distributor = TowersDistributor.from_dataset(users, projection=projection)
+    if len(users) < min_tile_users:
+        # too sparse to find settlements in, the tile becomes a single region
+        distributor.regions = {0: distributor.points}
+        distributor.region_indices = {0: np.arange(len(users))}
+        distributor.base_stations = {0: distributor.points.mean(axis=0)}
+    else:
+        distributor.perform_settlement_clustering(**settlement_clustering)
+    # format stacks the regions in order, their indices give the input position of every user
+    input_order = np.concatenate([distributor.region_indices[label] for label in distributor.regions])
+    distributor.perform_cellsite_clustering(**cellsite_clustering)
+    distributor.format()
+    distributor.optimize(**optimization)
+
+    tower_distribution = distributor.tower_distribution.compacted()
+    user_region = np.empty(len(users), dtype=np.intp)
+    user_region[input_order] = tower_distribution.user_region
+
+    geographic = distributor.geographic_distribution().compacted()
+    return {
+        "user_region": user_region,
+        "cell_sites": np.asarray(geographic.cell_sites),
+        "cell_site_region": np.asarray(geographic.cell_site_region),
+        "base_stations": np.asarray(geographic.base_stations),
+        "seconds": time.time() - start
+    }
+
+class PartitionedDistributor(TowersDistributor):
+    '''
+    Partitioned planning mode of TowersDistributor for country scale datasets.
+    The users are split into square geographic tiles, every tile is planned on its
+    own in a process pool together with a halo of the neighbouring users at least a
+    radiation range wide, and the tiles are stitched back into one distribution.
+
+    A user belongs to the tile it lies in and a cell site to the tile it was placed in.
+    Regions of two tiles that share most of their halo users are merged, and cell sites
+    of different tiles closer than min gap across a tile border are dropped.
+    '''
+    def __init__(self, dataset_filepath, tile_size=20000, halo=None, workers=None, min_tile_users=200,
+                 enable_logger=True, projection=None):
+        '''
+        :param tile_size: side of a tile(in metres)
+        :param halo: width of the overlap around a tile(in metres), the radiation range by default
+        :param workers: no of tile processes, defaults to the cpu count
+        :param projection: projection every tile is clustered in, see TowersDistributor
+        '''
+        if workers is not None and workers < 1:
+            raise ValueError("no of workers must be atleast 1")
+        if min_tile_users < 1:
+            raise ValueError("min users per tile must be atleast 1")
+        super().__init__(dataset_filepath, enable_logger=enable_logger)
+        self.tile_size = self.metres_to_geodistance(tile_size)
+        if self.tile_size == 0:
+            raise ValueError("tile size must be positive")
+        self.halo = None if halo is None else self.metres_to_geodistance(halo)
+        self.workers = workers or os.cpu_count() or 1
+        self.min_tile_users = min_tile_users
+        self.tile_projection = projection
+
+    def partition(self, halo):
+        '''
+        Splits the users into tiles, every user being a core user of the tile it lies in
+        and a halo user of the up to three neighbouring tiles within halo of it
+        :param halo: width of the overlap(in degrees), less than the tile size
+        :return: dict of tile: (indices of the core users, indices of the halo users)
+        '''
+        cells = np.floor(self.dataset / self.tile_size).astype(np.int64)
+        offsets = self.dataset / self.tile_size - cells
+        near_low, near_high = offsets < halo / self.tile_size, offsets > 1 - halo / self.tile_size
+
+        tile_cells, tile_users = [cells], [np.arange(len(cells))]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if dx == dy == 0:
+                    continue
+                within = np.ones(len(cells), dtype=bool)
+                for axis, step in ((0, dx), (1, dy)):
+                    if step == -1:
+                        within &= near_low[:, axis]
+                    elif step == 1:
+                        within &= near_high[:, axis]
+                indices = np.flatnonzero(within)
+                tile_cells.append(cells[indices] + (dx, dy))
+                tile_users.append(indices)
+
+        is_core = np.repeat([True, False], [len(cells), sum(len(indices) for indices in tile_users[1:])])
+        tile_cells, tile_users = np.concatenate(tile_cells), np.concatenate(tile_users)
+        tiles, inverse = np.unique(tile_cells, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="mergesort")
+        bounds = np.searchsorted(inverse[order], np.arange(len(tiles) + 1))
+
+        self.tiles = dict()
+        for index, tile in enumerate(tiles.tolist()):
+            tile = tuple(tile)
+            members = order[bounds[index]:bounds[index + 1]]
+            core = tile_users[members[is_core[members]]]
+            # tiles made of halo users alone are planned by the tiles those users belong to
+            if len(core):
+                self.tiles[tile] = (core, tile_users[members[~is_core[members]]])
+
+        self.logger.debug(
+            "Partitioned " + str(len(self.dataset)) + " users into " + str(len(self.tiles)) + " tiles, " +
+            str(sum(len(halo_users) for _, halo_users in self.tiles.values())) + " halo users, largest tile has " +
+            str(max((len(core) + len(halo_users) for core, halo_users in self.tiles.values()), default=0)) + " users"
+        )
+        return self.tiles
+
+    @profiler.instrument("partitioned_distribution")
+    def distribute(self, settlement_clustering=None, cellsite_clustering=None, optimization=None):
+        '''
+        Partitions the dataset, plans the tiles in parallel and stitches them
+        :param settlement_clustering: keyword arguments of perform_settlement_clustering
+        :param cellsite_clustering: keyword arguments of perform_cellsite_clustering
+        :param optimization: keyword arguments of optimize
+        :return: the stitched TowerDistribution
+        '''
+        settlement_clustering = settlement_clustering or dict()
+        # every tile is one process already, cell sites are clustered in its main thread
+        cellsite_clustering = dict(cellsite_clustering or dict(), executor="thread", workers=1)
+        optimization = optimization or dict()
+
+        self.radiation_range = self.metres_to_geodistance(cellsite_clustering.get("radiation_range", 1000))
+        self.min_towers = optimization.get("min_towers", 10)
+        self.min_cell_site_distance = self.metres_to_geodistance(optimization.get("min_cell_site_distance", 700))
+        halo = self.radiation_range if self.halo is None else self.halo
+        if halo < self.radiation_range:
+            raise ValueError("halo must be atleast the radiation range")
+        if halo >= self.tile_size / 2:
+            raise ValueError("halo must be less than half the tile size")
+
+        with profiler.span("partition"):
+            tiles = self.partition(halo)
+
+        threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=limit_blas_threads, initargs=(threads_per_worker,)
+        )
+        results = dict()
+        with profiler.span("tile_pipelines", tiles=len(tiles)), pool:
+            # largest tiles first so that they do not end up as the last stragglers
+            ordered_tiles = sorted(tiles.items(), key=lambda item: len(item[1][0]) + len(item[1][1]), reverse=True)
+            tasks = [
+                pool.submit(
+                    distribute_tile, self.dataset[np.concatenate((core, halo_users))], settlement_clustering,
+                    cellsite_clustering, optimization, self.tile_projection, self.min_tile_users
+                )
+                for _, (core, halo_users) in ordered_tiles
+            ]
+            for (tile, (core, halo_users)), task in zip(ordered_tiles, tasks):
+                results[tile] = task.result()
+                self.logger.debug(
+                    "Tile " + str(tile) + " with " + str(len(core)) + " + " + str(len(halo_users)) + " users took " +
+                    "%.3f" % results[tile]["seconds"] + " s for " + str(len(results[tile]["cell_sites"])) + " cell sites"
+                )
+
+        with profiler.span("stitch"):
+            self.tower_distribution = self.stitch(tiles, results)
+        return self.tower_distribution
+
+    def stitch(self, tiles, results):
+        '''
+        Joins the tile distributions. Every user takes the region its own tile gave it
+        and every cell site is kept by the tile it lies in. A halo region is merged into
+        the region of the neighbouring tile that owns most of its users, and cell sites of
+        different tiles closer than min gap are dropped, the earlier tile's one being kept.
+        :return: TowerDistribution over all the users
+        '''
+        tile_keys = sorted(results.keys())
+        region_offsets = np.cumsum([0] + [len(results[tile]["base_stations"]) for tile in tile_keys])
+        user_region = np.full(len(self.dataset), -1, dtype=np.intp)
+        halo_regions, halo_users = [], []
+        cell_sites, cell_site_region, cell_site_tile = [], [], []
+
+        for index, tile in enumerate(tile_keys):
+            result, (core, halo) = results[tile], tiles[tile]
+            regions = result["user_region"] + region_offsets[index]
+            user_region[core] = regions[:len(core)]
+            halo_regions.append(regions[len(core):])
+            halo_users.append(halo)
+
+            cells = np.floor(result["cell_sites"] / self.tile_size).astype(np.int64).reshape(-1, 2)
+            owned = (cells == tile).all(axis=1)
+            cell_sites.append(result["cell_sites"][owned])
+            cell_site_region.append(result["cell_site_region"][owned] + region_offsets[index])
+            cell_site_tile.append(np.full(np.count_nonzero(owned), index))
+
+        tower_distribution = TowerDistribution(
+            users=self.dataset,
+            user_region=user_region,
+            cell_sites=TowerDistribution.stack(cell_sites),
+            cell_site_region=np.concatenate(cell_site_region),
+            base_stations=TowerDistribution.stack(results[tile]["base_stations"] for tile in tile_keys)
+        )
+        cell_site_tile = np.concatenate(cell_site_tile)
+
+        # every halo region votes for the region of the neighbouring tile that owns most of its users
+        halo_regions, halo_users = np.concatenate(halo_regions), np.concatenate(halo_users)
+        links, counts = np.unique(
+            np.column_stack((halo_regions, user_region[halo_users])), axis=0, return_counts=True
+        )
+        halo_sizes = np.bincount(links[:, 0], weights=counts, minlength=len(tower_distribution.base_stations))
+        merged_regions = []
+        for (halo_region, owner_region), count in zip(links, counts):
+            if 2 * count <= halo_sizes[halo_region]:
+                continue
+            source, target = tower_distribution.resolve(np.array([halo_region, owner_region]))
+            if source != target:
+                tower_distribution.merge_regions(source, target)
+                merged_regions.append(target)
+
+        # halo regions that were not merged keep no users and serve none
+        user_counts = np.bincount(tower_distribution.user_regions, minlength=len(tower_distribution.base_stations))
+        unserved = user_counts[tower_distribution.cell_site_regions] == 0
+        seam_duplicates = ~greedy_separation(tower_distribution.cell_sites, self.min_cell_site_distance, cell_site_tile)
+        tower_distribution.remove_cell_sites(np.flatnonzero(unserved | seam_duplicates))
+
+        merged_regions = np.unique(tower_distribution.resolve(np.asarray(merged_regions, dtype=np.intp)))
+        self.relocate_merged_base_stations(tower_distribution, merged_regions)
+
+        tower_distribution = tower_distribution.compacted()
+        served = np.bincount(tower_distribution.user_region, minlength=len(tower_distribution.base_stations)) > 0
+        new_ids = np.cumsum(served) - 1
+        tower_distribution = TowerDistribution(
+            users=tower_distribution.users,
+            user_region=new_ids[tower_distribution.user_region],
+            cell_sites=tower_distribution.cell_sites,
+            cell_site_region=new_ids[tower_distribution.cell_site_region],
+            base_stations=tower_distribution.base_stations[served]
+        )
+
+        self.logger.debug(
+            "Stitched " + str(len(tile_keys)) + " tiles into " + str(len(tower_distribution.base_stations)) +
+            " regions with " + str(len(merged_regions)) + " cross tile merges and " +
+            str(np.count_nonzero(seam_duplicates)) + " duplicate cell sites dropped along the seams"
+        )
+        return tower_distribution
+
+    @staticmethod
+    def relocate_merged_base_stations(tower_distribution, region_ids):
+        '''
+        Moves the base station of every region merged across tiles to the centroid of
+        its users and from there onto its closest cell site, as the optimizer places them
+        '''
+        user_groups = tower_distribution.group(tower_distribution.users, tower_distribution.user_regions, region_ids)
+        cell_site_groups = tower_distribution.group(
+            tower_distribution.cell_sites, tower_distribution.cell_site_regions, region_ids
+        )
+        for region_id, users, cell_sites in zip(region_ids, user_groups, cell_site_groups):
+            base_station = users.mean(axis=0)
+            if len(cell_sites):
+                base_station = cell_sites[np.argmin(np.linalg.norm(cell_sites - base_station, axis=1))]
+            tower_distribution.base_stations[region_id] = base_station
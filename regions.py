@@ -1,9 +1,13 @@
 import logging
 import numpy as np
-from sklearn.cluster import SpectralClustering
+from sklearn.cluster import SpectralClustering, KMeans
 from scipy.sparse import csgraph
+from scipy.sparse.linalg import eigsh, lobpcg, spilu, LinearOperator
 from numpy import linalg as LA
+from scipy import sparse
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import squareform, pdist
+from instrumentation import profiler
 
 class Regions:
     '''
@@ -11,8 +15,17 @@ class Regions:
     to identify different clusters of human settlements such as cities, towns and villages
     '''
     geo_cordinates = np.array([])
+    AFFINITIES = ("dense", "sparse")
+    EIGEN_SOLVERS = ("dense", "arpack", "lobpcg")
 
-    def __init__(self):
+    def __init__(self, affinity="dense", eigen_solver="dense"):
+        if affinity not in self.AFFINITIES:
+            raise ValueError("affinity must be one of " + ", ".join(self.AFFINITIES))
+        if eigen_solver not in self.EIGEN_SOLVERS:
+            raise ValueError("eigen solver must be one of " + ", ".join(self.EIGEN_SOLVERS))
+        self.affinity = affinity
+        self.eigen_solver = eigen_solver
+        self.eigenvectors = None
         self.logger = logging.getLogger("regions")
 
     def get_affinity_matrix(self, coordinates, k=7):
@@ -45,6 +58,45 @@ class Regions:
         np.fill_diagonal(affinity_matrix, 0)
         return affinity_matrix
 
+    def get_sparse_affinity_matrix(self, coordinates, k=7):
+        """
+        Sparse counterpart of get_affinity_matrix for large datasets.
+
+        Only the k nearest neighbours of every point are looked up with a KD-tree,
+        so the matrix holds O(n * k) entries instead of n * n. The local scale of
+        each point is the distance to its k-th neighbour, as in the dense version,
+        and the graph is symmetrised by keeping the larger of the two directed weights.
+            References:
+        https://papers.nips.cc/paper/2619-self-tuning-spectral-clustering.pdf
+        """
+        self.logger.debug("Building sparse affinity matrix")
+        n_points = len(coordinates)
+        k = min(k, n_points - 1)
+
+        # the query includes the point itself at distance 0, so the column k holds
+        # the same k-th nearest neighbour distance (sigma_i) as the dense version
+        knn_distances, knn_indices = cKDTree(coordinates).query(coordinates, k=k + 1)
+        local_scale = knn_distances[:, k]
+
+        rows = np.repeat(np.arange(n_points), k + 1)
+        cols = knn_indices.ravel()
+        distances = knn_distances.ravel()
+        not_self = rows != cols
+        rows, cols, distances = rows[not_self], cols[not_self], distances[not_self]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = -distances * distances / (local_scale[rows] * local_scale[cols])
+        # same handling of coincident points as the dense matrix
+        weights[np.isnan(weights)] = 0.0
+        weights = np.exp(weights)
+
+        affinity_matrix = sparse.csr_matrix((weights, (rows, cols)), shape=(n_points, n_points))
+        affinity_matrix = affinity_matrix.maximum(affinity_matrix.T).tocsr()
+        affinity_matrix.eliminate_zeros()
+
+        self.logger.debug("Affinity matrix has " + str(affinity_matrix.nnz) + " non zero entries")
+        return affinity_matrix
+
     def eigen_decomposition(self, A, topK=5):
         """
         :param A: Affinity matrix
@@ -67,7 +119,12 @@ class Regions:
         """
         self.logger.debug("Computing Eigen decompostion")
 
+        if self.eigen_solver != "dense":
+            return self.partial_eigen_decomposition(A, topK=topK)
+
         L = csgraph.laplacian(A, normed=True)
+        if sparse.issparse(L):
+            L = L.toarray()
         n_components = A.shape[0]
 
         # LM parameter : Eigenvalues with largest magnitude (eigs, eigsh), that is, largest eigenvalues in
@@ -83,13 +140,90 @@ class Regions:
         self.logger.debug("Eigen decomposition applied")
         return nb_clusters, eigenvalues
 
+    def partial_eigen_decomposition(self, A, topK=50):
+        '''
+        Computes only the topK smallest eigenpairs of the normalized laplacian
+        with an iterative solver instead of the full O(n^3) decomposition.
+        The eigenvectors are kept on the instance so that the spectral embedding
+        can reuse them instead of decomposing the laplacian a second time.
+        :param A: Affinity matrix, dense or scipy.sparse
+        :param topK: no of smallest eigenpairs to compute
+        :return: the optimal number of clusters by eigengap heuristic and the eigenvalues
+        '''
+        L, degree_sqrt = csgraph.laplacian(A, normed=True, return_diag=True)
+        if sparse.issparse(L):
+            L = L.tocsr()
+        n_points = L.shape[0]
+        topK = max(1, min(topK, n_points - 1))
+        random_state = np.random.RandomState(0)
+
+        if self.eigen_solver == "arpack":
+            # shift-invert around 1 on -L converges to the eigenvalues of L closest to 0
+            v0 = random_state.uniform(-1, 1, n_points)
+            eigenvalues, eigenvectors = eigsh(-L, k=topK, sigma=1.0, which="LM", v0=v0)
+            eigenvalues = -eigenvalues
+        else:
+            # incomplete LU of the slightly shifted laplacian as the preconditioner
+            shifted = sparse.csc_matrix(L) + 1e-5 * sparse.identity(n_points, format="csc")
+            incomplete_lu = spilu(shifted)
+            preconditioner = LinearOperator((n_points, n_points), matvec=incomplete_lu.solve)
+            initial_vectors = random_state.uniform(-1, 1, (n_points, topK))
+            eigenvalues, eigenvectors = lobpcg(
+                L, initial_vectors, M=preconditioner, tol=1e-5, largest=False, maxiter=2000
+            )
+
+        order = np.argsort(eigenvalues)
+        eigenvalues = eigenvalues[order]
+        self.eigenvectors = eigenvectors[:, order]
+        self.degree_sqrt = degree_sqrt
+
+        # Identify the optimal number of clusters as the index corresponding
+        # to the larger gap between eigen values
+        index_largest_gap = np.argmax(np.diff(eigenvalues))
+        nb_clusters = index_largest_gap + 1
+
+        self.logger.debug("Partial eigen decomposition applied with " + self.eigen_solver)
+        return nb_clusters, eigenvalues
+
+    def embed_and_cluster(self, n_clusters):
+        '''
+        Spectral embedding from the eigenvectors of partial_eigen_decomposition
+        followed by K-Means, the same steps SpectralClustering.fit performs
+        :param n_clusters: no of regions
+        :return: region label of every user
+        '''
+        embedding = self.eigenvectors[:, :n_clusters] / self.degree_sqrt[:, np.newaxis]
+
+        # deterministic sign of each eigenvector
+        max_abs_rows = np.argmax(np.abs(embedding), axis=0)
+        signs = np.sign(embedding[max_abs_rows, range(embedding.shape[1])])
+        embedding = embedding * signs
+
+        region_clustering = KMeans(n_clusters=n_clusters, random_state=0, n_init=10)
+        return region_clustering.fit_predict(embedding)
+
     def format_regions(self, labels, users):
+        '''
+        Groups the users by region label with a single stable argsort.
+        Each region is a contiguous slice of one sorted copy of the users, and
+        keeps its users in their original order.
+        :return: dict of label: users
+        '''
+        labels = np.asarray(labels)
+        order = np.argsort(labels, kind="mergesort")
+        region_labels, region_starts = np.unique(labels[order], return_index=True)
+        region_ends = np.append(region_starts[1:], len(order))
+
+        self.labels = labels
+        self.users = users
+        self.region_indices = dict()
+        sorted_users = users[order]
         regions = dict()
-        for region, datapoint in zip(labels, users):
-            if region in regions:
-                regions[region] = np.concatenate((regions[region], [datapoint]), axis=0)
-            else:
-                regions[region] = np.array([datapoint])
+        # regions are listed in the order of their first user, like the per point grouping did
+        for index in np.argsort(order[region_starts], kind="mergesort"):
+            region = region_labels[index]
+            self.region_indices[region] = order[region_starts[index]:region_ends[index]]
+            regions[region] = sorted_users[region_starts[index]:region_ends[index]]
 
         return regions
 
@@ -101,31 +235,45 @@ class Regions:
         '''
         self.logger.debug("Clustering settlements")
 
-        affinity_matrix = self.get_affinity_matrix(users, k=100)
+        with profiler.span("affinity", affinity=self.affinity, users=len(users)):
+            if self.affinity == "sparse":
+                affinity_matrix = self.get_sparse_affinity_matrix(users, k=100)
+            else:
+                affinity_matrix = self.get_affinity_matrix(users, k=100)
 
-        nb_clusters, eigenvalues = self.eigen_decomposition(affinity_matrix, topK=50)
+        with profiler.span("eigen_decomposition", eigen_solver=self.eigen_solver):
+            nb_clusters, eigenvalues = self.eigen_decomposition(affinity_matrix, topK=50)
 
         K = nb_clusters * 1 # Adjustment factor
         self.logger.debug("Optimal K for Region Clustering " + str(K))
 
-        region_clustering = SpectralClustering(n_clusters=K, random_state=0, affinity='precomputed')
-        region_clustering.fit(affinity_matrix)
+        with profiler.span("spectral_fit", n_clusters=int(K)):
+            if self.eigenvectors is not None:
+                labels = self.embed_and_cluster(K)
+            else:
+                region_clustering = SpectralClustering(n_clusters=K, random_state=0, affinity='precomputed')
+                region_clustering.fit(affinity_matrix)
+                labels = region_clustering.labels_
 
         # Explicitly deleting the affinity matrix due to mem leak issues
         del affinity_matrix
 
-        self.regions = self.format_regions(region_clustering.labels_, users)
+        self.regions = self.format_regions(labels, users)
 
         return self.regions
 
     def locate_base_stations_proximity(self):
-        self.base_stations = dict()
-        for region, users in self.regions.items():
-            base_station_location = np.array([
-                np.mean([user[0] for user in users]),
-                np.mean([user[1] for user in users])
-            ])
-
-            self.base_stations[region] = base_station_location
+        '''
+        Places each base station at the centroid of its region, all regions in one pass
+        :return: dict of label: base station
+        '''
+        region_labels, inverse, counts = np.unique(self.labels, return_inverse=True, return_counts=True)
+        centroids = np.column_stack([
+            np.bincount(inverse, weights=self.users[:, axis]) / counts
+            for axis in range(self.users.shape[1])
+        ])
+
+        centroid_of = dict(zip(region_labels, centroids))
+        self.base_stations = {region: centroid_of[region] for region in self.regions.keys()}
 
         return self.base_stations
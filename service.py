@@ -0,0 +1,623 @@
+'''
+Long running planning service. The daemon imports the pipeline once and keeps the
+datasets and the results of the pipeline stages in memory, least recently used first
+evicted, so repeated what-if jobs on the same dataset only redo the stages whose
+parameters changed. Jobs run concurrently on a thread pool and their log messages are
+streamed back as newline delimited JSON.
+
+API, JSON over HTTP on 127.0.0.1:8765 by default
+    GET  /health            service status and cache statistics
+    POST /jobs              {"type": "plan" | "cluster" | "optimize" | "evaluate" | "render", "parameters": {...}}
+    GET  /jobs/<id>         status, result or error of a job
+    GET  /jobs/<id>/events  progress events, streamed until the job ends
+
+The service has no authentication. It only binds to loopback addresses, answers only
+requests whose Host is a loopback name on its port, which a DNS rebinding page cannot
+send, takes jobs posted as application/json and resolves every path of a job inside its
+root directory.
+Only the standard library is imported up front, the client side stays cheap to load.
+
+USAGE: python3 cli.py serve [OPTIONS]
+'''
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import importlib
+import ipaddress
+import threading
+import collections
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+JOB_TYPES = ("plan", "cluster", "optimize", "evaluate", "render")
+# parameters of every job type that are paths, the service resolves them inside its root directory
+PATH_PARAMETERS = {
+    "plan": ("dataset", "output_json_file", "output_map_html_file", "report", "tiles", "profile", "cache_directory"),
+    "cluster": ("dataset", "output_json_file", "report", "cache_directory"),
+    "optimize": ("distribution", "output_json_file", "report"),
+    "evaluate": ("distribution", "report"),
+    "render": ("distribution", "output_map_html_file", "tiles")
+}
+
+# Host header names of the loopback addresses the service binds to
+LOOPBACK_HOSTS = ("localhost", "127.0.0.1", "[::1]")
+
+# pipeline stages serve() imports up front, the CLI imports them lazily
+WARM_UP_MODULES = (
+    "regions", "landmarks", "cellsites", "optimizer", "evaluator", "visualizer", "streaming", "partition"
+)
+
+class DatasetCache:
+    '''
+    Least recently used datasets read into memory, keyed by their path, size and
+    modification time so that a rewritten file is read again
+    '''
+    def __init__(self, max_datasets=4):
+        if max_datasets < 1:
+            raise ValueError("no of cached datasets must be atleast 1")
+        self.max_datasets = max_datasets
+        self.datasets = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("towersdistributor")
+
+    def read(self, dataset_filepath):
+        import numpy as np
+        from datahandler import DatasetReader
+
+        stat = os.stat(dataset_filepath)
+        key = (os.path.abspath(dataset_filepath), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.datasets:
+                self.datasets.move_to_end(key)
+                self.logger.debug("Dataset " + dataset_filepath + " is already in memory")
+                return self.datasets[key]
+
+        # the reader memory-maps cached datasets, a copy keeps them in memory for good
+        dataset = np.array(DatasetReader().read(dataset_filepath), dtype=float)
+        with self.lock:
+            self.datasets[key] = dataset
+            while len(self.datasets) > self.max_datasets:
+                self.datasets.popitem(last=False)
+        self.logger.debug("Read " + str(len(dataset)) + " users from " + dataset_filepath)
+        return dataset
+
+    def __len__(self):
+        return len(self.datasets)
+
+def plan(dataset, output_json_file, output_map_html_file, radiation_range=1000, min_towers=5, min_gap=400,
+         affinity="dense", eigen_solver="dense", engine="spectral", landmarks=500, projection=None, executor="thread",
+         workers=None, search="linear", minibatch_threshold=None, dedup=False, report=None, output_format="json",
+         stream=False, bucket_size=10000, partition=False, tile_size=20000, halo=None, cache_directory=None,
+         cache_size=1024, map_mode="auto", point_budget=50000, user_layer="heatmap", tiles=None, tile_max_zoom=15,
+         profile=None, profile_stage=None, no_map=False, display=True, log=True, stage_cache=None, datasets=None):
+    '''
+    The whole pipeline as run by cli.py distribute, the options keep their meaning
+    :param no_map: headless run, the map is neither drawn nor opened and folium is never imported
+    :param display: open the map in the default browser
+    :param stage_cache: stage cache used when no cache directory is given
+    :param datasets: DatasetCache to read the dataset through
+    :return: evaluation report
+    '''
+    from instrumentation import profiler
+
+    if radiation_range < 0:
+        raise ValueError("radiation range cannot be negative")
+    if min_towers < 0:
+        raise ValueError("min no of towers per cluster cannot be negative")
+    if min_gap < 0:
+        raise ValueError("min gap between cell sites cannot be negative")
+    if stream and partition:
+        raise ValueError("stream and partition modes cannot be combined")
+
+    settlement_clustering = dict(affinity=affinity, eigen_solver=eigen_solver, engine=engine, n_landmarks=landmarks)
+    cellsite_clustering = dict(
+        radiation_range=radiation_range, executor=executor, workers=workers,
+        search=search, minibatch_threshold=minibatch_threshold
+    )
+    optimization = dict(min_towers=min_towers, min_cell_site_distance=min_gap, deduplicate=dedup)
+    if profile is not None:
+        profiler.enable(profile_stage=profile_stage)
+
+    if stream:
+        from streaming import StreamingDistributor
+        distributor = StreamingDistributor(dataset, bucket_size=bucket_size, enable_logger=log, projection=projection)
+        distributor.distribute(
+            settlement_clustering=settlement_clustering, cellsite_clustering=cellsite_clustering,
+            optimization=optimization
+        )
+    elif partition:
+        from partition import PartitionedDistributor
+        distributor = PartitionedDistributor(
+            dataset, tile_size=tile_size, halo=halo, workers=workers, enable_logger=log, projection=projection
+        )
+        distributor.distribute(
+            settlement_clustering=settlement_clustering, cellsite_clustering=cellsite_clustering,
+            optimization=optimization
+        )
+    else:
+        distributor = clustered_distributor(
+            dataset, settlement_clustering, cellsite_clustering, projection=projection,
+            cache_directory=cache_directory, cache_size=cache_size, log=log, stage_cache=stage_cache, datasets=datasets
+        )
+        distributor.optimize(**optimization)
+
+    distributor.serialize_and_save_data(output_json_file, output_format=output_format)
+    if not no_map:
+        distributor.make_and_display_map(
+            output_map_html_file, mode=map_mode, point_budget=point_budget, user_layer=user_layer, display=display
+        )
+    if tiles is not None:
+        distributor.make_tiles(tiles, max_zoom=tile_max_zoom, workers=workers)
+
+    evaluation = distributor.evaluate(report_file=report)
+
+    if profile is not None:
+        profiler.dump(profile)
+        profiler.disable()
+    return evaluation
+
+def clustered_distributor(dataset, settlement_clustering, cellsite_clustering, projection=None, cache_directory=None,
+                          cache_size=1024, log=True, stage_cache=None, datasets=None):
+    '''
+    Runs the settlement and cell site clustering of a dataset
+    :return: TowersDistributor holding the unoptimized tower distribution
+    '''
+    from towersdistributor import TowersDistributor
+    from stagecache import StageCache
+
+    if cache_directory is not None:
+        stage_cache = StageCache(cache_directory, max_bytes=cache_size * 2 ** 20)
+    if datasets is not None:
+        distributor = TowersDistributor.from_dataset(datasets.read(dataset), enable_logger=log, projection=projection)
+        distributor.stage_cache = stage_cache
+    else:
+        distributor = TowersDistributor(dataset, enable_logger=log, stage_cache=stage_cache, projection=projection)
+
+    distributor.perform_settlement_clustering(**settlement_clustering)
+    distributor.perform_cellsite_clustering(**cellsite_clustering)
+
+    distributor.format()
+    return distributor
+
+def cluster(dataset, output_json_file, radiation_range=1000, affinity="dense", eigen_solver="dense", engine="spectral",
+            landmarks=500, projection=None, executor="thread", workers=None, search="linear", minibatch_threshold=None,
+            report=None, output_format="json", cache_directory=None, cache_size=1024, log=True, stage_cache=None,
+            datasets=None):
+    '''
+    Clusters a dataset into regions and cell sites and saves the distribution unoptimized,
+    the first step of cli.py cluster, optimize, evaluate and render
+    :return: evaluation report of the unoptimized distribution
+    '''
+    if radiation_range < 0:
+        raise ValueError("radiation range cannot be negative")
+
+    distributor = clustered_distributor(
+        dataset,
+        dict(affinity=affinity, eigen_solver=eigen_solver, engine=engine, n_landmarks=landmarks),
+        dict(
+            radiation_range=radiation_range, executor=executor, workers=workers,
+            search=search, minibatch_threshold=minibatch_threshold
+        ),
+        projection=projection, cache_directory=cache_directory, cache_size=cache_size, log=log,
+        stage_cache=stage_cache, datasets=datasets
+    )
+    distributor.serialize_and_save_data(output_json_file, output_format=output_format)
+    return distributor.evaluate(report_file=report)
+
+def restore_radiation_range(distributor, radiation_range=None):
+    '''
+    Sets the radiation range of a loaded distribution, JSON distributions are saved without it
+    :param radiation_range: in metres, defaults to the saved one, else to 1000 as in distribute
+    '''
+    if radiation_range is not None:
+        distributor.radiation_range = distributor.metres_to_geodistance(radiation_range)
+    elif not hasattr(distributor, "radiation_range"):
+        distributor.logger.warning("Distribution saved without its radiation range, evaluating with 1000 m")
+        distributor.radiation_range = distributor.metres_to_geodistance(1000)
+
+def optimize(distribution, output_json_file, min_towers=None, min_gap=None, dedup=False, report=None,
+             output_format="json", log=True, stage_cache=None, datasets=None):
+    '''
+    Optimizes a saved tower distribution, again with new min towers or min gap or for
+    the first time after cluster
+    :param min_towers: defaults to the saved one, else to 5 as in distribute
+    :param min_gap: in metres, defaults to the saved one, else to 400 as in distribute
+    :return: evaluation report
+    '''
+    from towersdistributor import TowersDistributor
+
+    distributor = TowersDistributor.from_distribution(distribution, enable_logger=log)
+    if min_towers is None:
+        min_towers = getattr(distributor, "min_towers", 5)
+    if min_gap is None:
+        min_gap = distributor.geodistance_to_metres(distributor.min_cell_site_distance) \
+            if hasattr(distributor, "min_cell_site_distance") else 400
+    restore_radiation_range(distributor)
+    distributor.optimize(min_towers=min_towers, min_cell_site_distance=min_gap, deduplicate=dedup)
+    distributor.serialize_and_save_data(output_json_file, output_format=output_format)
+    return distributor.evaluate(report_file=report)
+
+def evaluate(distribution, radiation_range=None, report=None, log=True, stage_cache=None, datasets=None):
+    '''
+    Evaluates a saved tower distribution
+    :param radiation_range: in metres, defaults to the one the distribution was built with
+    :return: evaluation report
+    '''
+    from towersdistributor import TowersDistributor
+
+    distributor = TowersDistributor.from_distribution(distribution, enable_logger=log)
+    restore_radiation_range(distributor, radiation_range)
+    return distributor.evaluate(report_file=report)
+
+def render(distribution, output_map_html_file, map_mode="auto", point_budget=50000, user_layer="heatmap", tiles=None,
+           tile_max_zoom=15, workers=None, display=True, log=True, stage_cache=None, datasets=None):
+    '''
+    Draws the map, and optionally the tile pyramid, of a saved tower distribution
+    :return: dict of the tile counts, None without tiles
+    '''
+    from towersdistributor import TowersDistributor
+
+    distributor = TowersDistributor.from_distribution(distribution, enable_logger=log)
+    distributor.make_and_display_map(
+        output_map_html_file, mode=map_mode, point_budget=point_budget, user_layer=user_layer, display=display
+    )
+    if tiles is not None:
+        return distributor.make_tiles(tiles, max_zoom=tile_max_zoom, workers=workers)
+
+JOBS = {"plan": plan, "cluster": cluster, "optimize": optimize, "evaluate": evaluate, "render": render}
+
+class Job:
+    '''
+    One job of the service with its progress events
+    '''
+    def __init__(self, job_type, parameters):
+        self.id = uuid.uuid4().hex[:12]
+        self.type = job_type
+        self.parameters = parameters
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.events = []
+        self.submitted = time.time()
+        self.condition = threading.Condition()
+
+    def emit(self, event, **fields):
+        with self.condition:
+            self.events.append(dict(fields, event=event, time=time.time() - self.submitted))
+            self.condition.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def as_dict(self):
+        return {
+            "id": self.id, "type": self.type, "status": self.status,
+            "result": self.result, "error": self.error, "events": len(self.events)
+        }
+
+class JobLogHandler(logging.Handler):
+    '''
+    Forwards the pipeline log messages of a job's thread to the job as progress events
+    '''
+    def __init__(self):
+        super().__init__(level=logging.DEBUG)
+        self.local = threading.local()
+
+    def emit(self, record):
+        job = getattr(self.local, "job", None)
+        if job is not None:
+            job.emit("log", logger=record.name, message=record.getMessage())
+
+class PlanningService:
+    '''
+    Runs the jobs on a thread pool against a warm dataset cache and in memory stage cache
+    '''
+    LOGGERS = ("towersdistributor", "regions", "cellsites", "optimizer", "visualizer", "evaluator", "stagecache")
+    # jobs that draw a map and would open it in a browser
+    MAP_JOBS = ("plan", "render")
+
+    def __init__(self, workers=2, cache_size=1024, max_datasets=4, max_jobs=256, root_directory="."):
+        '''
+        :param root_directory: jobs may only read and write paths inside it
+        '''
+        from stagecache import MemoryStageCache
+
+        if workers < 1:
+            raise ValueError("no of workers must be atleast 1")
+        if not os.path.isdir(root_directory):
+            raise ValueError("root directory " + root_directory + " does not exist")
+        self.root_directory = os.path.realpath(root_directory)
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.stage_cache = MemoryStageCache(max_bytes=cache_size * 2 ** 20)
+        self.datasets = DatasetCache(max_datasets=max_datasets)
+        self.max_jobs = max_jobs
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.logger = logging.getLogger("towersdistributor")
+
+        self.log_handler = JobLogHandler()
+        for name in self.LOGGERS:
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.DEBUG)
+            logger.addHandler(self.log_handler)
+
+    def submit(self, job_type, parameters):
+        if job_type not in JOBS:
+            raise ValueError("job type must be one of " + ", ".join(JOB_TYPES))
+        if parameters.get("profile") is not None:
+            raise ValueError("profiles of concurrent jobs would mix, profile without the service")
+        parameters = dict(parameters)
+        for name in PATH_PARAMETERS[job_type]:
+            if parameters.get(name) is not None:
+                parameters[name] = self.resolve_path(parameters[name])
+        job = Job(job_type, parameters)
+        with self.lock:
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, old_job in self.jobs.items() if old_job.finished]
+            for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+                del self.jobs[job_id]
+        self.pool.submit(self.run, job)
+        return job
+
+    def resolve_path(self, path):
+        '''
+        :return: real path of path, relative paths are taken from the root directory
+        '''
+        if not isinstance(path, str):
+            raise ValueError("paths must be strings")
+        path = os.path.realpath(os.path.join(self.root_directory, path))
+        if os.path.commonpath((path, self.root_directory)) != self.root_directory:
+            raise ValueError("path " + path + " is outside the service root " + self.root_directory)
+        return path
+
+    def run(self, job):
+        self.log_handler.local.job = job
+        job.status = "running"
+        job.emit("started", type=job.type)
+        start = time.time()
+        try:
+            # the service logs once for all jobs, a job must not reconfigure the logging,
+            # and the daemon never opens a browser, the client does
+            parameters = dict(job.parameters, log=False)
+            if job.type in self.MAP_JOBS:
+                parameters["display"] = False
+            job.result = JOBS[job.type](**parameters, stage_cache=self.stage_cache, datasets=self.datasets)
+            job.status = "done"
+        except Exception as error:
+            self.logger.exception("Job " + job.id + " failed")
+            job.error = type(error).__name__ + ": " + str(error)
+            job.status = "failed"
+        finally:
+            self.log_handler.local.job = None
+        job.emit("finished", status=job.status, seconds=time.time() - start)
+
+    def job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def health(self):
+        return {
+            "status": "ok", "pid": os.getpid(), "uptime": time.time() - self.started, "workers": self.workers,
+            "jobs": collections.Counter(job.status for job in list(self.jobs.values())),
+            "datasets": len(self.datasets),
+            "stage_cache": {
+                "entries": len(self.stage_cache.cache), "bytes": self.stage_cache.size(),
+                "hits": self.stage_cache.hits, "misses": self.stage_cache.misses,
+                "seconds_saved": self.stage_cache.seconds_saved
+            }
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        self.service.logger.debug("Service " + self.address_string() + " " + format % args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def allowed_host(self):
+        '''
+        A page served by a rebound DNS name reaches the service same origin, but its
+        requests still carry that name in the Host header
+        :return: whether the Host header is a loopback name on the port of the service
+        '''
+        host = self.headers.get("Host", "").strip().lower()
+        if ":" in host and not host.endswith("]"):
+            name, _, port = host.rpartition(":")
+        else:
+            # no port, the http default
+            name, port = host, "80"
+        return name in LOOPBACK_HOSTS and port == str(self.server.server_address[1])
+
+    def route(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        job = self.service.job(parts[1]) if len(parts) > 1 and parts[0] == "jobs" else None
+        return parts, job
+
+    def do_GET(self):
+        if not self.allowed_host():
+            return self.send_json(403, {"error": "host not allowed"})
+        parts, job = self.route()
+        if parts == ["health"]:
+            return self.send_json(200, self.service.health())
+        if job is None:
+            return self.send_json(404, {"error": "not found"})
+        if len(parts) == 2:
+            return self.send_json(200, job.as_dict())
+        if len(parts) == 3 and parts[2] == "events":
+            return self.stream_events(job)
+        return self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self.allowed_host():
+            # the body is left unread, the connection cannot be reused
+            self.close_connection = True
+            return self.send_json(403, {"error": "host not allowed"})
+        parts, _ = self.route()
+        if parts != ["jobs"]:
+            return self.send_json(404, {"error": "not found"})
+        # a browser page may only send text/plain or form bodies without a CORS preflight,
+        # which this service never answers, so JSON bodies come from real clients only
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            # the body is left unread, the connection cannot be reused
+            self.close_connection = True
+            return self.send_json(415, {"error": "jobs must be posted as application/json"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.service.submit(request.get("type"), request.get("parameters") or dict())
+        except (ValueError, AttributeError) as error:
+            return self.send_json(400, {"error": str(error)})
+        self.send_json(202, job.as_dict())
+
+    def stream_events(self, job):
+        '''
+        Sends the events of the job as newline delimited JSON chunks until it ends
+        '''
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        sent = 0
+        while True:
+            with job.condition:
+                while sent == len(job.events) and not job.finished:
+                    job.condition.wait(timeout=1)
+                events = job.events[sent:]
+                finished = job.finished and sent + len(events) == len(job.events)
+            sent += len(events)
+            if events:
+                chunk = "".join(json.dumps(event, default=str) + "\n" for event in events).encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            if finished:
+                break
+        self.wfile.write(b"0\r\n\r\n")
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+def serve(host="127.0.0.1", port=8765, workers=2, cache_size=1024, max_datasets=4, root_directory=".", log=True):
+    '''
+    Runs the planning service until interrupted. The pipeline is imported here, once.
+    The service has no authentication, it only listens on loopback addresses.
+    :param root_directory: jobs may only read and write paths inside it
+    '''
+    if not is_loopback(host):
+        raise ValueError("the service has no authentication, host must be a loopback address")
+
+    import logging.config
+    from towersdistributor import TowersDistributor
+
+    # the pipeline imports lazily, warm every stage up once so that no job pays for it
+    for module in WARM_UP_MODULES:
+        importlib.import_module(module)
+
+    if log:
+        if not os.path.isdir("logs"):
+            os.mkdir("logs")
+        logging.config.dictConfig(TowersDistributor.LOGGING)
+    service = PlanningService(
+        workers=workers, cache_size=cache_size, max_datasets=max_datasets, root_directory=root_directory
+    )
+    server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    service.logger.info(
+        "Planning service listening on http://" + host + ":" + str(port) + ", serving " + service.root_directory
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+class ServiceClient:
+    '''
+    Client of the planning service
+    '''
+    def __init__(self, url=DEFAULT_URL, timeout=None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, path, body=None, timeout=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(
+            self.url + path, data=data, headers={"Content-Type": "application/json"} if data else dict()
+        )
+        return urllib.request.urlopen(request, timeout=timeout or self.timeout)
+
+    def available(self, timeout=0.5):
+        '''
+        :return: whether a service answers at the url
+        '''
+        try:
+            with self.request("/health", timeout=timeout) as response:
+                return response.status == 200
+        except (OSError, ValueError):
+            return False
+
+    def submit(self, job_type, parameters):
+        '''
+        :return: dict of the submitted job, with its id
+        '''
+        try:
+            with self.request("/jobs", {"type": job_type, "parameters": parameters}) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as error:
+            raise ValueError(json.load(error).get("error", str(error)))
+
+    def events(self, job_id):
+        '''
+        :return: generator of the progress events of the job until it ends
+        '''
+        with self.request("/jobs/" + job_id + "/events") as response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+
+    def job(self, job_id):
+        with self.request("/jobs/" + job_id) as response:
+            return json.load(response)
+
+    def run(self, job_type, parameters, on_event=None):
+        '''
+        Submits a job and waits for it, passing every progress event to on_event
+        :return: the job's result
+        '''
+        job = self.submit(job_type, parameters)
+        for event in self.events(job["id"]):
+            if on_event is not None:
+                on_event(event)
+        job = self.job(job["id"])
+        if job["status"] != "done":
+            raise RuntimeError(job["error"])
+        return job["result"]
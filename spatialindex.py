@@ -0,0 +1,147 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+class BaseStationIndex:
+    '''
+    KD-tree over the base stations of a tower distribution that supports deleting
+    merged regions. Deleted entries are skipped at query time and the tree is rebuilt
+    once more than half of its entries are deleted.
+    '''
+    def __init__(self, base_stations, region_ids):
+        self.base_stations = base_stations
+        self.build(np.asarray(region_ids))
+
+    def build(self, region_ids):
+        self.region_ids = region_ids
+        self.alive = np.ones(len(region_ids), dtype=bool)
+        self.position = {region_id: position for position, region_id in enumerate(region_ids)}
+        self.tree = cKDTree(self.base_stations[region_ids]) if len(region_ids) else None
+        self.deleted = 0
+
+    def __len__(self):
+        return len(self.region_ids) - self.deleted
+
+    def remove(self, region_id):
+        self.alive[self.position.pop(region_id)] = False
+        self.deleted += 1
+        if self.deleted > len(self.region_ids) // 2:
+            self.build(self.region_ids[self.alive])
+
+    def nearest(self, region_id):
+        '''
+        Finds the region with the closest base station, ties going to the smallest region id
+        :param region_id: region whose neighbour is searched, itself excluded
+        :return: id of the nearest region or None if it is the only one left
+        '''
+        if len(self) < 2:
+            return None
+        location = self.base_stations[region_id]
+        n_points = len(self.region_ids)
+        k = 8
+        while True:
+            k = min(k, n_points)
+            distances, positions = self.tree.query(location, k=k)
+            distances, positions = np.atleast_1d(distances), np.atleast_1d(positions)
+            candidates = self.alive[positions] & (self.region_ids[positions] != region_id)
+            if candidates.any():
+                closest = distances[candidates].min()
+                # a farther last neighbour means no equally close region was cut off
+                if k == n_points or distances[-1] > closest:
+                    return self.region_ids[positions[candidates & (distances == closest)]].min()
+            k *= 2
+
+class SpatialGrid:
+    '''
+    Spatial hash grid whose cells are as wide as the search distance, so every point
+    within that distance of a query lies in one of the 3 x 3 cells around it.
+    All queries are answered in one vectorized pass over the candidate pairs.
+    '''
+    NEIGHBOUR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+    # below this many query x point pairs all distances are cheaper than hashing
+    BRUTE_FORCE_PAIRS = 4096
+
+    def __init__(self, points, distance):
+        if distance < 0:
+            raise ValueError("distance cannot be negative")
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.distance = distance
+        self.sorted_keys = None
+
+    def build(self):
+        point_keys = self.keys(self.cells(self.points))
+        self.order = np.argsort(point_keys, kind="mergesort")
+        self.sorted_keys = point_keys[self.order]
+
+    def cells(self, points):
+        return np.floor(points / self.distance).astype(np.int64)
+
+    @staticmethod
+    def keys(cells):
+        return cells[:, 0] * (1 << 32) + cells[:, 1]
+
+    def query_pairs(self, queries):
+        '''
+        Finds every (query, point) pair closer than the grid distance
+        :param queries: array of query coordinates
+        :return: tuple of query indices and point indices
+        '''
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        if self.distance <= 0 or not len(queries) or not len(self.points):
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+        if len(queries) * len(self.points) <= self.BRUTE_FORCE_PAIRS:
+            differences = queries[:, np.newaxis, :] - self.points[np.newaxis, :, :]
+            return np.nonzero(np.sqrt((differences ** 2).sum(axis=2)) < self.distance)
+
+        if self.sorted_keys is None:
+            self.build()
+        query_cells = self.cells(queries)
+        query_indices, point_indices = [], []
+        for dx, dy in self.NEIGHBOUR_OFFSETS:
+            neighbour_keys = self.keys(query_cells + (dx, dy))
+            starts = np.searchsorted(self.sorted_keys, neighbour_keys, side="left")
+            counts = np.searchsorted(self.sorted_keys, neighbour_keys, side="right") - starts
+            total = counts.sum()
+            if not total:
+                continue
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            query_indices.append(np.repeat(np.arange(len(queries)), counts))
+            point_indices.append(self.order[np.repeat(starts, counts) + offsets])
+
+        if not query_indices:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        query_indices = np.concatenate(query_indices)
+        point_indices = np.concatenate(point_indices)
+        distances = np.linalg.norm(queries[query_indices] - self.points[point_indices], axis=1)
+        within_range = distances < self.distance
+        return query_indices[within_range], point_indices[within_range]
+
+    def any_within(self, queries):
+        '''
+        :return: boolean mask of the queries that have a point closer than the grid distance
+        '''
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        query_indices, _ = self.query_pairs(queries)
+        within_range = np.zeros(len(queries), dtype=bool)
+        within_range[query_indices] = True
+        return within_range
+
+def greedy_separation(points, distance, groups=None):
+    '''
+    Keeps points in order, dropping every point closer than distance to an earlier kept one
+    :param groups: optional group of every point, points of the same group never conflict
+    :return: boolean mask of the kept points
+    '''
+    first, second = SpatialGrid(points, distance).query_pairs(points)
+    conflicts = first < second
+    if groups is not None:
+        groups = np.asarray(groups)
+        conflicts &= groups[first] != groups[second]
+    first, second = first[conflicts], second[conflicts]
+
+    kept = np.ones(len(points), dtype=bool)
+    # a point's fate only depends on earlier points, which are settled when pairs go by the later point
+    for index in np.lexsort((first, second)):
+        if kept[first[index]]:
+            kept[second[index]] = False
+    return kept
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import threading
+import collections
+import numpy as np
+
+class StageCache:
+    '''
+    On disk cache of pipeline stage results, content addressed by a hash of the
+    dataset and of the parameters every stage depends on. Entries are evicted least
+    recently used first once the cache grows past max_bytes.
+    '''
+    VERSION = 1
+    SUFFIX = ".stage.pkl"
+
+    def __init__(self, directory=".stagecache", max_bytes=2 ** 30):
+        if max_bytes <= 0:
+            raise ValueError("cache size must be positive")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.
+        self.logger = logging.getLogger("stagecache")
+
+    @staticmethod
+    def hash_array(array):
+        array = np.ascontiguousarray(array)
+        digest = hashlib.sha256(str((array.dtype.str, array.shape)).encode())
+        digest.update(memoryview(array).cast("B"))
+        return digest.hexdigest()
+
+    @classmethod
+    def key(cls, stage, upstream, parameters):
+        '''
+        :param stage: name of the stage
+        :param upstream: key of the stage it consumes, or the dataset hash
+        :param parameters: dict of the parameters that change the stage's result
+        :return: hex digest identifying the stage result
+        '''
+        description = json.dumps(
+            {"version": cls.VERSION, "stage": stage, "upstream": upstream, "parameters": parameters},
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def filepath(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def fetch(self, stage, key, compute):
+        '''
+        Returns the cached result of a stage, computing and storing it on a miss
+        :param compute: function without arguments that computes the stage
+        '''
+        filepath = self.filepath(key)
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, "rb") as entry:
+                    seconds, value = pickle.load(entry)
+                os.utime(filepath)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                self.logger.debug("Dropping unreadable " + stage + " entry " + key[:12])
+                self.remove(filepath)
+            else:
+                self.hits += 1
+                self.seconds_saved += seconds
+                self.logger.debug("Cache hit for " + stage + " " + key[:12] + ", saved " + "%.3f" % seconds + " s")
+                return value
+
+        start = time.time()
+        value = compute()
+        seconds = time.time() - start
+        self.misses += 1
+        self.logger.debug("Cache miss for " + stage + " " + key[:12] + ", computed in " + "%.3f" % seconds + " s")
+        self.store(filepath, seconds, value)
+        return value
+
+    def store(self, filepath, seconds, value):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            temporary_filepath = filepath + ".tmp"
+            with open(temporary_filepath, "wb") as entry:
+                pickle.dump((seconds, value), entry, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_filepath, filepath)
+        except OSError:
+            # an unwritable cache directory only costs the caching
+            return
+        self.evict()
+
+    def entries(self):
+        '''
+        :return: list of (last use time, size, path) of the cache entries, oldest first
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(self.SUFFIX):
+                continue
+            filepath = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filepath))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in max_bytes
+        :return: no of entries removed
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, filepath in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(filepath)
+            total -= size
+            removed += 1
+        if removed:
+            self.logger.debug("Evicted " + str(removed) + " cache entries")
+        return removed
+
+    def remove(self, filepath):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+    def clear(self):
+        for _, _, filepath in self.entries():
+            self.remove(filepath)
+
+class MemoryStageCache(StageCache):
+    '''
+    In memory counterpart of StageCache for long running processes. Entries are kept
+    pickled, so every fetch hands out a fresh copy that the pipeline may modify, and
+    are evicted least recently used first once they take more than max_bytes.
+    '''
+    def __init__(self, max_bytes=2 ** 30):
+        super().__init__(directory=None, max_bytes=max_bytes)
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def fetch(self, stage, key, compute):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+        if entry is not None:
+            seconds, payload = entry
+            self.hits += 1
+            self.seconds_saved += seconds
+            self.logger.debug("Cache hit for " + stage + " " + key[:12] + ", saved " + "%.3f" % seconds + " s")
+            return pickle.loads(payload)
+
+        start = time.time()
+        value = compute()
+        seconds = time.time() - start
+        self.misses += 1
+        self.logger.debug("Cache miss for " + stage + " " + key[:12] + ", computed in " + "%.3f" % seconds + " s")
+        self.store(key, seconds, value)
+        return value
+
+    def store(self, key, seconds, value):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.cache[key] = (seconds, payload)
+            self.cache.move_to_end(key)
+        self.evict()
+
+    def entries(self):
+        with self.lock:
+            return [(None, len(payload), key) for key, (_, payload) in self.cache.items()]
+
+    def evict(self):
+        removed = 0
+        with self.lock:
+            total = sum(len(payload) for _, payload in self.cache.values())
+            while total > self.max_bytes and len(self.cache) > 1:
+                _, (_, payload) = self.cache.popitem(last=False)
+                total -= len(payload)
+                removed += 1
+        if removed:
+            self.logger.debug("Evicted " + str(removed) + " cache entries")
+        return removed
+
+    def remove(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
@@ -0,0 +1,234 @@
+import os
+import glob
+import json
+import shutil
+import tempfile
+import numpy as np
+from towersdistributor import TowersDistributor
+from towerdistribution import TowerDistribution
+from datahandler import DatasetReader, Serializer, Deserializer
+
+class StreamingDistributor(TowersDistributor):
+    '''
+    Out of core mode of TowersDistributor for datasets that do not fit in memory.
+    The CSV is read in blocks and spilled to one file per geographic grid bucket in a
+    single pass. Every bucket then runs the whole pipeline on its own and its result is
+    written into one memory-mapped tower distribution, so peak memory follows the
+    largest bucket instead of the whole dataset.
+
+    Buckets are independent: regions never span two buckets and the per bucket
+    evaluation only counts the cell sites of the bucket itself. With a projection
+    every bucket is projected around its own centre.
+
+    Without a spill directory a temporary one is used and removed once the combined
+    distribution has been saved elsewhere, or when the run fails.
+    '''
+    def __init__(self, dataset_filepath, bucket_size=10000, spill_directory=None,
+                 block_size=64 * 2 ** 20, min_bucket_users=200, enable_logger=True, projection=None):
+        self.configure_logging(enable_logger)
+        if min_bucket_users < 1:
+            raise ValueError("min users per bucket must be atleast 1")
+        self.dataset_filepath = dataset_filepath
+        self.bucket_size = self.metres_to_geodistance(bucket_size)
+        if self.bucket_size == 0:
+            raise ValueError("bucket size must be positive")
+        self.block_size = block_size
+        self.min_bucket_users = min_bucket_users
+        self.bucket_projection = projection
+        self.temporary_spill = spill_directory is None
+        self.spill_directory = spill_directory or tempfile.mkdtemp(prefix="towersdistributor-")
+        self.bucket_counts = dict()
+
+    def bucket_filepath(self, bucket):
+        return os.path.join(self.spill_directory, "bucket_%d_%d.bin" % bucket)
+
+    def partition(self):
+        '''
+        Single pass over the dataset that appends every user to the raw float64
+        file of its grid bucket
+        :return: dict of bucket: no of users
+        '''
+        self.logger.debug("Partitioning dataset into buckets of " + str(self.bucket_size) + " degrees")
+        if not os.path.isdir(self.spill_directory):
+            os.makedirs(self.spill_directory)
+        # bucket files are appended to, a reused spill directory must not add an earlier run's users
+        for bucket_filepath in glob.glob(os.path.join(self.spill_directory, "bucket_*.bin")):
+            os.remove(bucket_filepath)
+
+        dataset_reader = DatasetReader(block_size=self.block_size, cache=False)
+        self.bucket_counts = dict()
+        for block in dataset_reader.iter_blocks(self.dataset_filepath):
+            dataset_reader.validate(block)
+            cells = np.floor(block / self.bucket_size).astype(np.int64)
+            buckets, inverse = np.unique(cells, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            order = np.argsort(inverse, kind="mergesort")
+            bounds = np.searchsorted(inverse[order], np.arange(len(buckets) + 1))
+
+            for index, bucket in enumerate(map(tuple, buckets)):
+                with open(self.bucket_filepath(bucket), "ab") as bucket_file:
+                    block[order[bounds[index]:bounds[index + 1]]].tofile(bucket_file)
+                self.bucket_counts[bucket] = self.bucket_counts.get(bucket, 0) + bounds[index + 1] - bounds[index]
+
+        self.logger.debug(
+            "Spilled " + str(sum(self.bucket_counts.values())) + " users into " + str(len(self.bucket_counts)) +
+            " buckets, largest has " + str(max(self.bucket_counts.values(), default=0)) + " users"
+        )
+        return self.bucket_counts
+
+    def read_bucket(self, bucket):
+        return np.fromfile(self.bucket_filepath(bucket), dtype=float).reshape(-1, 2)
+
+    def distribute_bucket(self, users, settlement_clustering, cellsite_clustering, optimization):
+        '''
+        Runs the whole pipeline on the users of a single bucket
+        :return: the bucket's TowersDistributor after evaluation
+        '''
+        distributor = TowersDistributor.from_dataset(users, projection=self.bucket_projection)
+        if len(users) < self.min_bucket_users:
+            # too sparse to find settlements in, the bucket becomes a single region
+            distributor.regions = {0: distributor.points}
+            distributor.base_stations = {0: distributor.points.mean(axis=0)}
+        else:
+            distributor.perform_settlement_clustering(**settlement_clustering)
+        distributor.perform_cellsite_clustering(**cellsite_clustering)
+        distributor.format()
+        distributor.optimize(**optimization)
+        distributor.evaluate()
+        return distributor
+
+    def distribute(self, output_directory=None, settlement_clustering=None, cellsite_clustering=None, optimization=None):
+        '''
+        Partitions the dataset and distributes the towers bucket by bucket
+        :param output_directory: binary distribution directory for the combined result
+        :param settlement_clustering: keyword arguments of perform_settlement_clustering
+        :param cellsite_clustering: keyword arguments of perform_cellsite_clustering
+        :param optimization: keyword arguments of optimize
+        :return: the combined TowerDistribution, memory-mapped from output_directory
+        '''
+        settlement_clustering = settlement_clustering or dict()
+        cellsite_clustering = cellsite_clustering or dict()
+        optimization = optimization or dict()
+        output_directory = output_directory or os.path.join(self.spill_directory, "distribution")
+
+        try:
+            tower_distribution = self.distribute_buckets(
+                output_directory, settlement_clustering, cellsite_clustering, optimization
+            )
+        except BaseException:
+            self.remove_spill_directory()
+            raise
+        spill_directory = os.path.abspath(self.spill_directory)
+        if os.path.commonpath((os.path.abspath(output_directory), spill_directory)) != spill_directory:
+            self.remove_spill_directory()
+        return tower_distribution
+
+    def distribute_buckets(self, output_directory, settlement_clustering, cellsite_clustering, optimization):
+        self.partition()
+        bucket_directories = []
+        covered_users = 0
+        for bucket, user_count in sorted(self.bucket_counts.items()):
+            self.logger.debug("Distributing bucket " + str(bucket) + " with " + str(user_count) + " users")
+            distributor = self.distribute_bucket(
+                self.read_bucket(bucket), settlement_clustering, cellsite_clustering, optimization
+            )
+            covered_users += distributor.evaluation['coverage'] * user_count / 100
+
+            bucket_directory = os.path.join(self.spill_directory, "bucket_%d_%d" % bucket)
+            Serializer(distributor.geographic_distribution()).save_arrays(bucket_directory)
+            bucket_directories.append(bucket_directory)
+            os.remove(self.bucket_filepath(bucket))
+
+            # the combined distribution is in degrees whatever the buckets were clustered in
+            self.radiation_range = self.metres_to_geodistance(
+                distributor.geodistance_to_metres(distributor.radiation_range)
+            )
+            self.min_towers = distributor.min_towers
+            self.min_cell_site_distance = self.metres_to_geodistance(
+                distributor.geodistance_to_metres(distributor.min_cell_site_distance)
+            )
+            del distributor
+
+        self.tower_distribution = self.combine(bucket_directories, output_directory)
+        self.logger.debug(
+            "Streaming coverage = " + str(covered_users * 100 / max(len(self.tower_distribution.users), 1)) + " %"
+        )
+        return self.tower_distribution
+
+    def serialize_and_save_data(self, output_JSON_file, output_format="json"):
+        super().serialize_and_save_data(output_JSON_file, output_format=output_format)
+        # the combined distribution is saved elsewhere now, the spill directory is no longer needed
+        if self.temporary_spill and os.path.isdir(self.spill_directory):
+            if os.path.isdir(output_JSON_file):
+                self.tower_distribution = Deserializer().load_arrays(output_JSON_file)
+            else:
+                self.tower_distribution = self.in_memory(self.tower_distribution)
+            self.remove_spill_directory()
+
+    @staticmethod
+    def in_memory(tower_distribution):
+        '''
+        :return: copy of a memory-mapped TowerDistribution that no longer reads its files
+        '''
+        copy = TowerDistribution(
+            users=np.array(tower_distribution.users), user_region=np.array(tower_distribution.user_region),
+            cell_sites=np.array(tower_distribution.cell_sites),
+            cell_site_region=np.array(tower_distribution.cell_site_region),
+            base_stations=np.array(tower_distribution.base_stations)
+        )
+        copy.region_map = np.array(tower_distribution.region_map)
+        return copy
+
+    def remove_spill_directory(self):
+        if self.temporary_spill:
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+
+    def combine(self, bucket_directories, output_directory):
+        '''
+        Concatenates the bucket distributions into one binary distribution written
+        through memory maps, one bucket at a time, with region ids offset per bucket
+        :return: the combined TowerDistribution
+        '''
+        manifests = []
+        for bucket_directory in bucket_directories:
+            with open(os.path.join(bucket_directory, Serializer.MANIFEST)) as manifest_file:
+                manifests.append(json.load(manifest_file))
+
+        if not os.path.isdir(output_directory):
+            os.makedirs(output_directory)
+        combined = dict()
+        for name in Serializer.ARRAYS:
+            lengths = [manifest["arrays"][name]["shape"][0] for manifest in manifests]
+            shape = [sum(lengths)] + (manifests[0]["arrays"][name]["shape"][1:] if manifests else [2])
+            dtype = manifests[0]["arrays"][name]["dtype"] if manifests else "float64"
+            combined[name] = np.lib.format.open_memmap(
+                os.path.join(output_directory, name + ".npy"), mode="w+", dtype=dtype, shape=tuple(shape)
+            )
+
+        offsets = dict((name, 0) for name in Serializer.ARRAYS)
+        region_offset = 0
+        for bucket_directory in bucket_directories:
+            bucket_distribution = Deserializer().load_arrays(bucket_directory)
+            for name in Serializer.ARRAYS:
+                array = getattr(bucket_distribution, name)
+                if name in ("user_region", "cell_site_region"):
+                    array = array + region_offset
+                combined[name][offsets[name]:offsets[name] + len(array)] = array
+                offsets[name] += len(array)
+            region_offset += len(bucket_distribution.base_stations)
+            del bucket_distribution
+            shutil.rmtree(bucket_directory)
+
+        # every bucket is saved grouped by region and region ids only grow from bucket to bucket
+        manifest = {
+            "format": "towersdistributor", "version": 1, "arrays": dict(), "metadata": dict(),
+            "grouped_users": offsets["users"]
+        }
+        for name, array in combined.items():
+            array.flush()
+            manifest["arrays"][name] = {"file": name + ".npy", "dtype": str(array.dtype), "shape": list(array.shape)}
+        del combined
+        with open(os.path.join(output_directory, Serializer.MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+        return Deserializer().load_arrays(output_directory)
@@ -0,0 +1,172 @@
+import os
+import csv
+import time
+import heapq
+import logging
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from cellsites import CellSites, limit_blas_threads
+from optimizer import Optimizer
+from evaluator import Evaluator
+from towerdistribution import TowerDistribution
+
+def region_chunks(regions, n_chunks):
+    '''
+    Splits the regions into chunks of about the same no of users, largest regions first
+    :return: list of non empty dicts of label: users
+    '''
+    chunks = [dict() for _ in range(n_chunks)]
+    chunk_sizes = [(0, index) for index in range(n_chunks)]
+    for label, users in sorted(regions.items(), key=lambda item: len(item[1]), reverse=True):
+        size, index = heapq.heappop(chunk_sizes)
+        chunks[index][label] = users
+        heapq.heappush(chunk_sizes, (size + len(users), index))
+    return [chunk for chunk in chunks if chunk]
+
+def cell_site_clustering_task(regions, radiation_range, search, minibatch_threshold, distortion_scale=1):
+    '''
+    Clusters the cell sites of a chunk of regions for one radiation range, runs inside the pool
+    :return: tuple of radiation range, cell sites and seconds taken
+    '''
+    start = time.time()
+    cellsite_clustering = CellSites(
+        radiation_range=radiation_range, executor="thread", workers=1,
+        search=search, minibatch_threshold=minibatch_threshold, distortion_scale=distortion_scale
+    )
+    cell_sites = cellsite_clustering.distribute_cellsites(regions)
+    return radiation_range, cell_sites, time.time() - start
+
+def optimization_task(tower_distribution, radiation_range, min_towers, min_cell_site_distance, merge, deduplicate):
+    '''
+    Optimizes and evaluates one configuration, runs inside the pool
+    :return: dict of the evaluation figures and the seconds taken by each step
+    '''
+    start = time.time()
+    region = Optimizer(
+        min_towers=min_towers, min_cell_site_distance=min_cell_site_distance, merge=merge, deduplicate=deduplicate
+    )
+    tower_distribution = region.optimize(tower_distribution)
+    optimize_seconds = time.time() - start
+
+    start = time.time()
+    users, cell_sites, coverage = Evaluator(radiation_range=radiation_range).evaluate(tower_distribution)
+    return {
+        'regions': len(tower_distribution),
+        'users': users,
+        'cell_sites': cell_sites,
+        'coverage': float(coverage),
+        'optimize_seconds': optimize_seconds,
+        'evaluate_seconds': time.time() - start
+    }
+
+class ParameterSweep:
+    '''
+    Runs the pipeline for every combination of radiation range, min towers and min gap.
+    Settlement clustering runs once, cell sites once per radiation range and the
+    optimizer and evaluator once per configuration, all fanned out over a process pool.
+    The cell sites of a radiation range are clustered in chunks of regions, so that a
+    sweep over a single radiation range still keeps every worker busy.
+    '''
+    COLUMNS = (
+        "radiation_range", "min_towers", "min_gap", "regions", "users", "cell_sites", "coverage",
+        "cellsite_seconds", "optimize_seconds", "evaluate_seconds", "seconds"
+    )
+    # region chunks per worker, more chunks balance uneven regions better at more pickling
+    CHUNKS_PER_WORKER = 4
+
+    def __init__(self, distributor, workers=None):
+        if workers is not None and workers < 1:
+            raise ValueError("no of workers must be atleast 1")
+        self.distributor = distributor
+        self.workers = workers or os.cpu_count() or 1
+        self.logger = logging.getLogger("towersdistributor")
+
+    def run(self, radiation_ranges, min_towers, min_gaps, settlement_clustering=None,
+            search="linear", minibatch_threshold=None, merge="heap", deduplicate=False):
+        '''
+        :param radiation_ranges: radiation ranges to try(in metres)
+        :param min_towers: min no of towers per region to try
+        :param min_gaps: min distances between cell sites to try(in metres)
+        :param settlement_clustering: keyword arguments of perform_settlement_clustering
+        :return: list of result rows, one dict per configuration
+        '''
+        distributor = self.distributor
+        for radiation_range in radiation_ranges:
+            if radiation_range < 0:
+                raise ValueError("radiation range cannot be negative")
+        for min_towers_per_region in min_towers:
+            if min_towers_per_region < 0:
+                raise ValueError("min no of towers per cluster cannot be negative")
+        for min_gap in min_gaps:
+            if min_gap < 0:
+                raise ValueError("min gap between cell sites cannot be negative")
+
+        distributor.perform_settlement_clustering(**(settlement_clustering or dict()))
+        regions, base_stations = distributor.regions, distributor.base_stations
+        configurations = list(itertools.product(radiation_ranges, min_towers, min_gaps))
+        self.logger.debug(
+            "Sweeping " + str(len(configurations)) + " configurations over " + str(len(regions)) +
+            " regions on " + str(self.workers) + " workers"
+        )
+
+        threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=limit_blas_threads, initargs=(threads_per_worker,)
+        )
+        self.rows = []
+        chunks = region_chunks(regions, max(1, -(-self.CHUNKS_PER_WORKER * self.workers // len(radiation_ranges))))
+        with pool:
+            cell_site_tasks = [
+                [
+                    pool.submit(
+                        cell_site_clustering_task, chunk, distributor.metres_to_geodistance(radiation_range),
+                        search, minibatch_threshold, distributor.distortion_scale()
+                    )
+                    for chunk in chunks
+                ]
+                for radiation_range in radiation_ranges
+            ]
+            tower_distributions, cellsite_seconds = dict(), dict()
+            for radiation_range, tasks in zip(radiation_ranges, cell_site_tasks):
+                cell_sites, seconds = dict(), 0.
+                for task in tasks:
+                    _, chunk_cell_sites, chunk_seconds = task.result()
+                    cell_sites.update(chunk_cell_sites)
+                    seconds += chunk_seconds
+                tower_distributions[radiation_range] = TowerDistribution.from_regions(regions, cell_sites, base_stations)
+                cellsite_seconds[radiation_range] = seconds
+                self.logger.debug(
+                    "Cell sites for " + str(radiation_range) + " m took " + "%.3f" % seconds + " s over " +
+                    str(len(tasks)) + " region chunks"
+                )
+
+            optimization_tasks = [
+                pool.submit(
+                    optimization_task, tower_distributions[radiation_range],
+                    distributor.metres_to_geodistance(radiation_range), min_towers_per_region,
+                    distributor.metres_to_geodistance(min_gap), merge, deduplicate
+                )
+                for radiation_range, min_towers_per_region, min_gap in configurations
+            ]
+            for (radiation_range, min_towers_per_region, min_gap), task in zip(configurations, optimization_tasks):
+                row = dict(radiation_range=radiation_range, min_towers=min_towers_per_region, min_gap=min_gap)
+                row.update(task.result())
+                row['cellsite_seconds'] = cellsite_seconds[radiation_range]
+                row['seconds'] = row['cellsite_seconds'] + row['optimize_seconds'] + row['evaluate_seconds']
+                self.rows.append(row)
+
+        return self.rows
+
+    def save(self, filename):
+        '''
+        Writes the results table as CSV, or tab separated unless the file ends with .csv
+        '''
+        delimiter = "," if filename.endswith(".csv") else "\t"
+        with open(filename, "w", newline="") as results_file:
+            writer = csv.DictWriter(results_file, fieldnames=self.COLUMNS, delimiter=delimiter)
+            writer.writeheader()
+            for row in self.rows:
+                writer.writerow({
+                    column: "%.3f" % value if isinstance(value, float) else value
+                    for column, value in row.items()
+                })
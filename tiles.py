@@ -0,0 +1,296 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from towerdistribution import TowerDistribution
+from instrumentation import profiler
+
+TILE_SIZE = 256
+# metres per pixel at the equator on zoom level 0
+EQUATOR_METRES_PER_PIXEL = 156543.03392
+
+VIEWER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Tower distribution</title>
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {{ height: 100%; margin: 0; }}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var bounds = L.latLngBounds({bounds});
+var map = L.map("map", {{preferCanvas: true}}).fitBounds(bounds);
+L.tileLayer("https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png", {{
+    maxZoom: 19, attribution: "&copy; OpenStreetMap contributors"
+}}).addTo(map);
+L.tileLayer("{{z}}/{{x}}/{{y}}.png", {{
+    minZoom: {min_zoom}, maxNativeZoom: {max_zoom}, maxZoom: 19, bounds: bounds,
+    errorTileUrl: "data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
+}}).addTo(map);
+</script>
+</body>
+</html>
+"""
+
+def to_pixels(coordinates, zoom):
+    '''
+    Projects latitude, longitude to global web mercator pixel coordinates
+    :return: array of x, y pixels
+    '''
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    scale = TILE_SIZE * 2 ** zoom
+    latitude = np.radians(np.clip(coordinates[:, 0], -85.0511, 85.0511))
+    x = (coordinates[:, 1] + 180) / 360 * scale
+    y = (1 - np.log(np.tan(latitude) + 1 / np.cos(latitude)) / np.pi) / 2 * scale
+    return np.column_stack((x, y))
+
+def tile_pairs(pixels_min, pixels_max):
+    '''
+    Lists every tile touched by each bounding box
+    :return: tuple of tile x, tile y and the index of the box
+    '''
+    tiles_min = np.floor(pixels_min / TILE_SIZE).astype(np.int64)
+    tiles_max = np.floor(pixels_max / TILE_SIZE).astype(np.int64)
+    widths = tiles_max[:, 0] - tiles_min[:, 0] + 1
+    heights = tiles_max[:, 1] - tiles_min[:, 1] + 1
+    counts = widths * heights
+    indices = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile_x = tiles_min[indices, 0] + offsets % widths[indices]
+    tile_y = tiles_min[indices, 1] + offsets // widths[indices]
+    return tile_x, tile_y, indices
+
+def render_tile(filepath, users, user_colors, discs, disc_radii, disc_colors, segments, segment_colors, stations):
+    '''
+    Rasterizes one tile, runs inside the process pool. All coordinates are pixels
+    relative to the top left corner of the tile.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Circle
+    from matplotlib.collections import PatchCollection, LineCollection
+
+    figure = Figure(figsize=(1, 1), dpi=TILE_SIZE)
+    figure.patch.set_alpha(0)
+    axes = figure.add_axes([0, 0, 1, 1])
+    axes.set_xlim(0, TILE_SIZE)
+    axes.set_ylim(TILE_SIZE, 0)
+    axes.set_axis_off()
+
+    if len(discs):
+        axes.add_collection(PatchCollection(
+            [Circle(center, radius) for center, radius in zip(discs, disc_radii)],
+            facecolors=[color + "26" for color in disc_colors], edgecolors=disc_colors, linewidths=0.6
+        ))
+    if len(segments):
+        axes.add_collection(LineCollection(segments, colors=segment_colors, linewidths=0.8))
+
+    if len(users):
+        # users are binned per pixel, a pixel shows the region color of its users
+        # with an opacity growing with their count
+        pixels = np.floor(users).astype(np.int64)
+        flat = pixels[:, 1] * TILE_SIZE + pixels[:, 0]
+        counts = np.bincount(flat, minlength=TILE_SIZE * TILE_SIZE)
+        image = np.zeros((TILE_SIZE * TILE_SIZE, 4))
+        image[flat, :3] = user_colors
+        image[:, 3] = np.clip(0.45 + 0.15 * np.log2(np.maximum(counts, 1)), 0, 1) * (counts > 0)
+        axes.imshow(
+            image.reshape(TILE_SIZE, TILE_SIZE, 4), extent=(0, TILE_SIZE, TILE_SIZE, 0),
+            interpolation="nearest", zorder=2
+        )
+
+    if len(discs):
+        # markers shrink with the discs on the lower zoom levels, sizes are in points squared
+        marker_sizes = (np.clip(0.3 * disc_radii, 2, 9) * 72 / TILE_SIZE) ** 2
+        axes.scatter(
+            discs[:, 0], discs[:, 1], s=marker_sizes, marker="^", c=disc_colors,
+            edgecolors="black", linewidths=0.3, zorder=3
+        )
+    if len(stations):
+        axes.scatter(
+            stations[:, 0], stations[:, 1], s=(12 * 72 / TILE_SIZE) ** 2, marker="p", c="orange",
+            edgecolors="black", linewidths=0.5, zorder=4
+        )
+
+    directory = os.path.dirname(filepath)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    figure.savefig(filepath, dpi=TILE_SIZE, transparent=True)
+    return filepath
+
+class TileRenderer:
+    '''
+    Exports the tower distribution as a z/x/y PNG tile pyramid with a static Leaflet
+    viewer, for distributions too large for a single HTML map. Users, coverage discs,
+    backhaul lines and base stations are projected and assigned to tiles with numpy
+    in one pass per zoom level, and the tiles are drawn with matplotlib Agg in a
+    process pool.
+
+    A manifest keeps a hash of the inputs of every tile, so a new export into the
+    same directory only redraws the tiles whose users, cell sites or regions changed.
+    '''
+    MANIFEST = "tiles.json"
+
+    def __init__(self, tower_distribution, min_zoom=10, max_zoom=15, workers=None, cell_site_radius=800):
+        if not 0 <= min_zoom <= max_zoom <= 22:
+            raise ValueError("zoom levels must satisfy 0 <= min zoom <= max zoom <= 22")
+        if workers is not None and workers < 1:
+            raise ValueError("no of workers must be atleast 1")
+        if not isinstance(tower_distribution, TowerDistribution):
+            tower_distribution = TowerDistribution.from_dict(tower_distribution)
+        self.tower_distribution = tower_distribution.compacted()
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.workers = workers or os.cpu_count() or 1
+        self.cell_site_radius = cell_site_radius
+        self.logger = logging.getLogger("visualizer")
+
+    def region_colors(self):
+        from visualizer import Visuals
+        palette = Visuals.palette
+        return np.array([palette[region_id % len(palette)] for region_id in range(len(self.tower_distribution.base_stations))])
+
+    @staticmethod
+    def rgb(colors):
+        return np.array([[int(color[index:index + 2], 16) / 255 for index in (1, 3, 5)] for color in colors]).reshape(-1, 3)
+
+    def zoom_tiles(self, zoom, region_colors, region_rgb):
+        '''
+        Assigns every element to the tiles it is drawn on at one zoom level
+        :return: dict of (x, y): keyword arguments of render_tile without the filepath
+        '''
+        tower_distribution = self.tower_distribution
+        user_pixels = to_pixels(tower_distribution.users, zoom)
+        site_pixels = to_pixels(tower_distribution.cell_sites, zoom)
+        station_pixels = to_pixels(tower_distribution.base_stations, zoom)
+
+        latitudes = np.radians(tower_distribution.cell_sites[:, 0])
+        radii = self.cell_site_radius * 2 ** zoom / (EQUATOR_METRES_PER_PIXEL * np.cos(latitudes))
+        backhaul_start = station_pixels[tower_distribution.cell_site_region]
+        margin = 4
+
+        parts = {
+            "users": tile_pairs(user_pixels, user_pixels),
+            "discs": tile_pairs(site_pixels - radii[:, np.newaxis] - margin, site_pixels + radii[:, np.newaxis] + margin),
+            "segments": tile_pairs(
+                np.minimum(backhaul_start, site_pixels) - margin, np.maximum(backhaul_start, site_pixels) + margin
+            ),
+            "stations": tile_pairs(station_pixels - margin, station_pixels + margin)
+        }
+
+        tiles = dict()
+        for part, (tile_x, tile_y, indices) in parts.items():
+            keys = tile_x * (1 << 32) + tile_y
+            order = np.argsort(keys, kind="mergesort")
+            unique_keys, starts = np.unique(keys[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            for key, start, end in zip(unique_keys, starts, ends):
+                tiles.setdefault((int(key >> 32), int(key & 0xffffffff)), dict())[part] = indices[order[start:end]]
+
+        tile_arguments = dict()
+        for (x, y), members in tiles.items():
+            origin = np.array([x, y]) * TILE_SIZE
+            users = members.get("users", np.empty(0, dtype=np.intp))
+            discs = members.get("discs", np.empty(0, dtype=np.intp))
+            segments = members.get("segments", np.empty(0, dtype=np.intp))
+            stations = members.get("stations", np.empty(0, dtype=np.intp))
+            tile_arguments[(x, y)] = dict(
+                users=user_pixels[users] - origin,
+                user_colors=region_rgb[tower_distribution.user_region[users]],
+                discs=site_pixels[discs] - origin,
+                disc_radii=radii[discs],
+                disc_colors=list(region_colors[tower_distribution.cell_site_region[discs]]),
+                segments=np.stack((backhaul_start[segments] - origin, site_pixels[segments] - origin), axis=1),
+                segment_colors=list(region_colors[tower_distribution.cell_site_region[segments]]),
+                stations=station_pixels[stations] - origin
+            )
+        return tile_arguments
+
+    @staticmethod
+    def digest(arguments, radius):
+        digest = hashlib.sha1(str(radius).encode())
+        for name in sorted(arguments):
+            value = arguments[name]
+            digest.update(name.encode())
+            if isinstance(value, list):
+                digest.update(",".join(value).encode())
+            else:
+                digest.update(np.ascontiguousarray(np.round(value, 3)).tobytes())
+        return digest.hexdigest()
+
+    def render(self, directory):
+        '''
+        Renders the pyramid into directory, redrawing only the changed tiles
+        :return: dict with the no of tiles rendered, unchanged and removed
+        '''
+        manifest_filepath = os.path.join(directory, self.MANIFEST)
+        previous = dict()
+        if os.path.exists(manifest_filepath):
+            with open(manifest_filepath) as manifest_file:
+                previous = json.load(manifest_file).get("tiles", dict())
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        region_colors = self.region_colors()
+        region_rgb = self.rgb(region_colors)
+        tiles, stale = dict(), []
+        with profiler.span("tile_assignment", zooms=self.max_zoom - self.min_zoom + 1):
+            for zoom in range(self.min_zoom, self.max_zoom + 1):
+                for (x, y), arguments in self.zoom_tiles(zoom, region_colors, region_rgb).items():
+                    name = "%d/%d/%d" % (zoom, x, y)
+                    tiles[name] = self.digest(arguments, self.cell_site_radius)
+                    filepath = os.path.join(directory, name + ".png")
+                    if previous.get(name) != tiles[name] or not os.path.exists(filepath):
+                        stale.append((filepath, arguments))
+
+        removed = 0
+        for name in set(previous) - set(tiles):
+            filepath = os.path.join(directory, name + ".png")
+            if os.path.exists(filepath):
+                os.remove(filepath)
+                removed += 1
+
+        self.logger.debug(
+            "Rendering " + str(len(stale)) + " of " + str(len(tiles)) + " tiles on " + str(self.workers) + " workers"
+        )
+        with profiler.span("tile_rendering", tiles=len(stale)):
+            if self.workers == 1:
+                for filepath, arguments in stale:
+                    render_tile(filepath, **arguments)
+            else:
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    tasks = [pool.submit(render_tile, filepath, **arguments) for filepath, arguments in stale]
+                    for task in tasks:
+                        task.result()
+        profiler.count("tiles_rendered", len(stale))
+
+        with open(manifest_filepath, "w") as manifest_file:
+            json.dump({
+                "min_zoom": self.min_zoom, "max_zoom": self.max_zoom, "tile_size": TILE_SIZE, "tiles": tiles
+            }, manifest_file)
+        self.write_viewer(os.path.join(directory, "index.html"))
+
+        return {"rendered": len(stale), "unchanged": len(tiles) - len(stale), "removed": removed}
+
+    def write_viewer(self, filepath):
+        points = np.concatenate((self.tower_distribution.users, self.tower_distribution.cell_sites), axis=0)
+        if len(points):
+            bounds = [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+        else:
+            bounds = [[17.7, 83.2], [17.8, 83.3]]
+        with open(filepath, "w") as viewer_file:
+            viewer_file.write(VIEWER.format(bounds=json.dumps(bounds), min_zoom=self.min_zoom, max_zoom=self.max_zoom))
+
+if __name__ == "__main__":
+    import sys
+    from datahandler import Deserializer
+
+    # USAGE: python3 tiles.py DISTRIBUTION OUTPUT_DIRECTORY [MAX_ZOOM]
+    tower_distribution = Deserializer().load(sys.argv[1])
+    renderer = TileRenderer(tower_distribution, max_zoom=int(sys.argv[3]) if len(sys.argv) > 3 else 15)
+    print(renderer.render(sys.argv[2]))
@@ -0,0 +1,253 @@
+import numpy as np
+from collections.abc import Mapping
+
+class TowerDistribution(Mapping):
+    '''
+    Columnar tower distribution: one contiguous array of users with their region ids,
+    one array of cell sites with the ids of the regions owning them and one array of
+    base stations indexed by region id.
+
+    Merging regions only remaps region ids, so users are never copied between regions.
+    Added users are kept apart until every user is needed, so that adding a few users
+    to a memory-mapped distribution does not copy it. The mapping interface is a view keyed by str(base_station) that yields the same
+    {'users', 'cell_sites', 'base_station'} dicts as the former dict based structure.
+    '''
+    def __init__(self, users, user_region, cell_sites, cell_site_region, base_stations):
+        self.stored_users = np.asarray(users, dtype=float).reshape(-1, 2)
+        self.stored_user_region = np.asarray(user_region, dtype=np.intp)
+        self.added_users = np.empty((0, 2))
+        self.added_user_region = np.empty(0, dtype=np.intp)
+        # the first grouped_users stored users are ordered by region id, found by binary search
+        self.grouped_users = 0
+        self.cell_sites = np.asarray(cell_sites, dtype=float).reshape(-1, 2)
+        self.cell_site_region = np.asarray(cell_site_region, dtype=np.intp)
+        self.base_stations = np.array(base_stations, dtype=float).reshape(-1, 2)
+        # region_map[region] is the region it was merged into, itself while it exists
+        self.region_map = np.arange(len(self.base_stations))
+
+    @classmethod
+    def from_regions(cls, regions, cell_sites, base_stations):
+        '''
+        Builds the distribution from the label keyed dicts of Regions and CellSites
+        :param regions: dict of label: users
+        :param cell_sites: dict of label: cell sites
+        :param base_stations: dict of label: base station
+        :return: TowerDistribution with region ids in the order of the regions dict
+        '''
+        labels = list(regions.keys())
+        tower_distribution = cls(
+            users=cls.stack([regions[label] for label in labels]),
+            user_region=np.repeat(np.arange(len(labels)), [len(regions[label]) for label in labels]),
+            cell_sites=cls.stack([cell_sites[label] for label in labels]),
+            cell_site_region=np.repeat(np.arange(len(labels)), [len(cell_sites[label]) for label in labels]),
+            base_stations=[base_stations[label] for label in labels]
+        )
+        tower_distribution.grouped_users = len(tower_distribution.stored_users)
+        return tower_distribution
+
+    @classmethod
+    def from_dict(cls, tower_distribution):
+        '''
+        Builds the distribution from the str(base_station) keyed dict
+        :param tower_distribution: dict of key: {'users', 'cell_sites', 'base_station'}
+        :return: TowerDistribution with region ids in the order of the dict
+        '''
+        regions = list(tower_distribution.values())
+        return cls.from_regions(
+            dict(enumerate(region['users'] for region in regions)),
+            dict(enumerate(region['cell_sites'] for region in regions)),
+            dict(enumerate(region['base_station'] for region in regions))
+        )
+
+    @staticmethod
+    def stack(arrays):
+        arrays = [np.asarray(array, dtype=float).reshape(-1, 2) for array in arrays]
+        if not arrays:
+            return np.empty((0, 2))
+        return np.concatenate(arrays, axis=0)
+
+    def resolve(self, region):
+        '''
+        Maps original region ids to the ids of the regions they have been merged into
+        '''
+        region_map = self.region_map
+        while True:
+            compressed = region_map[region_map]
+            if np.array_equal(compressed, region_map):
+                break
+            region_map = compressed
+        self.region_map = region_map
+        return region_map[region]
+
+    @property
+    def users(self):
+        self.store_added_users()
+        return self.stored_users
+
+    @property
+    def user_region(self):
+        self.store_added_users()
+        return self.stored_user_region
+
+    def store_added_users(self):
+        if len(self.added_users):
+            self.stored_users = np.concatenate((self.stored_users, self.added_users), axis=0)
+            self.stored_user_region = np.concatenate((self.stored_user_region, self.added_user_region))
+            self.added_users = np.empty((0, 2))
+            self.added_user_region = np.empty(0, dtype=np.intp)
+
+    @property
+    def region_ids(self):
+        return np.flatnonzero(self.region_map == np.arange(len(self.region_map)))
+
+    @property
+    def user_regions(self):
+        return self.resolve(self.user_region)
+
+    @property
+    def cell_site_regions(self):
+        return self.resolve(self.cell_site_region)
+
+    def region_users(self, region_id):
+        return self.users[self.user_regions == region_id]
+
+    def users_in(self, region_ids):
+        '''
+        Users of some regions without going over every user: the grouped users of every
+        original region merged into them are found by binary search, only the ungrouped
+        and added users are scanned
+        :param region_ids: ids of existing regions
+        :return: array of users x 2 and the region id of every user
+        '''
+        region_ids = np.asarray(region_ids, dtype=np.intp)
+        original_regions = np.flatnonzero(np.isin(self.resolve(np.arange(len(self.region_map))), region_ids))
+        grouped_region = self.stored_user_region[:self.grouped_users]
+        starts = np.searchsorted(grouped_region, original_regions, side="left")
+        ends = np.searchsorted(grouped_region, original_regions, side="right")
+        indices = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] + [np.empty(0, np.intp)])
+        users, user_region = [self.stored_users[indices]], [grouped_region[indices]]
+
+        for ungrouped_users, ungrouped_region in (
+            (self.stored_users[self.grouped_users:], self.stored_user_region[self.grouped_users:]),
+            (self.added_users, self.added_user_region)
+        ):
+            selected = np.isin(self.resolve(ungrouped_region), region_ids)
+            users.append(ungrouped_users[selected])
+            user_region.append(ungrouped_region[selected])
+        return np.concatenate(users, axis=0), self.resolve(np.concatenate(user_region))
+
+    def region_cell_sites(self, region_id):
+        return self.cell_sites[self.cell_site_regions == region_id]
+
+    def cell_site_counts(self):
+        '''
+        :return: no of cell sites of every region id, 0 for merged regions
+        '''
+        return np.bincount(self.cell_site_regions, minlength=len(self.base_stations))
+
+    def merge_regions(self, source, target, rejected_cell_sites=()):
+        '''
+        Merges the source region into the target region
+        :param source: id of the region that disappears
+        :param target: id of the region that absorbs the users and cell sites
+        :param rejected_cell_sites: indices of source cell sites that are dropped
+        '''
+        self.region_map[source] = target
+        if len(rejected_cell_sites):
+            self.remove_cell_sites(rejected_cell_sites)
+
+    def remove_cell_sites(self, indices):
+        self.cell_sites = np.delete(self.cell_sites, indices, axis=0)
+        self.cell_site_region = np.delete(self.cell_site_region, indices)
+
+    def add_users(self, users, region_ids):
+        self.added_users = np.concatenate((self.added_users, np.asarray(users, dtype=float).reshape(-1, 2)), axis=0)
+        self.added_user_region = np.concatenate((self.added_user_region, np.asarray(region_ids, dtype=np.intp)))
+
+    def add_cell_sites(self, cell_sites, region_ids):
+        self.cell_sites = np.concatenate((self.cell_sites, np.asarray(cell_sites).reshape(-1, 2)), axis=0)
+        self.cell_site_region = np.concatenate((self.cell_site_region, np.asarray(region_ids, dtype=np.intp)))
+
+    def compacted(self):
+        '''
+        :return: TowerDistribution with the surviving regions renumbered 0..n-1 in order
+        '''
+        region_ids = self.region_ids
+        new_ids = np.full(len(self.base_stations), -1, dtype=np.intp)
+        new_ids[region_ids] = np.arange(len(region_ids))
+        return TowerDistribution(
+            users=self.users,
+            user_region=new_ids[self.user_regions],
+            cell_sites=self.cell_sites,
+            cell_site_region=new_ids[self.cell_site_regions],
+            base_stations=self.base_stations[region_ids]
+        )
+
+    def transformed(self, transform):
+        '''
+        :param transform: function mapping an array of points to an array of points
+        :return: TowerDistribution with the users, cell sites and base stations
+                 transformed and the same regions
+        '''
+        tower_distribution = TowerDistribution(
+            users=transform(self.users),
+            user_region=self.user_region,
+            cell_sites=transform(self.cell_sites),
+            cell_site_region=self.cell_site_region,
+            base_stations=transform(self.base_stations)
+        )
+        tower_distribution.region_map = self.region_map.copy()
+        tower_distribution.grouped_users = self.grouped_users
+        return tower_distribution
+
+    def key(self, region_id):
+        return str(self.base_stations[region_id])
+
+    def region(self, region_id):
+        return {
+            'cell_sites': self.region_cell_sites(region_id),
+            'base_station': self.base_stations[region_id],
+            'users': self.region_users(region_id)
+        }
+
+    def region_id(self, key):
+        for region_id in self.region_ids:
+            if self.key(region_id) == key:
+                return region_id
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        return self.region(self.region_id(key))
+
+    def __iter__(self):
+        return (self.key(region_id) for region_id in self.region_ids)
+
+    def __len__(self):
+        return len(self.region_ids)
+
+    def values(self):
+        # one grouping pass instead of a mask per region
+        region_ids = self.region_ids
+        user_groups = self.group(self.users, self.user_regions, region_ids)
+        cell_site_groups = self.group(self.cell_sites, self.cell_site_regions, region_ids)
+        return [
+            {
+                'cell_sites': cell_site_groups[index],
+                'base_station': self.base_stations[region_id],
+                'users': user_groups[index]
+            }
+            for index, region_id in enumerate(region_ids)
+        ]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def as_dict(self):
+        return dict(self.items())
+
+    @staticmethod
+    def group(points, point_regions, region_ids):
+        order = np.argsort(point_regions, kind="mergesort")
+        bounds = np.searchsorted(point_regions[order], np.append(region_ids, np.iinfo(np.intp).max))
+        sorted_points = points[order]
+        return [sorted_points[bounds[index]:bounds[index + 1]] for index in range(len(region_ids))]
@@ -1,15 +1,24 @@
 import os
-import csv
 import json
+import webbrowser
 import logging
 import logging.config
 import numpy as np
-from regions import Regions
-from cellsites import CellSites
-from optimizer import Optimizer
-from visualizer import Visuals
 from datahandler import *
-from evaluator import Evaluator
+from towerdistribution import TowerDistribution
+from stagecache import StageCache
+from projection import Projection
+from instrumentation import profiler
+
+# the clustering, optimization, evaluation and map modules pull in sklearn, scipy, folium
+# and matplotlib, every stage imports its own when it runs so short jobs start fast
+
+def open_in_browser(filepath):
+    '''
+    Opens a saved map in the default browser, on any platform
+    :param filepath: path of the HTML file, relative to the working directory or absolute
+    '''
+    webbrowser.open("file://" + os.path.abspath(filepath))
 
 class TowersDistributor:
     '''
@@ -18,6 +27,9 @@ class TowersDistributor:
     cell_sites = np.array([])
     base_stations = np.array([])
     regions = np.array([])
+    stage_cache = None
+    projection = None
+    STAGES = ("settlement_clustering", "cellsite_clustering", "optimization")
 
     LOGGING = {
         "version": 1,
@@ -63,6 +75,11 @@ class TowersDistributor:
                 "formatter": "default",
                 "filename": "logs/evaluator.log"
             },
+            "stagecache": {
+                "class": "logging.FileHandler",
+                "formatter": "default",
+                "filename": "logs/stagecache.log"
+            },
             "console": {
                 "class": "logging.StreamHandler",
                 "formatter": "default",
@@ -93,92 +110,381 @@ class TowersDistributor:
             "evaluator": {
                 "handlers": ["evaluator", "main", "console"],
                 "level": "DEBUG",
+            },
+            "stagecache": {
+                "handlers": ["stagecache", "main", "console"],
+                "level": "DEBUG",
             }
         }
     }
 
-    def __init__(self, dataset_filepath, enable_logger=True):
+    def __init__(self, dataset_filepath, enable_logger=True, stage_cache=None, projection=None):
+        '''
+        :param projection: None to cluster in degrees, or equirectangular to project the users
+                           once into a local plane in metres, converted back to degrees
+                           only when the distribution is saved or drawn
+        '''
+        self.configure_logging(enable_logger)
+        self.stage_cache = stage_cache
+
+        self.logger.debug("Reading dataset")
+        dataset_reader = DatasetReader()
+        with profiler.span("ingest"):
+            self.dataset = dataset_reader.read(dataset_filepath)
+        self.logger.debug(
+            "Read " + str(len(self.dataset)) + " users " + ("from cache " if dataset_reader.from_cache else "") +
+            "at " + str(int(dataset_reader.rows_per_second)) + " rows/s"
+        )
+        self.project(projection)
+
+    def configure_logging(self, enable_logger):
         if enable_logger:
             if "logs" not in os.listdir(os.getcwd()):
                 os.mkdir("logs")
             logging.config.dictConfig(self.LOGGING)
         self.logger = logging.getLogger("towersdistributor")
 
-        self.logger.debug("Reading dataset")
-        with open(dataset_filepath) as dataset_file:
-            dataset_reader = csv.reader(dataset_file)
-            self.dataset = np.array([list(map(float, datapoint)) for datapoint in dataset_reader])
+    def project(self, projection=None):
+        '''
+        Projects the users once into the plane every later stage works in,
+        self.dataset keeps the latitude, longitude of the users
+        :param projection: None or one of Projection.METHODS
+        '''
+        self.projection = None
+        self.points = self.dataset
+        if projection is None:
+            return
+        self.logger.debug("Projecting users to an " + projection + " plane in metres")
+        with profiler.span("projection", users=len(self.dataset)):
+            self.projection = Projection.from_extent(self.dataset, method=projection)
+            self.points = self.projection.forward(self.dataset)
+
+    @classmethod
+    def from_dataset(cls, dataset, enable_logger=False, projection=None):
+        '''
+        Creates a distributor for users that are already in memory
+        :param dataset: array of users x (latitude, longitude)
+        '''
+        distributor = cls.__new__(cls)
+        distributor.configure_logging(enable_logger)
+        distributor.dataset = dataset
+        distributor.project(projection)
+        return distributor
+
+    @classmethod
+    def from_distribution(cls, distribution_path, enable_logger=False):
+        '''
+        Creates a distributor around a saved tower distribution, JSON or binary
+        :param distribution_path: path given to serialize_and_save_data
+        '''
+        distributor = cls.__new__(cls)
+        distributor.configure_logging(enable_logger)
+        distributor.logger.debug("Loading tower distribution")
+        deserializer = Deserializer()
+        distributor.tower_distribution = deserializer.load(distribution_path)
+        distributor.dataset = distributor.tower_distribution.users
+        for key, value in deserializer.metadata.items():
+            setattr(distributor, key, value)
+
+        distributor.points = distributor.dataset
+        if distributor.projection is not None:
+            # saved in degrees, the distances of the metadata are in the projected metres
+            distributor.projection = Projection.from_dict(distributor.projection)
+            distributor.tower_distribution = distributor.tower_distribution.transformed(distributor.projection.forward)
+            distributor.points = distributor.tower_distribution.users
+        return distributor
+
+    def run_stage(self, stage, parameters, compute):
+        '''
+        Runs a pipeline stage, through the stage cache when one is set. The cache key
+        chains the key of the previous stage, so a stage is reused only if everything
+        upstream of it is unchanged too.
+        :param parameters: dict of the parameters that change the stage's result
+        :param compute: function without arguments that runs the stage
+        '''
+        if self.stage_cache is None:
+            return compute()
+
+        index = self.STAGES.index(stage)
+        if index == 0:
+            self.stage_keys = {"dataset": StageCache.hash_array(self.points)}
+        upstream = getattr(self, "stage_keys", dict()).get(self.STAGES[index - 1] if index else "dataset")
+        if upstream is None:
+            # the previous stage did not go through the cache
+            return compute()
 
+        self.stage_keys[stage] = StageCache.key(stage, upstream, parameters)
+        return self.stage_cache.fetch(stage, self.stage_keys[stage], compute)
 
     def metres_to_geodistance(self, metres):
         if metres < 0:
             raise ValueError("distance cannot be negative")
+        if self.projection is not None:
+            return metres
         geo_distance = metres / (10 ** 5)
         return geo_distance
 
-    def perform_settlement_clustering(self):
+    def geodistance_to_metres(self, geo_distance):
+        if self.projection is not None:
+            return geo_distance
+        return geo_distance * (10 ** 5)
+
+    def distortion_scale(self):
+        # the permissible distortion was tuned on degrees where 10 ** 5 metres make a unit
+        return 1 if self.projection is None else 10 ** 5
+
+    def geographic_distribution(self):
+        '''
+        :return: the tower distribution in latitude, longitude
+        '''
+        if self.projection is None:
+            return self.tower_distribution
+        return self.tower_distribution.transformed(self.projection.inverse)
+
+    @profiler.instrument("settlement_clustering")
+    def perform_settlement_clustering(self, affinity="dense", eigen_solver="dense", engine="spectral", n_landmarks=500):
+        if engine not in ("spectral", "landmark"):
+            raise ValueError("region engine must be spectral or landmark")
         self.logger.debug("Performing Level 1 clustering")
 
-        settlement_clustering = Regions()
-        self.regions = settlement_clustering.detect_regions(self.dataset)
-        self.base_stations = settlement_clustering.locate_base_stations_proximity()
+        def settlement_clustering_stage():
+            if engine == "landmark":
+                from landmarks import LandmarkRegions
+                settlement_clustering = LandmarkRegions(n_landmarks=n_landmarks)
+            else:
+                from regions import Regions
+                settlement_clustering = Regions(affinity=affinity, eigen_solver=eigen_solver)
+            regions = settlement_clustering.detect_regions(self.points)
+            self.region_indices = settlement_clustering.region_indices
+            return regions, settlement_clustering.locate_base_stations_proximity()
 
-    def perform_cellsite_clustering(self, radiation_range=1000):
+        # indices of every region's users in the points, only known when the stage is computed
+        self.region_indices = None
+        parameters = dict(engine=engine, n_landmarks=n_landmarks) if engine == "landmark" else \
+            dict(engine=engine, affinity=affinity, eigen_solver=eigen_solver)
+        self.regions, self.base_stations = self.run_stage(
+            "settlement_clustering", parameters, settlement_clustering_stage
+        )
+
+    @profiler.instrument("cellsite_clustering")
+    def perform_cellsite_clustering(self, radiation_range=1000, executor="thread", workers=None,
+                                    search="linear", minibatch_threshold=None):
         if radiation_range < 0:
             raise ValueError("radiation range cannot be negative")
 
+        from cellsites import CellSites
+
         self.radiation_range = self.metres_to_geodistance(radiation_range)
         self.logger.debug("Performing Level 2 clustering")
 
-        cellsite_clustering = CellSites(radiation_range=self.radiation_range)
-        self.cell_sites = cellsite_clustering.distribute_cellsites(self.regions)
+        cellsite_clustering = CellSites(
+            radiation_range=self.radiation_range, executor=executor, workers=workers,
+            search=search, minibatch_threshold=minibatch_threshold, distortion_scale=self.distortion_scale()
+        )
+        self.cell_sites = self.run_stage(
+            "cellsite_clustering",
+            dict(radiation_range=self.radiation_range, search=search, minibatch_threshold=minibatch_threshold),
+            lambda: cellsite_clustering.distribute_cellsites(self.regions)
+        )
 
+    @profiler.instrument("format")
     def format(self):
-        self.logger.debug("Formatting to dictionary")
-
-        self.tower_distribution = {}
-        for key in self.regions.keys():
-            self.tower_distribution[str(self.base_stations[key])] = {
-                'cell_sites': self.cell_sites[key],
-                'base_station': self.base_stations[key],
-                'users': self.regions[key]
-            }
+        self.logger.debug("Formatting to tower distribution")
+
+        self.tower_distribution = TowerDistribution.from_regions(self.regions, self.cell_sites, self.base_stations)
 
-    def optimize(self, min_towers=10, min_cell_site_distance=700):
+    @profiler.instrument("optimization")
+    def optimize(self, min_towers=10, min_cell_site_distance=700, merge="heap", deduplicate=False):
         if min_towers < 0:
             raise ValueError("min no of towers per cluster cannot be negative")
         if min_cell_site_distance < 0:
             raise ValueError("min gap between cell sites cannot be negative")
+        from optimizer import Optimizer
 
         self.min_towers = min_towers
         self.min_cell_site_distance = self.metres_to_geodistance(min_cell_site_distance)
         self.logger.debug("Performing Region optimization")
 
-        region = Optimizer(min_towers=self.min_towers, min_cell_site_distance=self.min_cell_site_distance)
-        self.tower_distribution = region.optimize(self.tower_distribution)
+        region = Optimizer(
+            min_towers=self.min_towers, min_cell_site_distance=self.min_cell_site_distance,
+            merge=merge, deduplicate=deduplicate
+        )
+        self.tower_distribution = self.run_stage(
+            "optimization",
+            dict(
+                min_towers=self.min_towers, min_cell_site_distance=self.min_cell_site_distance,
+                merge=merge, deduplicate=deduplicate
+            ),
+            lambda: region.optimize(self.tower_distribution)
+        )
+
+    @profiler.instrument("update")
+    def update(self, new_users, radiation_range=None, min_towers=None, min_cell_site_distance=None,
+               search="linear", minibatch_threshold=None, executor="thread", workers=None):
+        '''
+        Adds users to the current tower distribution without rerunning the pipeline.
+        Every new user joins the region of its nearest base station, only the regions
+        whose distortion now exceeds the permissible distortion get their cell sites
+        clustered again, and only the touched regions are optimized and evaluated.
+        :param new_users: array of users x (latitude, longitude) or path of a CSV or .npy dataset
+        :param radiation_range: in metres, defaults to the one the distribution was built with
+        :param min_towers: defaults to the one the distribution was built with
+        :param min_cell_site_distance: in metres, defaults to the one the distribution was built with
+        :return: evaluation report of the touched regions
+        '''
+        from scipy.spatial import cKDTree
+        from cellsites import CellSites
+        from optimizer import Optimizer
+        from evaluator import Evaluator
+
+        if isinstance(new_users, str):
+            new_users = DatasetReader().read(new_users)
+        new_users = np.asarray(new_users, dtype=float).reshape(-1, 2)
+        if self.projection is not None:
+            new_users = self.projection.forward(new_users)
+
+        if radiation_range is not None:
+            if radiation_range < 0:
+                raise ValueError("radiation range cannot be negative")
+            self.radiation_range = self.metres_to_geodistance(radiation_range)
+        if min_towers is not None:
+            if min_towers < 0:
+                raise ValueError("min no of towers per cluster cannot be negative")
+            self.min_towers = min_towers
+        if min_cell_site_distance is not None:
+            self.min_cell_site_distance = self.metres_to_geodistance(min_cell_site_distance)
+        for key in ("radiation_range", "min_towers", "min_cell_site_distance"):
+            if not hasattr(self, key):
+                raise ValueError(key.replace("_", " ") + " is required, the distribution was saved without it")
+
+        tower_distribution = self.tower_distribution
+        region_ids = tower_distribution.region_ids
+        if not len(region_ids):
+            raise ValueError("tower distribution has no regions to add users to")
+        self.logger.debug("Assigning " + str(len(new_users)) + " new users to the nearest regions")
+        nearest = cKDTree(tower_distribution.base_stations[region_ids]).query(new_users)[1]
+        assigned_regions = region_ids[nearest]
+        # the new users are appended apart and the touched regions' users found through the
+        # region grouping, so the cost follows the update, not the size of the distribution
+        tower_distribution.add_users(new_users, assigned_regions)
+        touched_regions = np.unique(assigned_regions)
+
+        touched_users, touched_user_regions = tower_distribution.users_in(touched_regions)
+        cell_site_regions = tower_distribution.cell_site_regions
+        touched_cell_sites = np.flatnonzero(np.isin(cell_site_regions, touched_regions))
+        region_users = tower_distribution.group(touched_users, touched_user_regions, touched_regions)
+        region_cell_sites = tower_distribution.group(
+            tower_distribution.cell_sites[touched_cell_sites], cell_site_regions[touched_cell_sites], touched_regions
+        )
+
+        cellsite_clustering = CellSites(
+            radiation_range=self.radiation_range, executor=executor, workers=workers,
+            search=search, minibatch_threshold=minibatch_threshold, distortion_scale=self.distortion_scale()
+        )
+        self.regions = {
+            region_id: users
+            for region_id, users, cell_sites in zip(touched_regions, region_users, region_cell_sites)
+            if cellsite_clustering.distortion(users, cell_sites) > cellsite_clustering.permissible_distortion
+        }
+        self.logger.debug(
+            str(len(touched_regions)) + " regions touched, " + str(len(self.regions)) + " need new cell sites"
+        )
+
+        if self.regions:
+            self.cell_sites = cellsite_clustering.distribute_cellsites(self.regions)
+            reclustered_regions = np.array(list(self.regions.keys()), dtype=np.intp)
+            tower_distribution.remove_cell_sites(
+                touched_cell_sites[np.isin(cell_site_regions[touched_cell_sites], reclustered_regions)]
+            )
+            tower_distribution.add_cell_sites(
+                TowerDistribution.stack(self.cell_sites.values()),
+                np.repeat(reclustered_regions, [len(cell_sites) for cell_sites in self.cell_sites.values()])
+            )
+
+            region = Optimizer(min_towers=self.min_towers, min_cell_site_distance=self.min_cell_site_distance)
+            self.tower_distribution = region.optimize(tower_distribution, region_ids=reclustered_regions)
+
+        self.logger.debug("Evaluating touched regions")
+        accuracy_evaluator = Evaluator(radiation_range=self.radiation_range)
+        accuracy_evaluator.evaluate(self.tower_distribution, region_ids=touched_regions)
+        self.evaluation = accuracy_evaluator.report
+        return self.evaluation
+
+    @profiler.instrument("serialization")
+    def serialize_and_save_data(self, output_JSON_file, output_format="json"):
+        '''
+        Saves the distribution as JSON or in the binary columnar format
+        :param output_format: json, or binary for a memory-mappable directory at output_JSON_file
+        '''
+        if output_format not in ("json", "binary"):
+            raise ValueError("output format must be json or binary")
 
-    def serialize_and_save_data(self, output_JSON_file):
         self.output_JSON_file = output_JSON_file
-        self.logger.debug("Saving UBC dict to JSON")
-        serializer = Serializer(self.tower_distribution)
-        serializer.serialize()
-        serializer.save(self.output_JSON_file)
+        metadata = {
+            key: getattr(self, key) for key in ("radiation_range", "min_towers", "min_cell_site_distance")
+            if hasattr(self, key)
+        }
+        if self.projection is not None:
+            metadata["projection"] = self.projection.to_dict()
+        serializer = Serializer(self.geographic_distribution(), metadata=metadata)
+        if output_format == "binary":
+            self.logger.debug("Saving tower distribution arrays")
+            serializer.save_arrays(self.output_JSON_file)
+        else:
+            self.logger.debug("Saving UBC dict to JSON")
+            serializer.serialize()
+            serializer.save(self.output_JSON_file)
+
+    @profiler.instrument("map_rendering")
+    def make_and_display_map(self, output_map_html_file, mode="auto", point_budget=50000, user_layer="heatmap",
+                             display=True):
+        '''
+        :param mode: detailed draws every user, large draws a downsampled user layer and
+                     GeoJSON cell sites, auto picks large above Visuals.DETAILED_MAX_USERS
+        :param point_budget: max users drawn by the large map
+        :param user_layer: heatmap or cluster layer for the users of the large map
+        :param display: open the map in the default browser once it is saved
+        '''
+        from visualizer import Visuals
 
-    def make_and_display_map(self, output_map_html_file):
         self.output_html_map_file = output_map_html_file
         self.logger.debug("Creating Visuals")
-        visuals = Visuals(self.tower_distribution)
+        visuals = Visuals(self.geographic_distribution(), mode=mode, point_budget=point_budget, user_layer=user_layer)
         # visuals.display_distribution()
         visuals.make_map(self.output_html_map_file)
 
-        self.logger.debug("Calling default browser to open map")
-        os.system("open " + self.output_html_map_file)
+        if display:
+            self.logger.debug("Calling default browser to open map")
+            open_in_browser(self.output_html_map_file)
+
+    @profiler.instrument("tile_export")
+    def make_tiles(self, output_tiles_directory, min_zoom=10, max_zoom=15, workers=None):
+        from visualizer import Visuals
+
+        self.logger.debug("Exporting map tiles")
+        visuals = Visuals(self.geographic_distribution())
+        tile_counts = visuals.make_tiles(output_tiles_directory, min_zoom=min_zoom, max_zoom=max_zoom, workers=workers)
+        self.logger.debug(
+            "Rendered " + str(tile_counts["rendered"]) + " tiles, " + str(tile_counts["unchanged"]) + " unchanged"
+        )
+        return tile_counts
+
+    @profiler.instrument("evaluation")
+    def evaluate(self, method="kdtree", report_file=None):
+        from evaluator import Evaluator
 
-    def evaluate(self):
         self.logger.debug("Evaluating model")
 
-        accuracy_evaluator = Evaluator(radiation_range=self.radiation_range)
+        accuracy_evaluator = Evaluator(radiation_range=self.radiation_range, method=method)
         users, cell_site_count, accuracy = accuracy_evaluator.evaluate(tower_distribution=self.tower_distribution)
+        self.evaluation = accuracy_evaluator.report
+
+        if report_file is not None:
+            self.logger.debug("Saving evaluation report")
+            with open(report_file, "w") as report:
+                json.dump(self.evaluation, report)
+
+        return self.evaluation
 
 
 if __name__ == "__main__":
@@ -1,25 +1,41 @@
 import folium
+import folium.plugins
 import logging
 import itertools
 import numpy as np
-import matplotlib.pyplot as plt
+from instrumentation import profiler
+from towerdistribution import TowerDistribution
 
 class Visuals:
     '''
     Displays the map, users and the cell sites predicted
     '''
-    colors = itertools.cycle([
+    palette = [
         '#e6194b', '#3cb44b', '#ffe119', '#4363d8',
         '#f58231', '#46f0f0', '#f032e6', '#bcf60c',
         '#fabebe', '#008080', '#e6beff', '#9a6324',
         '#fffac8', '#800000', '#aaffc3', '#808000',
         '#000075', '#808080', '#ffd8b1', '#ffffff',
         '#000000'
-    ])
+    ]
+    colors = itertools.cycle(palette)
+    MODES = ("auto", "detailed", "large")
+    USER_LAYERS = ("heatmap", "cluster")
+    # above this many users auto mode switches to the large data map
+    DETAILED_MAX_USERS = 5000
 
-
-    def __init__(self, tower_distribution):
+    def __init__(self, tower_distribution, mode="auto", point_budget=50000, user_layer="heatmap", cell_site_radius=800):
+        if mode not in self.MODES:
+            raise ValueError("map mode must be one of " + ", ".join(self.MODES))
+        if user_layer not in self.USER_LAYERS:
+            raise ValueError("user layer must be one of " + ", ".join(self.USER_LAYERS))
+        if point_budget < 1:
+            raise ValueError("point budget must be atleast 1")
         self.tower_distribution = tower_distribution
+        self.mode = mode
+        self.point_budget = point_budget
+        self.user_layer = user_layer
+        self.cell_site_radius = cell_site_radius
         self.logger = logging.getLogger("visualizer")
 
     def display_distribution(self):
@@ -27,6 +43,8 @@ class Visuals:
         Displays the users and cell sites
         :return: None
         '''
+        # pyplot is slow to import and only this interactive view needs it
+        import matplotlib.pyplot as plt
 
         # users, basestations, cellsites
         for UBC in self.tower_distribution.values():
@@ -75,6 +93,9 @@ class Visuals:
         :param save_path: Path to save the map
         :return: None
         '''
+        if self.mode == "large" or (self.mode == "auto" and self.user_count() > self.DETAILED_MAX_USERS):
+            return self.make_large_map(save_path)
+
         self.logger.debug("Making map with cellsite distribution")
         map = folium.Map(
             location=[17.777612, 83.250768],
@@ -88,58 +109,198 @@ class Visuals:
             cell_sites = region['cell_sites']
             color = next(self.colors)
 
-            for user in users:
-                user_marker = folium.Circle(
-                    location=user,
-                    radius=0.25,
-                    color=color,
-                    fill=True,
-                    fill_color=color,
-                    tooltip="user"
-                )
-                map.add_child(user_marker)
+            with profiler.span("map_region", users=len(users), cell_sites=len(cell_sites)):
+                for user in users:
+                    user_marker = folium.Circle(
+                        location=user,
+                        radius=0.25,
+                        color=color,
+                        fill=True,
+                        fill_color=color,
+                        tooltip="user"
+                    )
+                    map.add_child(user_marker)
 
-            for cell_site in cell_sites:
-                cell_site_marker = folium.Marker(
-                    location=cell_site,
-                    icon=folium.Icon(icon="tower", color="darkblue")
-                )
-                map.add_child(cell_site_marker)
-
-                cell_site_circle = folium.Circle(
-                    location=cell_site,
-                    radius=800,
-                    color=color,
-                    fill=True,
-                    tooltip="Cellsite"
-                )
-                map.add_child(cell_site_circle)
-
-                backhaul_line = folium.ColorLine(
-                    positions=(base_station, cell_site),
-                    colors=[0],
-                    colormap=[color, "black"],
-                    weight=2,
-                    tooltip="Backhaul"
+                for cell_site in cell_sites:
+                    cell_site_marker = folium.Marker(
+                        location=cell_site,
+                        icon=folium.Icon(icon="tower", color="darkblue")
+                    )
+                    map.add_child(cell_site_marker)
+
+                    cell_site_circle = folium.Circle(
+                        location=cell_site,
+                        radius=self.cell_site_radius,
+                        color=color,
+                        fill=True,
+                        tooltip="Cellsite"
+                    )
+                    map.add_child(cell_site_circle)
+
+                    backhaul_line = folium.ColorLine(
+                        positions=(base_station, cell_site),
+                        colors=[0],
+                        colormap=[color, "black"],
+                        weight=2,
+                        tooltip="Backhaul"
+                    )
+                    map.add_child(backhaul_line)
+
+                base_station_marker = folium.Marker(
+                    location=base_station,
+                    icon=folium.Icon(icon="home", color="orange")
                 )
-                map.add_child(backhaul_line)
+                map.add_child(base_station_marker)
+            profiler.count("map_markers", len(users) + 3 * len(cell_sites) + 1)
+
+        with profiler.span("map_save"):
+            map.save(save_path)
+
+    def make_tiles(self, directory, min_zoom=10, max_zoom=15, workers=None):
+        '''
+        Exports a z/x/y PNG tile pyramid with a static viewer at directory/index.html,
+        redrawing only the tiles that changed since the last export into directory
+        :return: dict with the no of tiles rendered, unchanged and removed
+        '''
+        from tiles import TileRenderer
+
+        self.logger.debug("Making tile pyramid with cellsite distribution")
+        renderer = TileRenderer(
+            self.tower_distribution, min_zoom=min_zoom, max_zoom=max_zoom, workers=workers,
+            cell_site_radius=self.cell_site_radius
+        )
+        return renderer.render(directory)
+
+    def user_count(self):
+        if isinstance(self.tower_distribution, TowerDistribution):
+            return len(self.tower_distribution.users)
+        return sum(len(region['users']) for region in self.tower_distribution.values())
+
+    def downsample(self, points):
+        '''
+        Keeps a seeded random sample of point_budget points when there are more
+        '''
+        if len(points) <= self.point_budget:
+            return points
+        sample = np.random.default_rng(0).choice(len(points), self.point_budget, replace=False)
+        return points[np.sort(sample)]
+
+    @staticmethod
+    def feature_collection(features):
+        return {"type": "FeatureCollection", "features": features}
+
+    @staticmethod
+    def lon_lat(point):
+        # the distribution stores latitude, longitude while GeoJSON wants longitude, latitude
+        return [round(float(point[1]), 6), round(float(point[0]), 6)]
+
+    def make_large_map(self, save_path):
+        '''
+        Large data version of make_map. Users become a single heatmap or clustered
+        marker layer fed from one packed coordinate array, downsampled to the point
+        budget, and the cell site coverage, backhaul lines and base stations are three
+        GeoJSON FeatureCollections instead of one folium object per element.
+        :param save_path: Path to save the map
+        :return: None
+        '''
+        self.logger.debug("Making large data map with cellsite distribution")
+        tower_distribution = self.tower_distribution
+        if not isinstance(tower_distribution, TowerDistribution):
+            tower_distribution = TowerDistribution.from_dict(tower_distribution)
+        tower_distribution = tower_distribution.compacted()
+
+        users = tower_distribution.users
+        map = folium.Map(
+            location=users.mean(axis=0).tolist() if len(users) else [17.777612, 83.250768],
+            titles="OpenStreetMap",
+            zoom_start=12,
+            prefer_canvas=True
+        )
+
+        with profiler.span("map_users", users=len(users), layer=self.user_layer):
+            sampled_users = self.downsample(users)
+            if len(sampled_users) < len(users):
+                self.logger.debug("Downsampled " + str(len(users)) + " users to " + str(len(sampled_users)))
+            packed_users = np.round(sampled_users, 5).tolist()
+            if self.user_layer == "heatmap":
+                user_layer = folium.plugins.HeatMap(packed_users, name="users", radius=8, blur=10)
+            else:
+                user_layer = folium.plugins.FastMarkerCluster(packed_users, name="users")
+            map.add_child(user_layer)
+            profiler.count("map_markers", len(packed_users))
 
-            base_station_marker = folium.Marker(
-                location=base_station,
-                icon=folium.Icon(icon="home", color="orange")
+        with profiler.span("map_features", cell_sites=len(tower_distribution.cell_sites)):
+            base_stations = tower_distribution.base_stations
+            cell_site_regions = tower_distribution.cell_site_region
+            region_colors = [self.palette[region_id % len(self.palette)] for region_id in range(len(base_stations))]
+
+            coverage = self.feature_collection([
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": self.lon_lat(cell_site)},
+                    "properties": {"region": int(region_id), "color": region_colors[region_id]}
+                }
+                for cell_site, region_id in zip(tower_distribution.cell_sites, cell_site_regions)
+            ])
+            cell_site_groups = tower_distribution.group(
+                tower_distribution.cell_sites, cell_site_regions, np.arange(len(base_stations))
             )
-            map.add_child(base_station_marker)
+            backhaul = self.feature_collection([
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "MultiLineString",
+                        "coordinates": [
+                            [self.lon_lat(base_station), self.lon_lat(cell_site)] for cell_site in cell_sites
+                        ]
+                    },
+                    "properties": {"region": region_id, "color": region_colors[region_id]}
+                }
+                for region_id, (base_station, cell_sites) in enumerate(zip(base_stations, cell_site_groups))
+                if len(cell_sites)
+            ])
+            stations = self.feature_collection([
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": self.lon_lat(base_station)},
+                    "properties": {"region": region_id, "cell_sites": len(cell_sites)}
+                }
+                for region_id, (base_station, cell_sites) in enumerate(zip(base_stations, cell_site_groups))
+            ])
+
+            folium.GeoJson(
+                coverage, name="cell site coverage",
+                marker=folium.Circle(radius=self.cell_site_radius, fill=True, weight=1),
+                style_function=lambda feature: {
+                    "color": feature["properties"]["color"], "fillColor": feature["properties"]["color"],
+                    "fillOpacity": 0.15
+                },
+                tooltip=folium.GeoJsonTooltip(fields=["region"])
+            ).add_to(map)
+            folium.GeoJson(
+                backhaul, name="backhaul",
+                style_function=lambda feature: {"color": feature["properties"]["color"], "weight": 2}
+            ).add_to(map)
+            folium.GeoJson(
+                stations, name="base stations",
+                marker=folium.CircleMarker(radius=6, fill=True, color="black", fill_color="orange", fill_opacity=1),
+                tooltip=folium.GeoJsonTooltip(fields=["region", "cell_sites"])
+            ).add_to(map)
+            profiler.count("map_features", len(coverage["features"]) + len(backhaul["features"]) + len(base_stations))
 
-        map.save(save_path)
+        folium.LayerControl().add_to(map)
+        with profiler.span("map_save"):
+            map.save(save_path)
 
 if __name__ == "__main__":
-    import os
+    import sys
     from datahandler import *
+    from towersdistributor import open_in_browser
 
+    # either a JSON file or a binary distribution directory
     deserializer = Deserializer()
-    deserializer.restore("outputs/td.json")
-    tower_distribution = deserializer.deserialize()
+    tower_distribution = deserializer.load(sys.argv[1] if len(sys.argv) > 1 else "outputs/td.json")
 
     visuals = Visuals(tower_distribution)
     visuals.make_map("tower-distribution.html")
-    os.system("open tower-distribution.html")
\ No newline at end of file
+    open_in_browser("tower-distribution.html")
\ No newline at end of file